@@ -2,8 +2,6 @@
 Global variables used throughout the code.
 """
 import os
-import boto3
-import sagemaker
 
 # model deployment
 HF_MODEL_ID: str = "anymodality/llava-v1.5-7b"
@@ -20,8 +18,7 @@ BUCKET_EMB_PREFIX: str = f"{BUCKET_PREFIX}/osi-embeddings-json"
 BUCKET_IMG_PREFIX: str = f"{BUCKET_PREFIX}/img"
 
 # Amazon Titan multimodal model
-AWS_REGION: str = boto3.Session().region_name
-FMC_URL: str = f"https://bedrock-runtime.{AWS_REGION}.amazonaws.com"
+# AWS_REGION and FMC_URL are looked up on first use, see __getattr__ below
 FMC_MODEL_ID: str = "amazon.titan-embed-image-v1"
 ACCEPT_ENCODING: str = "application/json"
 CONTENT_ENCODING: str = "application/json"
@@ -35,7 +32,8 @@ OS_SERVICE: str = "aoss"
 # local files and folder structure
 IMAGE_DIR: str = "img"
 IMAGE_FILE_EXTN: str = ".jpg"
-B64_ENCODED_IMAGES_DIR: str = os.path.join(IMAGE_DIR, "b64_images")
+# images larger than this are memory mapped while they are encoded to base64
+MMAP_THRESHOLD_BYTES: int = 4 * 1024 * 1024
 ENDPOINT_FILENAME: str = "endpoint.txt"
 
 # this is the slide deck to which we will be talking to. Replace with your slide deck's URL to analyze a different deck
@@ -44,3 +42,17 @@ SLIDE_DECK: str = "https://d1.awsstatic.com/events/Summits/torsummit2023/CMP301_
 # AWS CloudFormation stack that created the resources for this blog post including this notebook
 # if a different name is used while creating the CloudFormation stack then change this to match the name you used
 CFN_STACK_NAME: str = "multimodal-stack"
+
+
+def __getattr__(name: str) -> str:
+    # the region, and the endpoint url that depends on it, are looked up on first use rather than when this
+    # module is imported, since importing boto3 and creating a session takes a large part of the startup time
+    if name == 'AWS_REGION':
+        import boto3
+        value = boto3.Session().region_name
+    elif name == 'FMC_URL':
+        value = f"https://bedrock-runtime.{globals().get('AWS_REGION') or __getattr__('AWS_REGION')}.amazonaws.com"
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
@@ -2,8 +2,6 @@
 Global variables used throughout the code.
 """
 import os
-import boto3
-import sagemaker
 
 BUCKET_PREFIX: str = "multimodal"
 BUCKET_EMB_PREFIX: str = f"{BUCKET_PREFIX}/osi-embeddings-json"
@@ -13,8 +11,7 @@ S3_MODEL_CODE_PREFIX: str = "code"
 S3_MODEL_PREFIX: str = "model"
 
 # Amazon Titan Text model
-AWS_REGION: str = boto3.Session().region_name
-TITAN_URL: str = f"https://bedrock-runtime.{AWS_REGION}.amazonaws.com"
+# AWS_REGION and TITAN_URL are looked up on first use, see __getattr__ below
 TITAN_MODEL_ID: str = "amazon.titan-embed-text-v1"
 CLAUDE_MODEL_ID: str = "anthropic.claude-3-sonnet-20240229-v1:0"
 ACCEPT_ENCODING: str = "application/json"
@@ -26,7 +23,8 @@ OS_SERVICE: str = "aoss"
 # local files and folder structure
 IMAGE_DIR: str = "img"
 IMAGE_FILE_EXTN: str = ".jpg"
-B64_ENCODED_IMAGES_DIR: str = os.path.join(IMAGE_DIR, "b64_images")
+# images larger than this are memory mapped while they are encoded to base64
+MMAP_THRESHOLD_BYTES: int = 4 * 1024 * 1024
 
 # this is the slide deck to which we will be talking to. Replace with your slide deck's URL to analyze a different deck
 SLIDE_DECK: str = "https://d1.awsstatic.com/events/Summits/torsummit2023/CMP301_TrainDeploy_E1_20230607_SPEdited.pdf"
@@ -35,3 +33,16 @@ SLIDE_DECK: str = "https://d1.awsstatic.com/events/Summits/torsummit2023/CMP301_
 # if a different name is used while creating the CloudFormation stack then change this to match the name you used
 CFN_STACK_NAME: str = "multimodal-blog2-stack"
 
+
+def __getattr__(name: str) -> str:
+    # the region, and the endpoint url that depends on it, are looked up on first use rather than when this
+    # module is imported, since importing boto3 and creating a session takes a large part of the startup time
+    if name == 'AWS_REGION':
+        import boto3
+        value = boto3.Session().region_name
+    elif name == 'TITAN_URL':
+        value = f"https://bedrock-runtime.{globals().get('AWS_REGION') or __getattr__('AWS_REGION')}.amazonaws.com"
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
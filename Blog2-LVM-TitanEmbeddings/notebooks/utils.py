@@ -3,13 +3,15 @@ Utility functions for S3 and CloudFormation used by the rest of the code
 """
 import os
 import json
+import time
 import boto3
+import hashlib
 import logging
 import botocore
 import numpy as np
 import globals as g
-from typing import List
-from sagemaker.s3 import S3Uploader
+from typing import List, Dict
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger(__name__)
 
@@ -38,16 +40,43 @@ def upload_to_s3(local_file_path:str, bucket_name: str, bucket_prefix:str) -> No
     except Exception as e:
         logger.error(f"error uploading file to S3: {e}")
         
-def download_image_files_from_s3(bucket:str, bucket_image_prefix:str, local_image_dir:str, image_file_extn:str) -> List:
-    images = s3.list_objects_v2(Bucket=bucket, Prefix=bucket_image_prefix)['Contents']
-    local_file_paths: List = []
-    for img in images:
-        if img['Key'].endswith(image_file_extn):
-            file_path = os.path.join(local_image_dir, os.path.basename(img['Key']))            
-            s3.download_file(bucket, img['Key'], file_path)
-            logger.info(f"downloaded {bucket}/{img['Key']} to {file_path}")
-            local_file_paths.append(file_path)
-    return local_file_paths 
+def _is_unchanged(local_path: str, obj: Dict) -> bool:
+    # the local file is unchanged if it has the size of the object and, for objects uploaded in a single part,
+    # the MD5 in the ETag. The ETag of a multipart object is not the MD5 of the file, so its LastModified time,
+    # which is set as the modification time of the local file when it is downloaded, is compared instead
+    if not os.path.exists(local_path) or os.path.getsize(local_path) != obj['Size']:
+        return False
+    etag: str = obj['ETag'].strip('"')
+    if '-' in etag:
+        return int(os.path.getmtime(local_path)) == int(obj['LastModified'].timestamp())
+    with open(local_path, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest() == etag
+
+
+def download_image_files_from_s3(bucket:str, bucket_image_prefix:str, local_image_dir:str, image_file_extn:str, max_workers: int = 16) -> List:
+    # list every page of the prefix (list_objects_v2 returns at most 1000 keys per call)
+    objects: List[Dict] = [obj for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=bucket_image_prefix)
+                           for obj in page.get('Contents', []) if obj['Key'].endswith(image_file_extn)]
+
+    def download(obj: Dict) -> int:
+        file_path = os.path.join(local_image_dir, os.path.basename(obj['Key']))
+        if _is_unchanged(file_path, obj):
+            logger.info(f"{file_path} is unchanged from {bucket}/{obj['Key']}, skipping the download")
+            return 0
+        s3.download_file(bucket, obj['Key'], file_path)
+        # keep the LastModified time of the object, so that a changed multipart object is downloaded again
+        last_modified: float = obj['LastModified'].timestamp()
+        os.utime(file_path, (last_modified, last_modified))
+        logger.info(f"downloaded {bucket}/{obj['Key']} to {file_path}")
+        return obj['Size']
+    # download the files concurrently, the boto3 client is thread safe
+    st = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        downloaded_bytes: int = sum(executor.map(download, objects))
+    elapsed = time.perf_counter() - st
+    logger.info(f"{len(objects)} files from {bucket}/{bucket_image_prefix} are in {local_image_dir}, downloaded {downloaded_bytes} bytes "
+                f"at {downloaded_bytes / elapsed if elapsed > 0 else 0:.1f} bytes/sec")
+    return [os.path.join(local_image_dir, os.path.basename(obj['Key'])) for obj in objects]
             
             
 def get_cfn_outputs(stackname: str) -> List:  
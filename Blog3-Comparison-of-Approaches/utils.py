@@ -3,7 +3,10 @@ Utility functions for S3 and CloudFormation used by the rest of the code
 """
 import os
 import json
+import mmap
+import time
 import boto3
+import hashlib
 import base64
 import logging
 import botocore
@@ -13,7 +16,7 @@ import requests as req
 from pathlib import Path
 from typing import List, Dict
 from opensearchpy import OpenSearch
-from sagemaker.s3 import S3Uploader
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger(__name__)
 
@@ -29,16 +32,43 @@ def upload_to_s3(local_file_path:str, bucket_name: str, bucket_prefix:str) -> No
     except Exception as e:
         logger.error(f"error uploading file to S3: {e}")
         
-def download_image_files_from_s3(bucket:str, bucket_image_prefix:str, local_image_dir:str, image_file_extn:str) -> List:
-    images = s3.list_objects_v2(Bucket=bucket, Prefix=bucket_image_prefix)['Contents']
-    local_file_paths: List = []
-    for img in images:
-        if img['Key'].endswith(image_file_extn):
-            file_path = os.path.join(local_image_dir, os.path.basename(img['Key']))            
-            s3.download_file(bucket, img['Key'], file_path)
-            logger.info(f"downloaded {bucket}/{img['Key']} to {file_path}")
-            local_file_paths.append(file_path)
-    return local_file_paths 
+def _is_unchanged(local_path: str, obj: Dict) -> bool:
+    # the local file is unchanged if it has the size of the object and, for objects uploaded in a single part,
+    # the MD5 in the ETag. The ETag of a multipart object is not the MD5 of the file, so its LastModified time,
+    # which is set as the modification time of the local file when it is downloaded, is compared instead
+    if not os.path.exists(local_path) or os.path.getsize(local_path) != obj['Size']:
+        return False
+    etag: str = obj['ETag'].strip('"')
+    if '-' in etag:
+        return int(os.path.getmtime(local_path)) == int(obj['LastModified'].timestamp())
+    with open(local_path, 'rb') as f:
+        return hashlib.md5(f.read()).hexdigest() == etag
+
+
+def download_image_files_from_s3(bucket:str, bucket_image_prefix:str, local_image_dir:str, image_file_extn:str, max_workers: int = 16) -> List:
+    # list every page of the prefix (list_objects_v2 returns at most 1000 keys per call)
+    objects: List[Dict] = [obj for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=bucket_image_prefix)
+                           for obj in page.get('Contents', []) if obj['Key'].endswith(image_file_extn)]
+
+    def download(obj: Dict) -> int:
+        file_path = os.path.join(local_image_dir, os.path.basename(obj['Key']))
+        if _is_unchanged(file_path, obj):
+            logger.info(f"{file_path} is unchanged from {bucket}/{obj['Key']}, skipping the download")
+            return 0
+        s3.download_file(bucket, obj['Key'], file_path)
+        # keep the LastModified time of the object, so that a changed multipart object is downloaded again
+        last_modified: float = obj['LastModified'].timestamp()
+        os.utime(file_path, (last_modified, last_modified))
+        logger.info(f"downloaded {bucket}/{obj['Key']} to {file_path}")
+        return obj['Size']
+    # download the files concurrently, the boto3 client is thread safe
+    st = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        downloaded_bytes: int = sum(executor.map(download, objects))
+    elapsed = time.perf_counter() - st
+    logger.info(f"{len(objects)} files from {bucket}/{bucket_image_prefix} are in {local_image_dir}, downloaded {downloaded_bytes} bytes "
+                f"at {downloaded_bytes / elapsed if elapsed > 0 else 0:.1f} bytes/sec")
+    return [os.path.join(local_image_dir, os.path.basename(obj['Key'])) for obj in objects]
             
 def download_image_from_url(url, image_dir):
     logger.info(f"downloading image at {url}")
@@ -53,12 +83,12 @@ def download_image_from_url(url, image_dir):
     return ""
 
 def encode_image_to_base64(image_file_path: str) -> str:
+    # the image is encoded in memory, large images are memory mapped instead of read into memory
     with open(image_file_path, "rb") as image_file:
-        b64_image = base64.b64encode(image_file.read()).decode('utf8')
-        b64_image_path = os.path.join(g.B64_ENCODED_IMAGES_DIR, f"{Path(image_file_path).stem}.b64")
-        with open(b64_image_path, "wb") as b64_image_file:
-            b64_image_file.write(bytes(b64_image, 'utf-8'))
-    return b64_image_path
+        if os.fstat(image_file.fileno()).st_size > g.MMAP_THRESHOLD_BYTES:
+            with mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return base64.b64encode(mm).decode('utf8')
+        return base64.b64encode(image_file.read()).decode('utf8')
 
 def find_similar_data(os_client: OpenSearch, text_embeddings: np.ndarray, size: int, index_name: str, deck_name: str, deck_url: str) -> Dict:
     query = {
@@ -81,11 +111,8 @@ def find_similar_data(os_client: OpenSearch, text_embeddings: np.ndarray, size:
         image_based_search_response = None
     return image_based_search_response
 
-def get_img_desc(bedrock: botocore.client, image_file_path: str, prompt: str):
-    # read the file, MAX image size supported is 2048 * 2048 pixels
-    with open(image_file_path, "rb") as image_file:
-        input_image_b64 = image_file.read().decode('utf-8')
-  
+def get_img_desc(bedrock: botocore.client, input_image_b64: str, prompt: str):
+    # the image is passed in base64 encoded, see encode_image_to_base64. MAX image size supported is 2048 * 2048 pixels
     body = json.dumps(
         {
             "anthropic_version": "bedrock-2023-05-31",
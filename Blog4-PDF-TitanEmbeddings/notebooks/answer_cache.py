@@ -0,0 +1,121 @@
+"""
+Semantic cache for the responses to user questions. A question is answered from the cache if a
+previous question with a similar embedding was asked against the same indexes, so repeated and
+trivially rephrased questions skip the retrieval and LLM calls.
+"""
+import time
+import logging
+import threading
+import numpy as np
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class SemanticAnswerCache:
+    """
+    In memory cache of question responses keyed by the question embedding. A lookup returns the
+    response of the most similar cached question in the same scope if its cosine similarity is at
+    least the similarity threshold. Entries expire after a TTL and the least recently used entries
+    are evicted when the cache is full. Every entry is tied to a fingerprint of the indexed content
+    and prompt templates, and the whole cache is cleared when the fingerprint changes.
+    """
+
+    def __init__(self, similarity_threshold: float = 0.95, ttl_seconds: Optional[float] = 3600, max_entries: int = 1000):
+        """
+        :param similarity_threshold: Minimum cosine similarity between two question embeddings for a cache hit.
+        :param ttl_seconds: Seconds after which an entry expires, None for no expiry.
+        :param max_entries: Maximum number of entries kept in the cache.
+        """
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries: OrderedDict = OrderedDict()
+        self._next_key: int = 0
+        self._fingerprint: Optional[str] = None
+        self._lock = threading.Lock()
+        self._counts: Dict[str, int] = {'hits': 0, 'misses': 0, 'expired': 0, 'evicted': 0, 'invalidations': 0}
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = float(np.linalg.norm(vector))
+        return vector / norm if norm > 0 else vector
+
+    def _check_fingerprint(self, fingerprint: str) -> None:
+        # the cached responses are stale once the indexed content or the prompts change
+        if fingerprint != self._fingerprint:
+            if self._entries:
+                logger.info(f"the indexed content or prompts changed, clearing {len(self._entries)} cached answers")
+                self._counts['invalidations'] += 1
+            self._entries.clear()
+            self._fingerprint = fingerprint
+
+    def _expire(self) -> None:
+        if self.ttl_seconds is None:
+            return
+        now = time.time()
+        expired = [key for key, entry in self._entries.items() if now - entry['created_at'] > self.ttl_seconds]
+        for key in expired:
+            del self._entries[key]
+        self._counts['expired'] += len(expired)
+
+    def get(self, embedding: List[float], scope: str, fingerprint: str) -> Optional[Dict]:
+        """
+        Return a copy of the cached response for the most similar question asked in the same scope,
+        or None on a miss.
+        :param embedding: Embedding of the question.
+        :param scope: Identifies what the question was asked against, for example the index names and k.
+        :param fingerprint: Fingerprint of the indexed content and prompt templates.
+        """
+        query = self._normalize(embedding)
+        with self._lock:
+            self._check_fingerprint(fingerprint)
+            self._expire()
+            keys = [key for key, entry in self._entries.items() if entry['scope'] == scope]
+            if keys:
+                # cosine similarity with every cached question in the scope in one matrix product
+                similarities = np.stack([self._entries[key]['embedding'] for key in keys]) @ query
+                best = int(np.argmax(similarities))
+                if similarities[best] >= self.similarity_threshold:
+                    self._entries.move_to_end(keys[best])
+                    self._counts['hits'] += 1
+                    entry = self._entries[keys[best]]
+                    logger.info(f"answer cache hit with similarity={similarities[best]:.4f} to the question: {entry['question']}")
+                    return dict(entry['response'])
+            self._counts['misses'] += 1
+        return None
+
+    def put(self, embedding: List[float], scope: str, fingerprint: str, response: Dict, question: str = "") -> None:
+        """
+        Store the response to a question and evict the least recently used entries if the cache is full.
+        """
+        with self._lock:
+            self._check_fingerprint(fingerprint)
+            self._entries[self._next_key] = {'embedding': self._normalize(embedding),
+                                             'scope': scope,
+                                             'question': question,
+                                             'response': dict(response),
+                                             'created_at': time.time()}
+            self._next_key += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counts['evicted'] += 1
+
+    def stats(self) -> Dict:
+        """
+        Return the hit/miss counters, hit rate, number of expired, evicted and current entries.
+        """
+        with self._lock:
+            lookups = self._counts['hits'] + self._counts['misses']
+            return {**self._counts,
+                    'hit_rate': self._counts['hits'] / lookups if lookups else 0.0,
+                    'entries': len(self._entries)}
+
+    def clear(self) -> None:
+        """
+        Delete every cached response.
+        """
+        with self._lock:
+            self._entries.clear()
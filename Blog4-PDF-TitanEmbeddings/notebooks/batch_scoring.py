@@ -0,0 +1,114 @@
+"""
+Batch scoring of the responses in an evaluation dataset against the target responses. Every distinct
+text is embedded once, the cosine similarities of all the (response, target) pairs are computed in a
+single matrix operation, and the ROUGE scores are computed in a pool of processes.
+"""
+import logging
+import numpy as np
+import pandas as pd
+from rouge_score import rouge_scorer
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+def embed_unique_texts(texts: Sequence[str],
+                       embed_fn: Callable[[str], List[float]],
+                       max_workers: int = 8) -> Dict[str, np.ndarray]:
+    """
+    Embed each distinct text once, with up to `max_workers` embedding calls in flight.
+    :return: Dictionary of text to its embedding.
+    """
+    unique_texts: List[str] = list(dict.fromkeys(texts))
+    logger.info(f"embedding {len(unique_texts)} unique texts out of {len(texts)}")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        embeddings = list(executor.map(embed_fn, unique_texts))
+    return {text: np.asarray(embedding, dtype=np.float64) for text, embedding in zip(unique_texts, embeddings)}
+
+
+def rowwise_cosine_similarity(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    Cosine similarity between each row of `a` and the same row of `b`.
+    """
+    return np.einsum('ij,ij->i', a, b) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1))
+
+
+def _rouge_fmeasures(pairs: List[Tuple[str, str]], rouge_metric: str) -> List[float]:
+    # runs in a worker process, the scorer is created once for the whole chunk
+    scorer = rouge_scorer.RougeScorer([rouge_metric])
+    return [round(scorer.score(golden, completion)[rouge_metric].fmeasure, 4) for completion, golden in pairs]
+
+
+def rouge_fmeasures(pairs: Sequence[Tuple[str, str]],
+                    rouge_metric: str,
+                    max_workers: Optional[int] = None,
+                    chunk_size: int = 64) -> List[float]:
+    """
+    ROUGE f-measure of each (completion, golden) pair, computed in chunks by a pool of processes.
+    Each distinct pair is only scored once.
+    :param pairs: (completion, golden) text pairs.
+    :param rouge_metric: ROUGE metric to compute, for example rougeL.
+    :param max_workers: Number of worker processes, defaults to the number of CPUs.
+    :param chunk_size: Number of pairs scored by a worker process in one task.
+    """
+    unique_pairs: List[Tuple[str, str]] = list(dict.fromkeys(pairs))
+    chunks = [unique_pairs[i:i + chunk_size] for i in range(0, len(unique_pairs), chunk_size)]
+    scores: Dict[Tuple[str, str], float] = {}
+    if chunks:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for chunk, chunk_scores in zip(chunks, executor.map(_rouge_fmeasures, chunks, [rouge_metric] * len(chunks))):
+                scores.update(zip(chunk, chunk_scores))
+    return [scores[pair] for pair in pairs]
+
+
+def score_responses(eval_df: pd.DataFrame,
+                    response_columns: Sequence[str],
+                    target_column: str,
+                    embed_fn: Callable[[str], List[float]],
+                    rouge_metric: str,
+                    max_text_len_for_embedding: Optional[int] = None,
+                    embedding_max_workers: int = 8,
+                    rouge_max_workers: Optional[int] = None,
+                    rouge_chunk_size: int = 64) -> pd.DataFrame:
+    """
+    Score every response column against the target column. For each response column `col`, the returned
+    dataframe has the columns `col_rouge_l_f1_score` and `col_cosine_similarity`, aligned with the index of
+    `eval_df`. Rows without a response or a target response are left as NaN. The cosine similarity is
+    computed between the embeddings of the lower cased texts, truncated to `max_text_len_for_embedding`.
+    """
+    scores = pd.DataFrame(index=eval_df.index)
+    # (response column, row position, completion, golden) for every row that can be scored
+    scored_rows: List[Tuple[str, int, str, str]] = []
+    for col in response_columns:
+        scores[f'{col}_rouge_l_f1_score'] = np.nan
+        scores[f'{col}_cosine_similarity'] = np.nan
+        if col not in eval_df.columns:
+            logger.info(f"no {col} column in the evaluation dataset, it is not scored")
+            continue
+        for position, (completion, golden) in enumerate(zip(eval_df[col], eval_df[target_column])):
+            if pd.notna(completion) and pd.notna(golden) and completion and golden:
+                scored_rows.append((col, position, str(completion), str(golden)))
+    if not scored_rows:
+        logger.info("there are no responses with a target response to score")
+        return scores
+
+    def embedding_text(text: str) -> str:
+        return text.lower()[:max_text_len_for_embedding]
+
+    embeddings = embed_unique_texts([embedding_text(text) for _, _, completion, golden in scored_rows
+                                     for text in (completion, golden)],
+                                    embed_fn,
+                                    embedding_max_workers)
+    completion_matrix = np.stack([embeddings[embedding_text(completion)] for _, _, completion, _ in scored_rows])
+    golden_matrix = np.stack([embeddings[embedding_text(golden)] for _, _, _, golden in scored_rows])
+    cosine_similarities = rowwise_cosine_similarity(completion_matrix, golden_matrix)
+    rouge_scores = rouge_fmeasures([(completion, golden) for _, _, completion, golden in scored_rows],
+                                   rouge_metric,
+                                   rouge_max_workers,
+                                   rouge_chunk_size)
+    for (col, position, _, _), rouge_score, cosine_similarity in zip(scored_rows, rouge_scores, cosine_similarities):
+        scores.iat[position, scores.columns.get_loc(f'{col}_rouge_l_f1_score')] = rouge_score
+        scores.iat[position, scores.columns.get_loc(f'{col}_cosine_similarity')] = cosine_similarity
+    logger.info(f"scored {len(scored_rows)} responses across {len(response_columns)} response columns")
+    return scores
@@ -3,17 +3,43 @@
 """Helper utilities for working with Amazon Bedrock from Python notebooks"""
 # Python Built-Ins:
 import os
-from typing import Optional
+import time
+import random
+import threading
+from typing import Dict, Optional
 
 # External Dependencies:
 import boto3
 from botocore.config import Config
+from botocore.exceptions import ClientError, HTTPClientError
+from botocore.exceptions import ConnectionError as BotocoreConnectionError
+
+# error codes returned by Bedrock when the account quota for a model is exceeded
+THROTTLING_ERROR_CODES = {"ThrottlingException", "TooManyRequestsException", "ServiceUnavailableException"}
+# error codes of transient failures that are not caused by the request rate, retried without reducing the concurrency
+TRANSIENT_ERROR_CODES = {"ModelNotReadyException", "ModelTimeoutException", "InternalServerException",
+                         "RequestTimeout", "RequestTimeoutException"}
+
+
+def is_transient_error(error: Exception) -> bool:
+    """Return True for connection errors, read timeouts and 5xx or transient error codes that are not throttling"""
+    if isinstance(error, (BotocoreConnectionError, HTTPClientError)):
+        return True
+    if not isinstance(error, ClientError):
+        return False
+    code = error.response.get("Error", {}).get("Code")
+    if code in THROTTLING_ERROR_CODES:
+        return False
+    status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode") or 0
+    return code in TRANSIENT_ERROR_CODES or status >= 500
 
 
 def get_bedrock_client(
     assumed_role: Optional[str] = None,
     region: Optional[str] = None,
     runtime: Optional[bool] = True,
+    max_pool_connections: Optional[int] = None,
+    max_attempts: Optional[int] = 10,
 ):
     """Create a boto3 client for Amazon Bedrock, with optional configuration overrides
 
@@ -27,6 +53,11 @@ def get_bedrock_client(
         If not specified, AWS_REGION or AWS_DEFAULT_REGION environment variable will be used.
     runtime :
         Optional choice of getting different client to perform operations with the Amazon Bedrock service.
+    max_pool_connections :
+        Optional maximum number of connections kept in the client's connection pool. If not
+        specified, the botocore default (10) is used.
+    max_attempts :
+        Optional maximum number of attempts (including retries) made by botocore for each call.
     """
     if region is None:
         target_region = os.environ.get("AWS_REGION", os.environ.get("AWS_DEFAULT_REGION"))
@@ -42,12 +73,16 @@ def get_bedrock_client(
         print(f"  Using profile: {profile_name}")
         session_kwargs["profile_name"] = profile_name
 
+    config_kwargs = {}
+    if max_pool_connections:
+        config_kwargs["max_pool_connections"] = max_pool_connections
     retry_config = Config(
         region_name=target_region,
         retries={
-            "max_attempts": 10,
+            "max_attempts": max_attempts,
             "mode": "standard",
         },
+        **config_kwargs,
     )
     session = boto3.Session(**session_kwargs)
 
@@ -77,3 +112,237 @@ def get_bedrock_client(
     print("boto3 Bedrock client successfully created!")
     print(bedrock_client._endpoint)
     return bedrock_client
+
+
+class TokenBucket:
+    """Thread safe token bucket that limits the rate of requests sent to a single model
+
+    Parameters
+    ----------
+    rate :
+        Number of tokens (requests) added to the bucket per second.
+    capacity :
+        Maximum number of tokens the bucket can hold, i.e. the largest burst allowed. Defaults to
+        one second worth of tokens.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens = self.capacity
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1.0) -> None:
+        """Block until the requested number of tokens is available and take them"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+                self._last_refill = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait_seconds = (tokens - self._tokens) / self.rate
+            time.sleep(wait_seconds)
+
+
+class AdaptiveConcurrencyLimiter:
+    """Limits the number of in-flight requests using additive increase/multiplicative decrease (AIMD)
+
+    The limit grows by `increase_step` for every `limit` successful calls (roughly once per round of
+    requests) and is multiplied by `decrease_factor` when a call is throttled, so the concurrency
+    settles just below the point at which the service starts throttling.
+
+    Parameters
+    ----------
+    initial_limit :
+        Number of concurrent requests allowed before any feedback has been received.
+    min_limit :
+        The limit never drops below this value.
+    max_limit :
+        The limit never grows above this value.
+    increase_step :
+        Amount added to the limit for each round of successful requests.
+    decrease_factor :
+        Factor the limit is multiplied by when a request is throttled.
+    decrease_cooldown_seconds :
+        Minimum time between two decreases, so a burst of throttled requests that were all in
+        flight at the same time only reduces the limit once.
+    """
+
+    def __init__(
+        self,
+        initial_limit: int = 10,
+        min_limit: int = 1,
+        max_limit: int = 64,
+        increase_step: float = 1.0,
+        decrease_factor: float = 0.5,
+        decrease_cooldown_seconds: float = 1.0,
+    ):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.decrease_cooldown_seconds = decrease_cooldown_seconds
+        self.limit = float(min(max(initial_limit, min_limit), max_limit))
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self) -> None:
+        """Block until the number of in-flight requests is below the current limit"""
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled: bool = False) -> None:
+        """Mark a request as complete and adjust the limit based on whether it was throttled"""
+        with self._condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if throttled:
+                if now - self._last_decrease >= self.decrease_cooldown_seconds:
+                    self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                    self._last_decrease = now
+            else:
+                self.limit = min(self.max_limit, self.limit + self.increase_step / self.limit)
+            self._condition.notify_all()
+
+
+class RateLimitedBedrockClient:
+    """Wraps a Bedrock runtime client with a token bucket and an AIMD concurrency limiter per model id
+
+    `invoke_model` has the same signature as the boto3 client method, so this class can be used
+    wherever a `bedrock-runtime` client is expected. Throttled calls are retried with jittered
+    exponential backoff after reducing the concurrency for that model. Transient errors (connection
+    errors, read timeouts, ModelNotReady and 5xx errors) are retried with the same backoff, without
+    reducing the concurrency. All other client methods are passed through to the wrapped client unchanged.
+
+    Parameters
+    ----------
+    client :
+        boto3 `bedrock-runtime` client to wrap.
+    requests_per_second :
+        Optional maximum number of requests per second sent to each model id. If not specified,
+        only the adaptive concurrency limit applies.
+    initial_concurrency :
+        Number of concurrent requests per model id before any feedback has been received.
+    max_concurrency :
+        Upper bound for the number of concurrent requests per model id.
+    max_retries :
+        Number of times a throttled or transiently failed call is retried before the exception is raised.
+    base_backoff_seconds :
+        Backoff before the first retry of a call, doubled on each further retry.
+    """
+
+    def __init__(
+        self,
+        client,
+        requests_per_second: Optional[float] = None,
+        initial_concurrency: int = 10,
+        max_concurrency: int = 64,
+        max_retries: int = 8,
+        base_backoff_seconds: float = 0.5,
+    ):
+        self._client = client
+        self.requests_per_second = requests_per_second
+        self.initial_concurrency = initial_concurrency
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_backoff_seconds = base_backoff_seconds
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._limiters: Dict[str, AdaptiveConcurrencyLimiter] = {}
+        self._counters: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def _get_model_limits(self, model_id: str):
+        with self._lock:
+            if model_id not in self._limiters:
+                self._limiters[model_id] = AdaptiveConcurrencyLimiter(
+                    initial_limit=self.initial_concurrency, max_limit=self.max_concurrency
+                )
+                self._buckets[model_id] = TokenBucket(self.requests_per_second) if self.requests_per_second else None
+                self._counters[model_id] = {"calls": 0, "throttled": 0, "transient_errors": 0}
+            return self._buckets[model_id], self._limiters[model_id], self._counters[model_id]
+
+    def invoke_model(self, **kwargs):
+        """Call `invoke_model` on the wrapped client within the rate and concurrency limits of the model"""
+        bucket, limiter, counters = self._get_model_limits(kwargs.get("modelId"))
+        for attempt in range(self.max_retries + 1):
+            if bucket is not None:
+                bucket.acquire()
+            limiter.acquire()
+            throttled = False
+            transient = False
+            try:
+                return self._client.invoke_model(**kwargs)
+            except (ClientError, BotocoreConnectionError, HTTPClientError) as e:
+                throttled = isinstance(e, ClientError) and e.response.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES
+                transient = is_transient_error(e)
+                if not (throttled or transient) or attempt == self.max_retries:
+                    raise
+            finally:
+                limiter.release(throttled=throttled)
+                with self._lock:
+                    counters["calls"] += 1
+                    counters["throttled"] += int(throttled)
+                    counters["transient_errors"] += int(transient)
+            time.sleep(self.base_backoff_seconds * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+    def stats(self) -> Dict[str, Dict]:
+        """Return the number of calls, throttled calls, transient errors and the current concurrency limit per model id"""
+        with self._lock:
+            return {
+                model_id: {**self._counters[model_id], "concurrency_limit": round(limiter.limit, 2)}
+                for model_id, limiter in self._limiters.items()
+            }
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+
+# one rate limited client per region, shared by every thread in this process
+_shared_clients: Dict[Optional[str], RateLimitedBedrockClient] = {}
+_shared_clients_lock = threading.Lock()
+
+
+def get_shared_bedrock_client(
+    region: Optional[str] = None,
+    max_pool_connections: int = 50,
+    requests_per_second: Optional[float] = None,
+    initial_concurrency: int = 10,
+    max_concurrency: int = 64,
+) -> RateLimitedBedrockClient:
+    """Return the process wide, rate limited Bedrock runtime client for a region, creating it on first use
+
+    The underlying boto3 client keeps a pool of up to `max_pool_connections` connections that is
+    reused by every caller in the process. botocore retries are disabled so that throttling is
+    surfaced to the adaptive concurrency limiter instead of being retried blindly, and the
+    rate limited client retries throttling and transient errors itself. The settings
+    passed on the first call for a region are used for the lifetime of the process.
+
+    Parameters
+    ----------
+    region :
+        Optional name of the AWS Region in which the service should be called.
+    max_pool_connections :
+        Maximum number of connections kept open to the Bedrock runtime endpoint.
+    requests_per_second :
+        Optional maximum number of requests per second sent to each model id.
+    initial_concurrency :
+        Number of concurrent requests per model id before any feedback has been received.
+    max_concurrency :
+        Upper bound for the number of concurrent requests per model id.
+    """
+    with _shared_clients_lock:
+        if region not in _shared_clients:
+            client = get_bedrock_client(region=region, max_pool_connections=max_pool_connections, max_attempts=1)
+            _shared_clients[region] = RateLimitedBedrockClient(
+                client,
+                requests_per_second=requests_per_second,
+                initial_concurrency=initial_concurrency,
+                max_concurrency=max_concurrency,
+            )
+        return _shared_clients[region]
@@ -0,0 +1,464 @@
+"""
+Offline benchmark of the Blog4 ingestion and inference pipelines. The functions defined in the data
+ingestion notebook are loaded from the notebook and, with the query path in `rag_query.py`, run end to
+end against the simulated backends in `simulated_backends.py`, on a synthetic set of pdf pages and questions. The
+benchmark reports the ingestion throughput (pages/sec), the query throughput (QPS), the query latency
+percentiles and the latency percentiles of each stage of a query, and compares them with a stored
+baseline to flag regressions.
+
+It also measures the time to import the modules that notebooks, Ray workers and the query service start
+with, each in a fresh interpreter, and reports the modules whose import time is over their budget.
+
+Usage (from this directory):
+    python benchmark.py                      # run and compare with the baseline
+    python benchmark.py --update-baseline    # run and store the results as the new baseline
+    python benchmark.py --imports-only       # only check the import times against their budgets
+"""
+import os
+import ast
+import sys
+import copy
+import json
+import time
+import types
+import random
+import logging
+import argparse
+import tempfile
+import subprocess
+import statistics
+import __future__
+import numpy as np
+import globals as g
+import bedrock_utils
+import utils
+from PIL import Image, ImageDraw
+from pathlib import Path
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from IPython.core.inputtransformer2 import TransformerManager
+from bulk_writer import close_bulk_writers
+from image_cache import S3ImageCache
+from rag_query import RAGQueryEngine, load_prompt_templates
+from latency_tracer import LatencyTracer, PERCENTILES
+from local_vector_index import LocalVectorIndex
+from ingestion_pipeline import StreamingPipeline, PipelineStage
+from entity_extraction import EntityExtractor
+from simulated_backends import (BackendProfile, SimulatedBedrockRuntime, SimulatedCompletion, SimulatedOSIEndpoint,
+                                SimulatedOpenSearch, SimulatedS3, DEFAULT_VOCABULARY)
+
+logging.basicConfig(format='[%(asctime)s] p%(process)s {%(filename)s:%(lineno)d} %(levelname)s - %(message)s', level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+INGESTION_NOTEBOOK: str = "2_data_ingestion.ipynb"
+
+# functions and variables that are loaded from the data ingestion notebook
+INGESTION_DEFINITIONS: List[str] = ['get_img_desc', 'get_img_txt_embeddings', 'load_image_page', 'describe_image_page',
+                                    'describe_image_entities_and_description', 'describe_counts',
+                                    'embed_image_page', 'write_image_page', 'process_image_data',
+                                    'load_text_page', 'embed_text_page', 'write_text_page', 'process_text_data']
+
+# names of the OSI pipelines and indexes used in the benchmark
+IMG_INDEX_NAME: str = "benchmark-img-index"
+TEXT_INDEX_NAME: str = "benchmark-text-index"
+
+# metrics compared with the baseline, and whether higher values are better
+HIGHER_IS_BETTER: str = "higher"
+LOWER_IS_BETTER: str = "lower"
+
+
+def _defined_names(tree: ast.Module) -> set:
+    # top level functions, classes and variables defined by a cell
+    names = set()
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            names.add(node.name)
+        elif isinstance(node, ast.Assign):
+            names |= {target.id for target in node.targets if isinstance(target, ast.Name)}
+        elif isinstance(node, ast.AnnAssign) and isinstance(node.target, ast.Name):
+            names.add(node.target.id)
+    return names
+
+
+def run_notebook_cells(notebook_path: str, namespace: Dict, select: Callable[[str, ast.Module], bool]) -> set:
+    """
+    Execute the code cells of a notebook that are selected by `select(source, tree)` in `namespace`. IPython
+    syntax (such as `!` shell commands) is translated to Python, and annotations are not evaluated.
+    :return: Names defined by the cells that were executed.
+    """
+    transformer = TransformerManager()
+    cells = json.loads(Path(notebook_path).read_text())['cells']
+    defined = set()
+    for i, cell in enumerate(cells):
+        if cell['cell_type'] != 'code':
+            continue
+        source = transformer.transform_cell(''.join(cell['source']))
+        tree = ast.parse(source)
+        if not tree.body or not select(source, tree):
+            continue
+        exec(compile(source, f"{notebook_path}[{i}]", 'exec', flags=__future__.annotations.compiler_flag, dont_inherit=True), namespace)
+        defined |= _defined_names(tree)
+    return defined
+
+
+def load_notebook_definitions(notebook_path: str, names: List[str], namespace: Dict) -> None:
+    """
+    Execute the import cells of a notebook and the cells that define the given functions and variables.
+    """
+    def select(source: str, tree: ast.Module) -> bool:
+        imports_only = all(isinstance(node, (ast.Import, ast.ImportFrom)) for node in tree.body)
+        return imports_only or bool(_defined_names(tree) & set(names))
+    missing = set(names) - run_notebook_cells(notebook_path, namespace, select)
+    if missing:
+        raise ValueError(f"{notebook_path} does not define {sorted(missing)}")
+
+
+def generate_workload(work_dir: str, n_pages: int, n_questions: int, seed: int,
+                      vocabulary: List[str] = DEFAULT_VOCABULARY) -> Tuple[List[str], List[str], List[str]]:
+    """
+    Write a synthetic page image and page text for each of `n_pages` pages, and generate the questions.
+    :return: Paths to the page images, paths to the page texts and the questions.
+    """
+    rng = random.Random(seed)
+    image_dir = os.path.join(work_dir, 'images')
+    text_dir = os.path.join(work_dir, 'texts')
+    os.makedirs(image_dir, exist_ok=True)
+    os.makedirs(text_dir, exist_ok=True)
+    image_files: List[str] = []
+    text_files: List[str] = []
+    for page in range(1, n_pages + 1):
+        img = Image.new('RGB', (850, 1100), 'white')
+        draw = ImageDraw.Draw(img)
+        for _ in range(12):
+            x, y = rng.randint(0, 700), rng.randint(0, 950)
+            draw.rectangle([x, y, x + rng.randint(40, 150), y + rng.randint(20, 150)],
+                           fill=tuple(rng.randint(0, 255) for _ in range(3)))
+        image_file = os.path.join(image_dir, f"benchmark_page_{page}{g.IMAGE_FILE_EXTN}")
+        img.save(image_file, format='JPEG')
+        image_files.append(image_file)
+        sentences = [f"The {rng.choice(vocabulary)} of the {rng.choice(vocabulary)} depends on {rng.choice(vocabulary)}."
+                     for _ in range(40)]
+        text_file = os.path.join(text_dir, f"benchmark_text_{page}{g.TEXT_FILE_EXTN}")
+        Path(text_file).write_text(" ".join(sentences))
+        text_files.append(text_file)
+    questions: List[str] = [f"How does {rng.choice(vocabulary)} affect {rng.choice(vocabulary)}?" for _ in range(n_questions)]
+    return image_files, text_files, questions
+
+
+def percentiles_ms(latencies_seconds: List[float]) -> Dict[str, float]:
+    if not latencies_seconds:
+        return {}
+    values = np.percentile(np.array(latencies_seconds) * 1000, PERCENTILES)
+    return {f"p{p}": round(float(v), 2) for p, v in zip(PERCENTILES, values)}
+
+
+def compare_with_baseline(report: Dict, baseline: Dict, tolerance_pct: float) -> List[Dict]:
+    """
+    Return the metrics that are worse than in the baseline by more than `tolerance_pct` percent.
+    """
+    metrics: List[Tuple[str, str, Optional[float], Optional[float]]] = []
+    for kind in ('image', 'text'):
+        metrics.append((f"ingestion.{kind}.pages_per_second", HIGHER_IS_BETTER,
+                        report['ingestion'][kind].get('pages_per_second'),
+                        baseline.get('ingestion', {}).get(kind, {}).get('pages_per_second')))
+    metrics.append(("query.qps", HIGHER_IS_BETTER, report['query'].get('qps'), baseline.get('query', {}).get('qps')))
+    for p, value in report['query']['latency_ms'].items():
+        metrics.append((f"query.latency_ms.{p}", LOWER_IS_BETTER, value,
+                        baseline.get('query', {}).get('latency_ms', {}).get(p)))
+    for p, value in report['query'].get('time_to_first_token_ms', {}).items():
+        metrics.append((f"query.time_to_first_token_ms.{p}", LOWER_IS_BETTER, value,
+                        baseline.get('query', {}).get('time_to_first_token_ms', {}).get(p)))
+    for stage, stage_summary in report['stages'].items():
+        metrics.append((f"stages.{stage}.p95_ms", LOWER_IS_BETTER, stage_summary.get('p95_ms'),
+                        baseline.get('stages', {}).get(stage, {}).get('p95_ms')))
+    regressions: List[Dict] = []
+    for name, direction, value, baseline_value in metrics:
+        if value is None or not baseline_value:
+            continue
+        change_pct = (value - baseline_value) / baseline_value * 100
+        if (direction == HIGHER_IS_BETTER and change_pct < -tolerance_pct) or \
+           (direction == LOWER_IS_BETTER and change_pct > tolerance_pct):
+            regressions.append({'metric': name, 'baseline': baseline_value, 'value': value, 'change_pct': round(change_pct, 2)})
+    return regressions
+
+
+def _parse_import_times(importtime_output: str, module: str) -> Tuple[Optional[float], Dict[str, float]]:
+    # `python -X importtime` prints "import time: self [us] | cumulative | name" for every module, with the names of
+    # the modules imported by a module indented by two more spaces and printed before it
+    children: Dict[str, float] = {}
+    for line in importtime_output.splitlines():
+        if not line.startswith('import time:') or line.count('|') != 2:
+            continue
+        _, cumulative, name = line.split('|')
+        if not cumulative.strip().isdigit():
+            continue
+        depth = (len(name) - 1 - len(name[1:].lstrip())) // 2
+        if depth == 0:
+            if name.strip() == module:
+                return int(cumulative) / 1000, children
+            children = {}
+        elif depth == 1:
+            children[name.strip()] = int(cumulative) / 1000
+    return None, children
+
+
+def measure_import_times(modules: List[str], runs: int = 5, top_n: int = 5) -> Dict[str, Dict]:
+    """
+    Import each module `runs` times, each time in a fresh interpreter started from this directory.
+    :return: Median and maximum import time of each module in milliseconds, and the modules that it imports
+             that took the longest to import.
+    """
+    results: Dict[str, Dict] = {}
+    for module in modules:
+        times_ms: List[float] = []
+        children: Dict[str, float] = {}
+        for _ in range(runs):
+            proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module}"],
+                                  cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True)
+            if proc.returncode != 0:
+                raise RuntimeError(f"could not import {module}: {proc.stderr.strip().splitlines()[-1:]}")
+            import_ms, children = _parse_import_times(proc.stderr, module)
+            if import_ms is not None:
+                times_ms.append(import_ms)
+        results[module] = {'median_ms': round(statistics.median(times_ms), 2),
+                           'max_ms': round(max(times_ms), 2),
+                           'slowest_imports_ms': dict(sorted(children.items(), key=lambda kv: kv[1], reverse=True)[:top_n])}
+        logger.info(f"import {module}: {results[module]}")
+    return results
+
+
+def check_import_budgets(import_times: Dict[str, Dict], budget_ms: Dict[str, float]) -> List[Dict]:
+    """
+    Return the modules whose median import time is over their budget.
+    """
+    return [{'metric': f"import_time_ms.{module}", 'budget': budget, 'value': import_times[module]['median_ms'],
+             'slowest_imports_ms': import_times[module]['slowest_imports_ms']}
+            for module, budget in budget_ms.items() if import_times[module]['median_ms'] > budget]
+
+
+def run_benchmark(config: Dict) -> Dict:
+    """
+    Ingest a synthetic set of pages and answer a set of questions against the simulated backends.
+    :return: Report with the ingestion and query throughput, and the query and stage latency percentiles.
+    """
+    benchmark_info: Dict = config['benchmark_info']
+    workload: Dict = benchmark_info['workload']
+    backends: Dict = benchmark_info['backends']
+    time_scale: float = benchmark_info.get('time_scale', 1.0)
+    seed: int = workload.get('seed', 42)
+    work_dir = tempfile.mkdtemp(prefix='benchmark_')
+    logger.info(f"running the benchmark in {work_dir} with the workload {workload}")
+
+    # the benchmark config writes to the work directory and does not use the caches, so that every run does the same work
+    config = copy.deepcopy(config)
+    config['dir_info']['json_img_dir'] = os.path.join(work_dir, 'img_json_dir')
+    config['dir_info']['json_txt_dir'] = os.path.join(work_dir, 'text_json_dir')
+    config['embedding_cache']['enabled'] = False
+    config['answer_cache_info']['enabled'] = False
+    utils._config = config
+    # the OSI requests are signed with SigV4, which needs credentials even for the local endpoint
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+    image_files, text_files, questions = generate_workload(work_dir, workload['pages'], workload['questions'], seed)
+    profile = lambda name, offset: BackendProfile.from_config(name, backends[name], time_scale, seed + offset)
+    bedrock_runtime = SimulatedBedrockRuntime(profile('bedrock_embeddings', 1), profile('bedrock_llm', 2),
+                                              malformed_rate=backends['bedrock_llm'].get('malformed_rate', 0.0))
+    completion = SimulatedCompletion(profile('completion', 3), backends['completion'].get('not_found_rate', 0.5), seed=seed,
+                                     first_token_fraction=backends['completion'].get('first_token_fraction', 0.25))
+    osi = SimulatedOSIEndpoint(profile('osi', 4))
+    s3 = SimulatedS3(profile('s3', 5), os.path.join(work_dir, 'images'))
+    # the shared rate limited client that the notebooks get from get_bedrock_runtime_client wraps the simulated runtime
+    inference_info: Dict = config['inference_info']
+    bedrock = bedrock_utils.RateLimitedBedrockClient(bedrock_runtime,
+                                                     requests_per_second=inference_info.get('max_requests_per_second_per_model'),
+                                                     initial_concurrency=inference_info['parallel_inference_count'],
+                                                     max_concurrency=inference_info.get('max_parallel_inference_count', 64))
+    bedrock_utils._shared_clients[None] = bedrock
+    utils.completion = completion
+    # the image hits are fetched through an image cache that starts empty in every run
+    image_cache_info: Dict = config['image_cache_info']
+    utils._image_cache = S3ImageCache(os.path.join(work_dir, 'image_cache'),
+                                      max_size_mb=image_cache_info.get('max_size_mb', 512),
+                                      max_memory_mb=image_cache_info.get('max_memory_mb', 64),
+                                      max_workers=image_cache_info.get('max_workers', 16),
+                                      revalidate_after_seconds=image_cache_info.get('revalidate_after_seconds'),
+                                      s3_client=s3)
+    benchmark_globals = types.SimpleNamespace(**{k: v for k, v in vars(g).items() if not k.startswith('__')})
+    benchmark_globals.LOCAL_IMAGE_DIR = os.path.join(work_dir, 'images')
+    prompt_dir: str = config['dir_info']['prompt_dir']
+    read_prompt = lambda key: Path(os.path.join(prompt_dir, config['dir_info'][key])).read_text()
+    report: Dict = {'timestamp': datetime.now().isoformat(), 'workload': workload, 'time_scale': time_scale}
+
+    try:
+        # ingestion: the image pages go through the same streaming pipeline as in the data ingestion notebook
+        # the globals that the notebook functions read are set after the notebook imports are executed
+        ingestion: Dict = {}
+        load_notebook_definitions(INGESTION_NOTEBOOK, INGESTION_DEFINITIONS, ingestion)
+        ingestion.update(config=config, bedrock=bedrock, logger=logger, g=benchmark_globals,
+                         claude_model_id=config['model_info']['inference_model_info'].get('model_id'),
+                         bucket_name='benchmark-bucket',
+                         osi_img_endpoint=osi.url(IMG_INDEX_NAME), osi_text_endpoint=osi.url(TEXT_INDEX_NAME),
+                         entity_extraction_prompt=read_prompt('extract_image_entities_template'),
+                         image_desc_prompt=read_prompt('image_description_prompt'),
+                         entities_and_description_prompt=read_prompt('image_entities_and_description_template'))
+        run_notebook_cells(INGESTION_NOTEBOOK, ingestion, lambda source, tree: 'nltk.download(' in source)
+        pipeline_info: Dict = config['ingestion_pipeline_info']
+        stage_workers: Dict = pipeline_info['stage_workers']
+        bucket_info: Dict = {'img_prefix': g.BUCKET_IMG_PREFIX, 'image_file_extn': g.IMAGE_FILE_EXTN}
+        image_pipeline = StreamingPipeline([
+            PipelineStage('load', ingestion['load_image_page'], stage_workers['load']),
+            PipelineStage('describe', ingestion['describe_image_page'], stage_workers['describe']),
+            PipelineStage('embed', ingestion['embed_image_page'], stage_workers['embed']),
+            PipelineStage('index_write', lambda page: ingestion['write_image_page'](page, osi.url(IMG_INDEX_NAME), bucket_info),
+                          stage_workers['index_write']),
+        ], queue_size=pipeline_info['queue_size'])
+        st = time.perf_counter()
+        ingested_images = list(image_pipeline.run(image_files))
+        close_bulk_writers()
+        image_seconds = time.perf_counter() - st
+        report_ingestion = {'image': {'pages': len(image_files), 'ingested': len(ingested_images),
+                                      'seconds': round(image_seconds, 3),
+                                      'pages_per_second': round(len(ingested_images) / image_seconds, 3),
+                                      'stages': image_pipeline.stats(),
+                                      'describe_calls': dict(ingestion['describe_counts'])}}
+        # the text pages go through the same entity extraction process pool and pipeline as in the data ingestion
+        # notebook, without the entity cache so that every run extracts the entities of every page
+        text_ingestion_info: Dict = config['text_ingestion_info']
+        text_stage_workers: Dict = text_ingestion_info['stage_workers']
+        entity_extractor = EntityExtractor(max_workers=text_ingestion_info.get('max_workers'),
+                                           batch_size=text_ingestion_info.get('batch_size', 8),
+                                           max_pending_batches=text_ingestion_info.get('max_pending_batches'))
+        ingestion['entity_extractor'] = entity_extractor
+        text_pipeline = StreamingPipeline([
+            PipelineStage('embed', ingestion['embed_text_page'], text_stage_workers['embed']),
+            PipelineStage('index_write', ingestion['write_text_page'], text_stage_workers['index_write']),
+        ], queue_size=text_ingestion_info.get('queue_size', 20))
+        st = time.perf_counter()
+        try:
+            pages = (ingestion['load_text_page'](text_file, page) for page, text_file in enumerate(text_files, start=1))
+            list(text_pipeline.run(entity_extractor.extract_pages(pages)))
+        finally:
+            entity_extractor.close()
+        close_bulk_writers()
+        text_seconds = time.perf_counter() - st
+        report_ingestion['text'] = {'pages': len(text_files), 'ingested': len(osi.documents(TEXT_INDEX_NAME)),
+                                    'seconds': round(text_seconds, 3),
+                                    'pages_per_second': round(len(osi.documents(TEXT_INDEX_NAME)) / text_seconds, 3),
+                                    'stages': text_pipeline.stats(), 'entity_extraction': entity_extractor.stats()}
+        report['ingestion'] = report_ingestion
+        logger.info(f"ingestion results: {json.dumps(report_ingestion, default=str)}")
+
+        # inference: the documents accepted by the simulated OSI endpoint are served by the simulated OpenSearch
+        vector_store_info: Dict = config['vector_store_info']
+        indexes: Dict[str, LocalVectorIndex] = {}
+        for index_name in (IMG_INDEX_NAME, TEXT_INDEX_NAME):
+            indexes[index_name] = LocalVectorIndex(index_name, mode=vector_store_info.get('mode', 'exact'))
+            indexes[index_name].add(osi.documents(index_name))
+        os_client = SimulatedOpenSearch(profile('opensearch', 6), indexes)
+        tracer = LatencyTracer()
+        query_engine = RAGQueryEngine(config, IMG_INDEX_NAME, TEXT_INDEX_NAME, load_prompt_templates(config), tracer,
+                                      utils._image_cache, completion_fn=completion)
+        index_clients = [(os_client, TEXT_INDEX_NAME), (os_client, IMG_INDEX_NAME)]
+        size: int = config['other_inference_and_eval_metrics']['k_count_retrieval']
+
+        stream_answer: bool = workload.get('stream_answer', False)
+
+        def timed_query(question: str) -> Tuple[float, bool, Optional[float]]:
+            query_st = time.perf_counter()
+            if not stream_answer:
+                response = query_engine.get_index_response(question, size, index_clients)
+                return time.perf_counter() - query_st, response is not None, None
+            stream = query_engine.stream_index_response(question, size, index_clients)
+            for _ in stream:
+                pass
+            return time.perf_counter() - query_st, stream.result is not None, stream.time_to_first_token_in_seconds
+        st = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workload.get('query_concurrency', 1)) as executor:
+            query_results = list(executor.map(timed_query, questions))
+        query_seconds = time.perf_counter() - st
+        report['query'] = {'queries': len(questions),
+                           'errors': sum(1 for _, ok, _ in query_results if not ok),
+                           'concurrency': workload.get('query_concurrency', 1),
+                           'answer_mode': config['other_inference_and_eval_metrics'].get('answer_mode', 'per_hit'),
+                           'seconds': round(query_seconds, 3),
+                           'qps': round(len(questions) / query_seconds, 3),
+                           'latency_ms': percentiles_ms([latency for latency, _, _ in query_results])}
+        if stream_answer:
+            report['query']['time_to_first_token_ms'] = percentiles_ms([ttft for _, _, ttft in query_results if ttft is not None])
+        report['stages'] = {stage: {key: value for key, value in stage_summary.items() if key != 'histogram'}
+                            for stage, stage_summary in tracer.summary().items()}
+        report['backends'] = {'bedrock': bedrock_runtime.stats(), 'bedrock_client': bedrock.stats(),
+                              'completion': completion.stats(), 'osi': osi.stats(),
+                              'opensearch': os_client.stats(), 's3': s3.stats(),
+                              'image_cache': utils._image_cache.stats()}
+        logger.info(f"query results: {json.dumps(report['query'])}")
+    finally:
+        osi.close()
+        bedrock_utils._shared_clients.pop(None, None)
+        utils._image_cache.close()
+        utils._image_cache = None
+    return report
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Offline benchmark of the ingestion and inference pipelines")
+    parser.add_argument('--update-baseline', action='store_true', help="store the results as the new baseline")
+    parser.add_argument('--pages', type=int, help="number of synthetic pages to ingest, overrides the config")
+    parser.add_argument('--questions', type=int, help="number of questions to answer, overrides the config")
+    parser.add_argument('--time-scale', type=float, help="factor applied to every simulated latency, overrides the config")
+    parser.add_argument('--imports-only', action='store_true', help="only check the import times against their budgets")
+    args = parser.parse_args()
+
+    config = utils.load_and_merge_configs(g.CONFIG_SUBSET_FILE, g.FULL_CONFIG_FILE)
+    benchmark_info: Dict = config['benchmark_info']
+    if args.pages is not None:
+        benchmark_info['workload']['pages'] = args.pages
+    if args.questions is not None:
+        benchmark_info['workload']['questions'] = args.questions
+    if args.time_scale is not None:
+        benchmark_info['time_scale'] = args.time_scale
+
+    import_time_info: Dict = benchmark_info['import_time']
+    import_times = measure_import_times(list(import_time_info['budget_ms']), runs=import_time_info.get('runs', 5))
+    over_budget = check_import_budgets(import_times, import_time_info['budget_ms'])
+    for module_over_budget in over_budget:
+        logger.warning(f"OVER IMPORT TIME BUDGET: {module_over_budget}")
+    if args.imports_only:
+        report = {'timestamp': datetime.now().isoformat(), 'import_time_ms': import_times, 'regressions': over_budget}
+        logger.info(f"{len(over_budget)} modules are over their import time budget")
+        print(json.dumps(report, indent=2))
+        return 1 if over_budget else 0
+
+    report = run_benchmark(config)
+    report['import_time_ms'] = import_times
+    baseline_path = Path(benchmark_info['baseline_file'])
+    if baseline_path.exists():
+        baseline: Dict = json.loads(baseline_path.read_text())
+        if baseline.get('workload') != report['workload'] or baseline.get('time_scale') != report['time_scale']:
+            logger.warning(f"the baseline in {baseline_path} was run with a different workload, the comparison may not be meaningful")
+        report['regressions'] = compare_with_baseline(report, baseline, benchmark_info.get('regression_tolerance_pct', 10))
+        for regression in report['regressions']:
+            logger.warning(f"REGRESSION: {regression}")
+        logger.info(f"{len(report['regressions'])} regressions against the baseline in {baseline_path}")
+    else:
+        report['regressions'] = []
+        logger.info(f"there is no baseline in {baseline_path}, run with --update-baseline to store one")
+    report['regressions'].extend(over_budget)
+
+    report_dir = Path(benchmark_info['report_dir'])
+    report_dir.mkdir(parents=True, exist_ok=True)
+    report_path = report_dir / f"benchmark_report_{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+    report_path.write_text(json.dumps(report, indent=2, default=str))
+    logger.info(f"wrote the benchmark report to {report_path}")
+    if args.update_baseline:
+        baseline_path.parent.mkdir(parents=True, exist_ok=True)
+        baseline_path.write_text(json.dumps(report, indent=2, default=str))
+        logger.info(f"stored the results as the new baseline in {baseline_path}")
+    return 1 if report['regressions'] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,209 @@
+"""
+Batched writer for posting documents to an Amazon OpenSearch Ingestion (OSI) pipeline endpoint.
+"""
+import json
+import time
+import random
+import logging
+import requests
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+from requests.adapters import HTTPAdapter
+from requests_auth_aws_sigv4 import AWSSigV4
+
+logger = logging.getLogger(__name__)
+
+# status codes for which a batch is retried
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class BulkWriter:
+    """
+    Accumulates documents and posts them to an OSI endpoint as a single JSON list once the batch
+    reaches a document count or byte size threshold, or when the oldest buffered document is older
+    than the flush interval. All batches are sent over one pooled HTTP session and batches that fail
+    with a 429/5xx status code are retried with jittered exponential backoff.
+    """
+
+    def __init__(self,
+                 endpoint: str,
+                 max_batch_documents: int = 100,
+                 max_batch_bytes: int = 5 * 1024 * 1024,
+                 flush_interval_seconds: float = 5.0,
+                 max_retries: int = 5,
+                 base_backoff_seconds: float = 0.5,
+                 pool_maxsize: int = 10,
+                 service: str = 'osis'):
+        """
+        :param endpoint: URL of the OSI pipeline ingest endpoint.
+        :param max_batch_documents: Number of documents after which a batch is sent.
+        :param max_batch_bytes: Size of the serialized documents after which a batch is sent.
+        :param flush_interval_seconds: Maximum time a document is buffered before it is sent.
+        :param max_retries: Number of times a batch is retried on a 429/5xx response or connection error.
+        :param base_backoff_seconds: Backoff before the first retry, doubled on each further retry.
+        :param pool_maxsize: Maximum number of connections kept open to the endpoint.
+        :param service: Service name used to sign the requests with SigV4.
+        """
+        self.endpoint = endpoint
+        self.max_batch_documents = max_batch_documents
+        self.max_batch_bytes = max_batch_bytes
+        self.flush_interval_seconds = flush_interval_seconds
+        self.max_retries = max_retries
+        self.base_backoff_seconds = base_backoff_seconds
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+        self._session.auth = AWSSigV4(service)
+        self._buffer: List[Tuple[str, Optional[Callable[[bool], None]]]] = []
+        self._buffer_bytes: int = 0
+        self._oldest_buffered: Optional[float] = None
+        self._lock = threading.Lock()
+        self.batch_stats: List[Dict] = []
+        self._closed = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+        self._flusher.start()
+
+    def add(self, document: Dict, callback: Optional[Callable[[bool], None]] = None) -> None:
+        """
+        Buffer a document and send the batch if it has reached its count or size threshold.
+        `callback` is called with True once the batch containing the document has been ingested,
+        or with False if the batch failed.
+        """
+        serialized = json.dumps(document, default=str)
+        batch: Optional[List[Tuple]] = None
+        with self._lock:
+            # send the current batch first if this document would take it over the byte limit
+            if self._buffer and self._buffer_bytes + len(serialized) > self.max_batch_bytes:
+                batch = self._take_batch()
+            self._buffer.append((serialized, callback))
+            self._buffer_bytes += len(serialized)
+            if self._oldest_buffered is None:
+                self._oldest_buffered = time.monotonic()
+            if batch is None and len(self._buffer) >= self.max_batch_documents:
+                batch = self._take_batch()
+        if batch:
+            self._send(batch)
+
+    def flush(self) -> None:
+        """
+        Send all buffered documents.
+        """
+        with self._lock:
+            batch = self._take_batch()
+        if batch:
+            self._send(batch)
+
+    def close(self) -> None:
+        """
+        Send all buffered documents and stop the background flush thread.
+        """
+        self._closed.set()
+        self._flusher.join()
+        self.flush()
+        self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _take_batch(self) -> List[Tuple]:
+        batch = self._buffer
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._oldest_buffered = None
+        return batch
+
+    def _flush_periodically(self) -> None:
+        while not self._closed.wait(min(self.flush_interval_seconds, 1.0)):
+            with self._lock:
+                expired = self._oldest_buffered is not None and \
+                          time.monotonic() - self._oldest_buffered >= self.flush_interval_seconds
+                batch = self._take_batch() if expired else None
+            if batch:
+                self._send(batch)
+
+    def _send(self, batch: List[Tuple]) -> None:
+        data = "[" + ",".join(serialized for serialized, _ in batch) + "]"
+        stats = {'documents': len(batch), 'bytes': len(data), 'status_code': None,
+                 'attempts': 0, 'latency_seconds': None, 'failed_documents': 0, 'error': None}
+        st = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            stats['attempts'] = attempt + 1
+            retryable = False
+            try:
+                r = self._session.post(self.endpoint, data=data, headers={'Content-Type': 'application/json'})
+                stats['status_code'] = r.status_code
+                if r.ok:
+                    stats['error'] = None
+                    break
+                stats['error'] = r.text
+                retryable = r.status_code in RETRYABLE_STATUS_CODES
+            except requests.exceptions.RequestException as e:
+                stats['error'] = str(e)
+                retryable = True
+            if not retryable or attempt == self.max_retries:
+                break
+            time.sleep(self.base_backoff_seconds * (2 ** attempt) * random.uniform(0.5, 1.5))
+        stats['latency_seconds'] = time.perf_counter() - st
+        if stats['error'] is not None:
+            stats['failed_documents'] = len(batch)
+            logger.error(f"failed to ingest a batch of {len(batch)} documents into {self.endpoint}, "
+                         f"status={stats['status_code']}, error={stats['error']}")
+        else:
+            logger.info(f"ingested a batch of {len(batch)} documents ({len(data)} bytes) into {self.endpoint} "
+                        f"in {stats['latency_seconds']:.2f}s after {stats['attempts']} attempt(s)")
+        with self._lock:
+            self.batch_stats.append(stats)
+        for _, callback in batch:
+            if callback is not None:
+                try:
+                    callback(stats['error'] is None)
+                except Exception as e:
+                    logger.error(f"error in the callback of an ingested document: {e}")
+
+    def stats(self) -> Dict:
+        """
+        Return the number of batches, documents sent, failed documents and the batch latencies.
+        """
+        with self._lock:
+            latencies = sorted(s['latency_seconds'] for s in self.batch_stats)
+            return {
+                'batches': len(self.batch_stats),
+                'documents': sum(s['documents'] for s in self.batch_stats),
+                'failed_documents': sum(s['failed_documents'] for s in self.batch_stats),
+                'retries': sum(s['attempts'] - 1 for s in self.batch_stats),
+                'mean_batch_latency_seconds': sum(latencies) / len(latencies) if latencies else None,
+                'max_batch_latency_seconds': latencies[-1] if latencies else None,
+            }
+
+
+# one writer per endpoint, shared by every thread in this process
+_bulk_writers: Dict[str, BulkWriter] = {}
+_bulk_writers_lock = threading.Lock()
+
+
+def get_bulk_writer(endpoint: str, **kwargs) -> BulkWriter:
+    """
+    Return the process wide bulk writer for an endpoint, creating it with the given settings on first use.
+    """
+    with _bulk_writers_lock:
+        if endpoint not in _bulk_writers:
+            _bulk_writers[endpoint] = BulkWriter(endpoint, **kwargs)
+        return _bulk_writers[endpoint]
+
+
+def close_bulk_writers() -> Dict[str, Dict]:
+    """
+    Flush and close every shared bulk writer and return the stats of each one.
+    """
+    with _bulk_writers_lock:
+        writers = dict(_bulk_writers)
+        _bulk_writers.clear()
+    all_stats: Dict[str, Dict] = {}
+    for endpoint, writer in writers.items():
+        writer.close()
+        all_stats[endpoint] = writer.stats()
+    return all_stats
@@ -0,0 +1,84 @@
+"""
+Packing of the retrieved hits into the context of a single LLM call. The hits are ranked by their
+retrieval score and added to the prompt until a token budget is reached, each one labelled with a
+source id so that the answer can cite the pages it comes from.
+"""
+import re
+import math
+import logging
+from typing import Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# source ids cited in the answer, for example [S1] or [S1, S3]
+_CITATION_PATTERN = re.compile(r"\[(S\d+(?:\s*,\s*S\d+)*)\]")
+
+
+def estimate_tokens(text: str, chars_per_token: float = 4.0) -> int:
+    """
+    Estimate the number of tokens in a text from its length in characters.
+    """
+    return math.ceil(len(text) / chars_per_token)
+
+
+def pack_contexts(hits: Sequence[Tuple[str, str, str, float]],
+                  token_budget: int,
+                  image_index_name: Optional[str] = None,
+                  max_images: int = 0,
+                  tokens_per_image: int = 1600,
+                  chars_per_token: float = 4.0) -> List[Dict]:
+    """
+    Select the contexts of the highest scoring hits that fit in the token budget. Hits that do not fit are
+    skipped so that smaller, lower ranked hits can still be used, and a hit that is returned by more than
+    one query is only packed once. Up to `max_images` of the selected hits from the image index also have
+    their image sent with the prompt, each one counted as `tokens_per_image` tokens.
+    :param hits: (file path, file text, index name, score) of each hit.
+    :param token_budget: Maximum number of estimated tokens of the packed contexts and images.
+    :return: Packed contexts in score order, each with a `source_id`, the hit fields, its estimated
+             `tokens` and whether its image is sent (`with_image`).
+    """
+    packed: List[Dict] = []
+    seen_paths = set()
+    used_tokens: int = 0
+    n_images: int = 0
+    for file_path, file_text, index_name, score in sorted(hits, key=lambda hit: hit[3] or 0.0, reverse=True):
+        if file_path in seen_paths:
+            continue
+        context_tokens = estimate_tokens(f"[S{len(packed) + 1}] {file_path}\n{file_text}", chars_per_token)
+        if used_tokens + context_tokens > token_budget:
+            logger.info(f"{file_path} ({context_tokens} tokens) does not fit in the remaining budget of {token_budget - used_tokens} tokens")
+            continue
+        with_image = index_name == image_index_name and n_images < max_images and \
+                     used_tokens + context_tokens + tokens_per_image <= token_budget
+        used_tokens += context_tokens + (tokens_per_image if with_image else 0)
+        n_images += int(with_image)
+        seen_paths.add(file_path)
+        packed.append({'source_id': f"S{len(packed) + 1}",
+                       'file_path': file_path,
+                       'file_text': file_text,
+                       'index_name': index_name,
+                       'score': score,
+                       'tokens': context_tokens + (tokens_per_image if with_image else 0),
+                       'with_image': with_image})
+    logger.info(f"packed {len(packed)} of {len(hits)} hits ({n_images} with images) in {used_tokens} of {token_budget} tokens")
+    return packed
+
+
+def format_contexts(packed: Sequence[Dict]) -> str:
+    """
+    Format the packed contexts for the prompt, each one preceded by its source id and file path.
+    """
+    return "\n\n".join(f"[{c['source_id']}] {c['file_path']}\n{c['file_text']}" for c in packed)
+
+
+def cited_sources(answer: Optional[str], packed: Sequence[Dict]) -> List[Dict]:
+    """
+    Return the packed contexts that are cited in the answer, in the order they are first cited.
+    """
+    by_id: Dict[str, Dict] = {c['source_id']: c for c in packed}
+    cited: List[Dict] = []
+    for match in _CITATION_PATTERN.finditer(answer or ""):
+        for source_id in re.split(r"\s*,\s*", match.group(1)):
+            if source_id in by_id and by_id[source_id] not in cited:
+                cited.append(by_id[source_id])
+    return cited
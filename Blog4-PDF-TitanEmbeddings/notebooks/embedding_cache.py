@@ -0,0 +1,153 @@
+"""
+Disk-backed, content-addressed cache for embedding model responses.
+
+Entries are keyed by the model id and a SHA-256 hash of the input text (or image bytes)
+and stored in a SQLite database so that multiple processes (for example Ray workers)
+can safely read and write the same cache file concurrently.
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import logging
+import threading
+from typing import Dict, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+# seconds to wait on a locked database before giving up
+SQLITE_TIMEOUT_SECONDS: int = 30
+
+
+class EmbeddingCache:
+    """
+    Content-addressed embedding cache with LRU eviction on entry count and total size.
+    Hit and miss counters are persisted in the cache file so that they are aggregated
+    across every process that uses the same cache.
+    """
+
+    def __init__(self, cache_path: str, max_entries: Optional[int] = None, max_size_mb: Optional[float] = None):
+        """
+        :param cache_path: Path to the SQLite file that backs the cache.
+        :param max_entries: Maximum number of entries to keep, None for no limit.
+        :param max_size_mb: Maximum total size of the cached values in MB, None for no limit.
+        """
+        self.cache_path = cache_path
+        self.max_entries = max_entries
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024) if max_size_mb else None
+        cache_dir = os.path.dirname(cache_path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(cache_path, timeout=SQLITE_TIMEOUT_SECONDS,
+                                     isolation_level=None, check_same_thread=False)
+        # WAL mode lets readers proceed while another process is writing
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                model_id TEXT NOT NULL,
+                value TEXT NOT NULL,
+                size_bytes INTEGER NOT NULL,
+                last_access REAL NOT NULL
+            )""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON embeddings (last_access)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, count INTEGER NOT NULL)")
+        self._conn.execute("INSERT OR IGNORE INTO stats (name, count) VALUES ('hits', 0), ('misses', 0)")
+
+    @staticmethod
+    def make_key(model_id: str, data: Union[str, bytes]) -> str:
+        """
+        Build the cache key from the model id and a hash of the input text or image bytes.
+        """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        return f"{model_id}:{hashlib.sha256(data).hexdigest()}"
+
+    def get(self, model_id: str, data: Union[str, bytes]) -> Optional[Dict]:
+        """
+        Return the cached model response for the given input, or None on a miss.
+        """
+        key = self.make_key(model_id, data)
+        with self._lock:
+            try:
+                row = self._conn.execute("SELECT value FROM embeddings WHERE key = ?", (key,)).fetchone()
+                counter = 'hits' if row else 'misses'
+                self._conn.execute("BEGIN IMMEDIATE")
+                if row:
+                    self._conn.execute("UPDATE embeddings SET last_access = ? WHERE key = ?", (time.time(), key))
+                self._conn.execute("UPDATE stats SET count = count + 1 WHERE name = ?", (counter,))
+                self._conn.execute("COMMIT")
+            except sqlite3.Error as e:
+                self._rollback()
+                logger.error(f"error reading from the embedding cache {self.cache_path}: {e}")
+                return None
+        return json.loads(row[0]) if row else None
+
+    def put(self, model_id: str, data: Union[str, bytes], value: Dict) -> None:
+        """
+        Store the model response for the given input and evict least recently used entries
+        if the cache is over its configured limits.
+        """
+        key = self.make_key(model_id, data)
+        serialized = json.dumps(value)
+        with self._lock:
+            try:
+                self._conn.execute("BEGIN IMMEDIATE")
+                self._conn.execute("INSERT OR REPLACE INTO embeddings (key, model_id, value, size_bytes, last_access) "
+                                   "VALUES (?, ?, ?, ?, ?)", (key, model_id, serialized, len(serialized), time.time()))
+                self._evict()
+                self._conn.execute("COMMIT")
+            except sqlite3.Error as e:
+                self._rollback()
+                logger.error(f"error writing to the embedding cache {self.cache_path}: {e}")
+
+    def _evict(self) -> None:
+        # evict the least recently used entries until the cache is within its limits
+        entries, size_bytes = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size_bytes), 0) FROM embeddings").fetchone()
+        evicted: int = 0
+        while (self.max_entries is not None and entries > self.max_entries) or \
+              (self.max_size_bytes is not None and size_bytes > self.max_size_bytes):
+            row = self._conn.execute("SELECT key, size_bytes FROM embeddings ORDER BY last_access LIMIT 1").fetchone()
+            if row is None:
+                break
+            self._conn.execute("DELETE FROM embeddings WHERE key = ?", (row[0],))
+            entries -= 1
+            size_bytes -= row[1]
+            evicted += 1
+        if evicted:
+            logger.info(f"evicted {evicted} entries from the embedding cache {self.cache_path}")
+
+    def _rollback(self) -> None:
+        try:
+            self._conn.execute("ROLLBACK")
+        except sqlite3.Error:
+            pass
+
+    def stats(self) -> Dict:
+        """
+        Return the hit/miss counters, hit rate, number of entries and total size of the cache.
+        """
+        with self._lock:
+            counts = dict(self._conn.execute("SELECT name, count FROM stats").fetchall())
+            entries, size_bytes = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size_bytes), 0) FROM embeddings").fetchone()
+        lookups = counts['hits'] + counts['misses']
+        return {
+            'hits': counts['hits'],
+            'misses': counts['misses'],
+            'hit_rate': counts['hits'] / lookups if lookups else 0.0,
+            'entries': entries,
+            'size_bytes': size_bytes,
+        }
+
+    def clear(self) -> None:
+        """
+        Delete every cached entry and reset the hit/miss counters.
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            self._conn.execute("DELETE FROM embeddings")
+            self._conn.execute("UPDATE stats SET count = 0")
+            self._conn.execute("COMMIT")
@@ -0,0 +1,231 @@
+"""
+Named entity extraction from the texts of the pdf pages with NLTK (word_tokenize -> pos_tag -> ne_chunk). The
+part of speech tagger and the named entity chunker are loaded once per process instead of on every call, the
+texts are processed in batches by a pool of processes, and the entities of each text are cached on disk by a
+hash of the text so that unchanged pages are not processed again.
+"""
+import time
+import logging
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+from embedding_cache import EmbeddingCache
+
+logger = logging.getLogger(__name__)
+
+# part of speech tagger and named entity chunker of this process, loaded by load_models
+_tagger: Any = None
+_chunker: Any = None
+
+
+def load_models() -> None:
+    """
+    Load the NLTK part of speech tagger and named entity chunker of this process, if they are not loaded yet.
+    This is the initializer of the worker processes.
+    """
+    global _tagger, _chunker
+    if _tagger is not None:
+        return
+    import nltk
+    from nltk.tag.perceptron import PerceptronTagger
+    _tagger = PerceptronTagger()
+    try:
+        # nltk >= 3.9 builds a new chunker from the maxent_ne_chunker_tab resource on every ne_chunk call
+        from nltk.chunk import ne_chunker
+        _chunker = ne_chunker()
+    except ImportError:
+        from nltk.chunk import _MULTICLASS_NE_CHUNKER
+        _chunker = nltk.data.load(_MULTICLASS_NE_CHUNKER)
+
+
+def get_continuous_chunks(text: str) -> List[str]:
+    """
+    This function uses nltk to get the entities from texts that are extracted from pdf files, with the
+    tagger and chunker of this process
+    """
+    from nltk.tree import Tree
+    from nltk.tokenize import word_tokenize
+    load_models()
+    chunked = _chunker.parse(_tagger.tag(word_tokenize(text)))
+    continuous_chunk = []
+    current_chunk = []
+    for i in chunked:
+        if type(i) == Tree:
+            current_chunk.append(" ".join([token for token, pos in i.leaves()]))
+        if current_chunk:
+            named_entity = " ".join(current_chunk)
+            if named_entity not in continuous_chunk:
+                continuous_chunk.append(named_entity)
+                current_chunk = []
+        else:
+            continue
+    return continuous_chunk
+
+
+def extract_entities_batch(texts: List[str]) -> List[List[str]]:
+    """
+    Return the entities of each text. Runs in a worker process.
+    """
+    return [get_continuous_chunks(text) for text in texts]
+
+
+class EntityExtractor:
+    """
+    Extracts the entities of page texts in batches on a pool of processes, with a cache of the entities of
+    every text that has already been processed. The pool is started on first use.
+    """
+
+    def __init__(self,
+                 max_workers: Optional[int] = None,
+                 batch_size: int = 8,
+                 max_pending_batches: Optional[int] = None,
+                 cache: Optional[EmbeddingCache] = None,
+                 batch_fn: Callable[[List[str]], List[List[str]]] = extract_entities_batch,
+                 initializer: Optional[Callable[[], None]] = load_models):
+        """
+        :param max_workers: Number of worker processes, defaults to the number of CPUs.
+        :param batch_size: Number of texts processed by a worker process in one task.
+        :param max_pending_batches: Maximum number of batches submitted to the pool and not yet returned,
+                                    defaults to twice the number of worker processes.
+        :param cache: Cache of the entities keyed by a hash of the text, None to not cache them.
+        :param batch_fn: Function that returns the entities of each text of a batch, run in the worker processes.
+        :param initializer: Function that loads the models once in each worker process.
+        """
+        self.max_workers = max_workers or multiprocessing.cpu_count()
+        self.batch_size = batch_size
+        self.max_pending_batches = max_pending_batches or 2 * self.max_workers
+        self.cache = cache
+        self.batch_fn = batch_fn
+        self.initializer = initializer
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._model_id: Optional[str] = None
+        self._stats: Dict[str, float] = {'texts': 0, 'cache_hits': 0, 'batches': 0, 'failed_batches': 0, 'wait_seconds': 0.0}
+
+    @property
+    def model_id(self) -> str:
+        # the entities are cached per nltk version, since the models can change between versions
+        if self._model_id is None:
+            import nltk
+            self._model_id = f"nltk_ne_chunk-{nltk.__version__}"
+        return self._model_id
+
+    def _pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # the workers are spawned rather than forked, since they are started while the ingestion
+                # pipeline threads of this process are running
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                     mp_context=multiprocessing.get_context('spawn'),
+                                                     initializer=self.initializer)
+                logger.info(f"started {self.max_workers} entity extraction processes")
+            return self._executor
+
+    def _cached(self, text: str) -> Optional[List[str]]:
+        if self.cache is None:
+            return None
+        value = self.cache.get(self.model_id, text)
+        return value['entities'] if value is not None else None
+
+    def _store(self, text: str, entities: List[str]) -> None:
+        if self.cache is not None:
+            self.cache.put(self.model_id, text, {'entities': entities})
+
+    def _count(self, **counts: float) -> None:
+        with self._lock:
+            for name, count in counts.items():
+                self._stats[name] += count
+
+    def extract(self, text: str) -> List[str]:
+        """
+        Return the entities of a single text, extracted in this process if they are not cached.
+        """
+        entities = self._cached(text)
+        self._count(texts=1, cache_hits=int(entities is not None))
+        if entities is None:
+            entities = get_continuous_chunks(text)
+            self._store(text, entities)
+        return entities
+
+    def _batch_results(self, future: Future, texts: List[str]) -> List[List[str]]:
+        # wait for a batch, and extract it in this process if the worker process failed
+        st = time.perf_counter()
+        try:
+            results = future.result()
+        except Exception as e:
+            logger.error(f"entity extraction of a batch of {len(texts)} texts failed in the process pool, "
+                         f"extracting it in this process: {e}")
+            self._count(failed_batches=1)
+            if isinstance(e, BrokenProcessPool):
+                # a worker process died, start a new pool for the next batches
+                self._discard_pool()
+            results = [get_continuous_chunks(text) for text in texts]
+        self._count(wait_seconds=time.perf_counter() - st)
+        for text, entities in zip(texts, results):
+            self._store(text, entities)
+        return results
+
+    def extract_pages(self, pages: Iterable[Dict], text_key: str = 'text', entities_key: str = 'entities') -> Iterator[Dict]:
+        """
+        Set the entities of each page and yield the page. Pages whose entities are cached are yielded as
+        they are read, the other pages are grouped into batches that are processed by the pool, and are
+        yielded once their batch is done, while the next batches are being processed.
+        :param pages: Dictionaries with the text of each page in `text_key`.
+        :param text_key: Key of the text of a page.
+        :param entities_key: Key under which the list of entities of a page is set.
+        """
+        pending: Deque[Tuple[Future, List[Dict]]] = deque()
+        batch: List[Dict] = []
+
+        def submit(batch: List[Dict]) -> None:
+            pending.append((self._pool().submit(self.batch_fn, [page[text_key] for page in batch]), batch))
+            self._count(batches=1)
+
+        def complete_oldest() -> Iterator[Dict]:
+            future, done_batch = pending.popleft()
+            for page, entities in zip(done_batch, self._batch_results(future, [page[text_key] for page in done_batch])):
+                page[entities_key] = entities
+                yield page
+
+        for page in pages:
+            entities = self._cached(page[text_key])
+            self._count(texts=1, cache_hits=int(entities is not None))
+            if entities is not None:
+                page[entities_key] = entities
+                yield page
+                continue
+            batch.append(page)
+            if len(batch) >= self.batch_size:
+                submit(batch)
+                batch = []
+            # yield the pages of the batches that are done, and wait for the oldest batch if too many are pending
+            while pending and (pending[0][0].done() or len(pending) >= self.max_pending_batches):
+                yield from complete_oldest()
+        if batch:
+            submit(batch)
+        while pending:
+            yield from complete_oldest()
+
+    def stats(self) -> Dict:
+        """
+        Return the number of texts, cache hits, batches and failed batches, and the time spent waiting on the pool.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats['wait_seconds'] = round(stats['wait_seconds'], 3)
+        return stats
+
+    def _discard_pool(self, wait: bool = False) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=wait)
+
+    def close(self) -> None:
+        """
+        Stop the worker processes.
+        """
+        self._discard_pool(wait=True)
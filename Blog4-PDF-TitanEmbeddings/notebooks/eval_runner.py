@@ -0,0 +1,144 @@
+"""
+Runner that answers every question in an evaluation dataset with each retrieval strategy (for example
+the combined, text only and image only indexes) concurrently, and checkpoints every completed result
+to disk so that an interrupted evaluation resumes where it stopped.
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+logger = logging.getLogger(__name__)
+
+
+def question_row_id(question: str) -> str:
+    """
+    Return the id under which the results of a question are checkpointed: a hash of the question text, so
+    that results stay with their question when the rows of the dataset are edited, added or reordered.
+    """
+    return hashlib.sha256(str(question).encode('utf-8')).hexdigest()
+
+
+class EvaluationCheckpoint:
+    """
+    Append only JSON lines file with one record per completed (row, strategy) pair. Each record is
+    flushed to disk as soon as it is written. Records written with a different fingerprint (for example
+    a different dataset, prompt templates or model) are ignored when the checkpoint is loaded.
+    """
+
+    def __init__(self, checkpoint_path: str, fingerprint: str):
+        """
+        :param checkpoint_path: Path to the JSON lines file that backs the checkpoint.
+        :param fingerprint: Fingerprint of the evaluation settings, see `ingestion_manifest.make_fingerprint`.
+        """
+        self.checkpoint_path = checkpoint_path
+        self.fingerprint = fingerprint
+        self._lock = threading.Lock()
+        checkpoint_dir = os.path.dirname(checkpoint_path)
+        if checkpoint_dir:
+            os.makedirs(checkpoint_dir, exist_ok=True)
+
+    def load(self) -> Dict[Tuple[str, str], Dict]:
+        """
+        Return the results recorded with the current fingerprint, keyed by (row id, strategy name).
+        """
+        results: Dict[Tuple[str, str], Dict] = {}
+        if not os.path.exists(self.checkpoint_path):
+            return results
+        with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line is incomplete if the previous run was killed while writing it
+                    logger.warning(f"skipping an incomplete record in the checkpoint {self.checkpoint_path}")
+                    continue
+                if record.get('fingerprint') == self.fingerprint:
+                    results[(record['row_id'], record['strategy'])] = record['result']
+        logger.info(f"loaded {len(results)} completed results from the checkpoint {self.checkpoint_path}")
+        return results
+
+    def append(self, row_id: str, strategy: str, result: Dict) -> None:
+        """
+        Record the result of a strategy for a row.
+        """
+        line = json.dumps({'row_id': row_id,
+                           'strategy': strategy,
+                           'fingerprint': self.fingerprint,
+                           'completed_at': time.time(),
+                           'result': result}, default=str)
+        with self._lock:
+            with open(self.checkpoint_path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+    def clear(self) -> None:
+        """
+        Delete the checkpoint file.
+        """
+        with self._lock:
+            if os.path.exists(self.checkpoint_path):
+                os.remove(self.checkpoint_path)
+
+
+def run_evaluation(questions: Iterable[Tuple[Any, str]],
+                   strategies: Dict[str, Callable[[str], Optional[Dict]]],
+                   checkpoint: EvaluationCheckpoint,
+                   max_concurrency: int = 8,
+                   progress_every: int = 50) -> Dict[str, Dict[str, Dict]]:
+    """
+    Answer every question with every strategy, running up to `max_concurrency` calls at the same time
+    across all the questions and strategies. Results that are already in the checkpoint are not computed
+    again, and each new result is written to the checkpoint as soon as it completes. Failed calls (that
+    raise or return None) are not checkpointed, so they are retried when the evaluation is run again.
+    :param questions: (row id, question) pairs, see `question_row_id`. Row ids are stored as strings in the checkpoint.
+    :param strategies: Strategy name to the function that answers a question with that strategy.
+    :param checkpoint: Checkpoint that the results are read from and written to.
+    :param max_concurrency: Maximum number of strategy calls in flight.
+    :param progress_every: Log the progress after this many calls complete.
+    :return: Results keyed by row id and strategy name, for every call that succeeded.
+    """
+    completed = checkpoint.load()
+    results: Dict[str, Dict[str, Dict]] = {}
+    for (row_id, strategy), result in completed.items():
+        results.setdefault(row_id, {})[strategy] = result
+    # rows with the same id (such as the same question asked twice) are only answered once
+    pending_questions: Dict[str, str] = {}
+    for row_id, question in questions:
+        pending_questions.setdefault(str(row_id), question)
+    tasks = [(row_id, question, strategy)
+             for row_id, question in pending_questions.items()
+             for strategy in strategies
+             if (row_id, strategy) not in completed]
+    logger.info(f"{len(completed)} results restored from the checkpoint, {len(tasks)} calls to run "
+                f"with max_concurrency={max_concurrency}")
+    if not tasks:
+        return results
+    n_done: int = 0
+    n_failed: int = 0
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        futures = {executor.submit(strategies[strategy], question): (row_id, strategy)
+                   for row_id, question, strategy in tasks}
+        for future in as_completed(futures):
+            row_id, strategy = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error(f"row={row_id}, strategy={strategy} failed: {e}")
+                result = None
+            if result is None:
+                n_failed += 1
+            else:
+                checkpoint.append(row_id, strategy, result)
+                results.setdefault(row_id, {})[strategy] = result
+            n_done += 1
+            if n_done % progress_every == 0 or n_done == len(tasks):
+                elapsed = time.perf_counter() - start_time
+                logger.info(f"completed {n_done}/{len(tasks)} calls ({n_failed} failed) in {elapsed:.1f}s")
+    return results
@@ -2,8 +2,6 @@
 Global variables used throughout the code.
 """
 import os
-import boto3
-import sagemaker
 from typing import List
 
 BUCKET_PREFIX: str = "multimodal"
@@ -35,7 +33,6 @@ LOCAL_TEXT_DIR: str = f"{BUCKET_PREFIX}/local_txts"
 TEXT_DIR: str = "text"
 IMAGE_FILE_EXTN: str = ".jpg"
 TEXT_FILE_EXTN: str = ".txt"
-B64_ENCODED_IMAGES_DIR: str = os.path.join(IMAGE_DIR, "b64_images")
 
 # Qualitative metrics on the following list
 QUALITATIVE_METRICS_LIST: List[str] = ['combined_response', 'text_response', 'img_response']
@@ -0,0 +1,258 @@
+"""
+Local cache for the images that are retrieved from S3 during inference. Images are keyed by their
+S3 URI and ETag, downloaded over one pooled S3 client, and can be prefetched concurrently as soon as
+the search results are known, so that displaying an image and sending it to the multimodal model do
+not each pay for a download.
+"""
+import os
+import json
+import time
+import boto3
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from collections import OrderedDict
+from urllib.parse import urlparse
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from typing import Dict, Iterable, Optional, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# name of the file in the cache directory that maps the S3 URIs to the cached files
+INDEX_FILE_NAME: str = "index.json"
+
+
+def parse_s3_uri(s3_uri: str) -> Tuple[str, str]:
+    """
+    Split an s3://bucket/key URI into the bucket and the key.
+    """
+    parsed = urlparse(s3_uri)
+    if parsed.scheme != 's3' or not parsed.netloc:
+        raise ValueError(f"{s3_uri} is not an s3:// URI")
+    return parsed.netloc, parsed.path.lstrip('/')
+
+
+class S3ImageCache:
+    """
+    Disk cache of S3 objects with LRU eviction on the total size of the cached files, and an in memory
+    LRU of the most recently used object bytes. A cached object is re-validated against its ETag with a
+    conditional request once it is older than `revalidate_after_seconds`, and downloaded again only if it
+    changed in S3. Objects that are in memory are served without being re-validated. Concurrent requests
+    for the same object share one download.
+    """
+
+    def __init__(self,
+                 cache_dir: str,
+                 max_size_mb: float = 512,
+                 max_memory_mb: float = 64,
+                 max_workers: int = 16,
+                 revalidate_after_seconds: Optional[float] = 300,
+                 s3_client=None):
+        """
+        :param cache_dir: Directory in which the downloaded objects are stored.
+        :param max_size_mb: Maximum total size of the files in the cache directory.
+        :param max_memory_mb: Maximum total size of the object bytes kept in memory.
+        :param max_workers: Number of concurrent downloads, and connections in the S3 client pool.
+        :param revalidate_after_seconds: Age after which a cached object is checked against S3, None to never check.
+        :param s3_client: S3 client to use, a pooled boto3 client is created if not given.
+        """
+        self.cache_dir = cache_dir
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self.max_memory_bytes = int(max_memory_mb * 1024 * 1024)
+        self.revalidate_after_seconds = revalidate_after_seconds
+        self._s3 = s3_client if s3_client is not None else \
+                   boto3.client('s3', config=Config(max_pool_connections=max_workers, retries={'mode': 'standard'}))
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='image-cache')
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, Future] = {}
+        self._memory: OrderedDict = OrderedDict()
+        self._memory_bytes: int = 0
+        self._counts: Dict[str, int] = {'memory_hits': 0, 'disk_hits': 0, 'revalidated': 0, 'downloads': 0,
+                                        'downloaded_bytes': 0, 'evicted': 0}
+        os.makedirs(cache_dir, exist_ok=True)
+        self._index_path = os.path.join(cache_dir, INDEX_FILE_NAME)
+        # S3 URI -> {'file_name', 'etag', 'size', 'validated_at', 'last_access'}, in least recently used order
+        self._index: OrderedDict = OrderedDict()
+        if os.path.exists(self._index_path):
+            with open(self._index_path, 'r') as f:
+                entries: Dict = json.load(f)
+            for s3_uri, entry in sorted(entries.items(), key=lambda item: item[1]['last_access']):
+                if os.path.exists(os.path.join(cache_dir, entry['file_name'])):
+                    self._index[s3_uri] = entry
+            logger.info(f"loaded {len(self._index)} cached images from {cache_dir}")
+
+    def _save_index(self) -> None:
+        # written atomically so that an interrupted write does not lose the index
+        tmp_path = f"{self._index_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(dict(self._index), f)
+        os.replace(tmp_path, self._index_path)
+
+    def _remember(self, s3_uri: str, data: bytes) -> None:
+        if len(data) > self.max_memory_bytes:
+            return
+        if s3_uri in self._memory:
+            self._memory_bytes -= len(self._memory.pop(s3_uri))
+        self._memory[s3_uri] = data
+        self._memory_bytes += len(data)
+        while self._memory_bytes > self.max_memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_bytes -= len(evicted)
+
+    def _evict(self) -> None:
+        total_bytes = sum(entry['size'] for entry in self._index.values())
+        while total_bytes > self.max_size_bytes and len(self._index) > 1:
+            s3_uri, entry = self._index.popitem(last=False)
+            self._memory_bytes -= len(self._memory.pop(s3_uri, b''))
+            try:
+                os.remove(os.path.join(self.cache_dir, entry['file_name']))
+            except FileNotFoundError:
+                pass
+            total_bytes -= entry['size']
+            self._counts['evicted'] += 1
+
+    def _fetch(self, s3_uri: str) -> bytes:
+        # download the object, or only validate the cached copy if it is old enough to be checked
+        bucket, key = parse_s3_uri(s3_uri)
+        with self._lock:
+            entry = dict(self._index[s3_uri]) if s3_uri in self._index else None
+        if entry is not None:
+            cached_path = os.path.join(self.cache_dir, entry['file_name'])
+            is_fresh = self.revalidate_after_seconds is None or \
+                       time.time() - entry['validated_at'] < self.revalidate_after_seconds
+            if is_fresh:
+                try:
+                    data = Path(cached_path).read_bytes()
+                except FileNotFoundError:
+                    # the file was evicted after the index lookup, so the object is downloaded again
+                    entry = None
+                else:
+                    with self._lock:
+                        self._counts['disk_hits'] += 1
+                        self._touch(s3_uri, data)
+                    return data
+        try:
+            kwargs = {'IfNoneMatch': entry['etag']} if entry is not None else {}
+            response = self._s3.get_object(Bucket=bucket, Key=key, **kwargs)
+        except ClientError as e:
+            # 304 means that the cached copy is still the current version of the object
+            if entry is not None and e.response.get('Error', {}).get('Code') in ('304', 'NotModified'):
+                try:
+                    data = Path(os.path.join(self.cache_dir, entry['file_name'])).read_bytes()
+                except FileNotFoundError:
+                    # the file was evicted while it was re-validated, so the object is downloaded again
+                    response = self._s3.get_object(Bucket=bucket, Key=key)
+                    return self._store(s3_uri, key, response)
+                with self._lock:
+                    self._counts['revalidated'] += 1
+                    if s3_uri in self._index:
+                        self._index[s3_uri]['validated_at'] = time.time()
+                    self._touch(s3_uri, data)
+                return data
+            raise
+        return self._store(s3_uri, key, response)
+
+    def _store(self, s3_uri: str, key: str, response: Dict) -> bytes:
+        # write the downloaded object to the cache directory and add it to the index
+        data: bytes = response['Body'].read()
+        etag: str = response.get('ETag', '').strip('"')
+        file_name = hashlib.sha256(f"{s3_uri}:{etag}".encode('utf-8')).hexdigest() + Path(key).suffix
+        tmp_path = os.path.join(self.cache_dir, f"{file_name}.{threading.get_ident()}.tmp")
+        Path(tmp_path).write_bytes(data)
+        os.replace(tmp_path, os.path.join(self.cache_dir, file_name))
+        with self._lock:
+            previous = self._index.pop(s3_uri, None)
+            if previous is not None and previous['file_name'] != file_name:
+                try:
+                    os.remove(os.path.join(self.cache_dir, previous['file_name']))
+                except FileNotFoundError:
+                    pass
+            now = time.time()
+            self._index[s3_uri] = {'file_name': file_name, 'etag': etag, 'size': len(data),
+                                   'validated_at': now, 'last_access': now}
+            self._counts['downloads'] += 1
+            self._counts['downloaded_bytes'] += len(data)
+            self._remember(s3_uri, data)
+            self._evict()
+            self._save_index()
+        logger.info(f"downloaded {s3_uri} ({len(data)} bytes) into the image cache")
+        return data
+
+    def _touch(self, s3_uri: str, data: bytes) -> None:
+        # mark the entry as most recently used, the caller holds the lock
+        if s3_uri in self._index:
+            self._index.move_to_end(s3_uri)
+            self._index[s3_uri]['last_access'] = time.time()
+        self._remember(s3_uri, data)
+
+    def _submit(self, s3_uri: str) -> Future:
+        # return the in flight request for the object, or start one. An invalid URI raises a ValueError here
+        parse_s3_uri(s3_uri)
+        with self._lock:
+            future = self._inflight.get(s3_uri)
+            if future is not None:
+                return future
+            future = self._executor.submit(self._fetch, s3_uri)
+            self._inflight[s3_uri] = future
+        # registered without the lock held: the callback runs in this thread if the request has already finished,
+        # and _forget takes the lock
+        future.add_done_callback(lambda _: self._forget(s3_uri, future))
+        return future
+
+    def _forget(self, s3_uri: str, future: Future) -> None:
+        with self._lock:
+            if self._inflight.get(s3_uri) is future:
+                del self._inflight[s3_uri]
+
+    def prefetch(self, s3_uris: Iterable[str]) -> None:
+        """
+        Start downloading the objects that are not in memory, without waiting for them.
+        """
+        for s3_uri in dict.fromkeys(s3_uris):
+            with self._lock:
+                in_memory = s3_uri in self._memory
+            if not in_memory:
+                try:
+                    self._submit(s3_uri)
+                except ValueError as e:
+                    logger.error(f"cannot prefetch {s3_uri}: {e}")
+
+    def get_bytes(self, s3_uri: str) -> bytes:
+        """
+        Return the contents of an object, from memory, from the disk cache or downloaded from S3. Waits for
+        the download if the object is being prefetched. Raises a ValueError if `s3_uri` is not an s3:// URI.
+        """
+        with self._lock:
+            data = self._memory.get(s3_uri)
+            if data is not None:
+                self._memory.move_to_end(s3_uri)
+                self._counts['memory_hits'] += 1
+                return data
+        return self._submit(s3_uri).result()
+
+    def get_path(self, s3_uri: str) -> str:
+        """
+        Return the path of the cached copy of an object, downloading it if needed.
+        """
+        self.get_bytes(s3_uri)
+        with self._lock:
+            return os.path.join(self.cache_dir, self._index[s3_uri]['file_name'])
+
+    def stats(self) -> Dict:
+        """
+        Return the hit and download counters, and the number and total size of the cached files.
+        """
+        with self._lock:
+            return {**self._counts,
+                    'entries': len(self._index),
+                    'size_bytes': sum(entry['size'] for entry in self._index.values()),
+                    'memory_bytes': self._memory_bytes}
+
+    def close(self) -> None:
+        """
+        Wait for the downloads in flight and stop the download threads.
+        """
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,90 @@
+"""
+In memory payload for the images that are sent to the multimodal and embedding models. The image
+is base64 encoded lazily from the source file the first time it is needed and the encoding is
+shared by every model call made for that image, so no base64 copy of the image is written to disk.
+"""
+import os
+import mmap
+import base64
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# images larger than this are memory mapped instead of read into memory before they are encoded
+MMAP_THRESHOLD_BYTES: int = 4 * 1024 * 1024
+
+# media types of the image file extensions supported by the models
+MEDIA_TYPES: Dict[str, str] = {
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.png': 'image/png',
+    '.gif': 'image/gif',
+    '.webp': 'image/webp',
+}
+
+
+def encode_file_to_base64(file_path: str, mmap_threshold_bytes: int = MMAP_THRESHOLD_BYTES) -> str:
+    """
+    Base64 encode the contents of a file in memory. Files larger than `mmap_threshold_bytes`
+    are encoded from a read only memory map of the file.
+    """
+    with open(file_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size > mmap_threshold_bytes:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return base64.b64encode(mm).decode('utf-8')
+        return base64.b64encode(f.read()).decode('utf-8')
+
+
+class ImagePayload:
+    """
+    Image file whose base64 encoding is computed on first access and cached until it is released.
+    One payload is created per image and passed to every model call for that image, for example
+    the entity extraction, description and embedding calls for a pdf page. If the image bytes are
+    already in memory, for example from the S3 image cache, they are encoded instead of the file.
+    """
+
+    def __init__(self, file_path: str, mmap_threshold_bytes: int = MMAP_THRESHOLD_BYTES, data: Optional[bytes] = None):
+        """
+        :param file_path: Path to the source image file, or its S3 URI if `data` is given.
+        :param mmap_threshold_bytes: Size above which the file is memory mapped while it is encoded.
+        :param data: Contents of the image, if they are already in memory.
+        """
+        self.file_path = file_path
+        self.mmap_threshold_bytes = mmap_threshold_bytes
+        self.data = data
+        self._b64: Optional[str] = None
+        self._lock = threading.Lock()
+
+    @property
+    def media_type(self) -> str:
+        """
+        Media type of the image, based on the extension of the source file.
+        """
+        return MEDIA_TYPES.get(Path(self.file_path).suffix.lower(), 'image/jpeg')
+
+    @property
+    def b64(self) -> str:
+        """
+        Base64 encoding of the image, encoded from the image bytes or the source file on first access.
+        """
+        with self._lock:
+            if self._b64 is None:
+                if self.data is not None:
+                    self._b64 = base64.b64encode(self.data).decode('utf-8')
+                else:
+                    self._b64 = encode_file_to_base64(self.file_path, self.mmap_threshold_bytes)
+                logger.debug(f"encoded {self.file_path} to base64, {len(self._b64)} characters")
+            return self._b64
+
+    def release(self) -> None:
+        """
+        Drop the cached encoding, it is encoded again if it is accessed later.
+        """
+        with self._lock:
+            self._b64 = None
+
+    def __repr__(self) -> str:
+        return f"ImagePayload(file_path={self.file_path!r}, encoded={self._b64 is not None})"
@@ -0,0 +1,139 @@
+"""
+Manifest that records a content hash and the processing status of every file that goes through
+the data preparation and ingestion steps, so that re-runs only process new or changed files and
+interrupted runs resume where they stopped.
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# status of each file recorded in the manifest
+STATUS_DONE: str = "done"
+STATUS_PENDING: str = "pending"
+STATUS_FAILED: str = "failed"
+
+# size of the blocks read while hashing a file
+_HASH_BLOCK_SIZE: int = 1024 * 1024
+
+
+def hash_file(file_path: str) -> str:
+    """
+    Return the SHA-256 hash of the contents of a file.
+    """
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(_HASH_BLOCK_SIZE), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def make_fingerprint(**parts: Any) -> str:
+    """
+    Return a hash of the settings that affect the output of a step, such as the prompt templates
+    and model ids. Files are re-processed when the fingerprint of the step changes.
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class IngestionManifest:
+    """
+    Thread safe manifest stored as a JSON file. Each entry is keyed by a file name and holds the
+    content hash of the file, the fingerprint of the step that processed it and its status. The
+    manifest is written to disk atomically after every update.
+    """
+
+    def __init__(self, manifest_path: str, fingerprint: str):
+        """
+        :param manifest_path: Path to the JSON file that backs the manifest.
+        :param fingerprint: Fingerprint of the current step settings, see `make_fingerprint`.
+        """
+        self.manifest_path = manifest_path
+        self.fingerprint = fingerprint
+        self._lock = threading.Lock()
+        self._entries: Dict[str, Dict] = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path, 'r') as f:
+                self._entries = json.load(f)
+            logger.info(f"loaded {len(self._entries)} entries from the manifest {manifest_path}")
+
+    def needs_processing(self, key: str, content_hash: str) -> bool:
+        """
+        Return True if the file is new, has changed, was processed with different settings or did
+        not complete successfully in a previous run.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+        return entry is None or \
+               entry['content_hash'] != content_hash or \
+               entry['fingerprint'] != self.fingerprint or \
+               entry['status'] != STATUS_DONE
+
+    def filter_pending(self, file_paths: Iterable[str], key_fn: Callable[[str], str] = os.path.basename) -> List[str]:
+        """
+        Return the files that need to be processed and mark them as pending. Files are keyed by
+        their file name unless a different `key_fn` is given.
+        """
+        pending: List[str] = []
+        for file_path in file_paths:
+            key = key_fn(file_path)
+            content_hash = hash_file(file_path)
+            if self.needs_processing(key, content_hash):
+                pending.append(file_path)
+                self.mark(key, content_hash, STATUS_PENDING, save=False)
+        self.save()
+        logger.info(f"{len(pending)} of the files need to be processed, the rest are unchanged since the last run")
+        return pending
+
+    def mark(self, key: str, content_hash: Optional[str] = None, status: str = STATUS_DONE, save: bool = True, **extra: Any) -> None:
+        """
+        Record the status of a file. The content hash of an existing entry is kept if none is given.
+        """
+        with self._lock:
+            entry = self._entries.get(key, {})
+            if content_hash is None:
+                content_hash = entry.get('content_hash')
+            entry.update(extra)
+            entry.update({'content_hash': content_hash,
+                          'fingerprint': self.fingerprint,
+                          'status': status,
+                          'updated_at': time.time()})
+            self._entries[key] = entry
+        if save:
+            self.save()
+
+    def get(self, key: str) -> Optional[Dict]:
+        """
+        Return the manifest entry for a file, or None if the file has never been processed.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            return dict(entry) if entry else None
+
+    def save(self) -> None:
+        """
+        Write the manifest to disk, replacing the previous version atomically.
+        """
+        with self._lock:
+            manifest_dir = os.path.dirname(self.manifest_path)
+            if manifest_dir:
+                os.makedirs(manifest_dir, exist_ok=True)
+            tmp_path = f"{self.manifest_path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(self._entries, f, indent=2)
+            os.replace(tmp_path, self.manifest_path)
+
+    def summary(self) -> Dict[str, int]:
+        """
+        Return the number of entries for each status.
+        """
+        with self._lock:
+            counts: Dict[str, int] = {}
+            for entry in self._entries.values():
+                counts[entry['status']] = counts.get(entry['status'], 0) + 1
+            return counts
@@ -0,0 +1,148 @@
+"""
+Streaming pipeline with bounded queues between stages, used to overlap the loading, describing,
+embedding and indexing of pdf pages during data ingestion.
+"""
+import time
+import queue
+import logging
+import threading
+from typing import Any, Callable, Dict, Iterable, Iterator, List
+
+logger = logging.getLogger(__name__)
+
+# marks the end of the stream in a stage's input queue
+_END_OF_STREAM = object()
+# seconds to wait on a full or empty queue before checking if the pipeline was stopped
+_QUEUE_POLL_SECONDS: float = 0.1
+
+
+class PipelineStage:
+    """
+    A single stage of the streaming pipeline. `fn` is called with one item at a time by `workers`
+    threads. It returns the item passed to the next stage, or None to drop the item.
+    """
+
+    def __init__(self, name: str, fn: Callable[[Any], Any], workers: int = 1):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+
+
+class StreamingPipeline:
+    """
+    Runs items through a list of stages connected by bounded queues. Every stage runs on its own
+    pool of worker threads, so a slow item only holds up the worker that is processing it and the
+    throughput of the pipeline is limited by its slowest stage. Items that raise an exception in a
+    stage are logged and dropped.
+    """
+
+    def __init__(self, stages: List[PipelineStage], queue_size: int = 16):
+        """
+        :param stages: Stages to run, in order.
+        :param queue_size: Maximum number of items waiting between two stages.
+        """
+        self.stages = stages
+        self.queue_size = queue_size
+        self._stats: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def _put(self, q: queue.Queue, item: Any) -> bool:
+        # block until there is room in the queue, unless the pipeline is being stopped
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=_QUEUE_POLL_SECONDS)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _get(self, q: queue.Queue) -> Any:
+        while not self._stop.is_set():
+            try:
+                return q.get(timeout=_QUEUE_POLL_SECONDS)
+            except queue.Empty:
+                continue
+        return _END_OF_STREAM
+
+    def _feed(self, items: Iterable, first_queue: queue.Queue) -> None:
+        try:
+            for item in items:
+                if not self._put(first_queue, item):
+                    return
+        except Exception as e:
+            logger.error(f"error reading the pipeline input: {e}")
+        for _ in range(self.stages[0].workers):
+            self._put(first_queue, _END_OF_STREAM)
+
+    def _work(self, stage_index: int, in_queue: queue.Queue, out_queue: queue.Queue, remaining_workers: List[int]) -> None:
+        stage = self.stages[stage_index]
+        stats = self._stats[stage.name]
+        while True:
+            item = self._get(in_queue)
+            if item is _END_OF_STREAM:
+                break
+            st = time.perf_counter()
+            try:
+                result = stage.fn(item)
+            except Exception as e:
+                logger.error(f"error in pipeline stage={stage.name}: {e}")
+                result = None
+                with self._lock:
+                    stats['errors'] += 1
+            with self._lock:
+                stats['processed'] += 1
+                stats['busy_seconds'] += time.perf_counter() - st
+            if result is not None:
+                if not self._put(out_queue, result):
+                    break
+            else:
+                with self._lock:
+                    stats['dropped'] += 1
+        # the last worker of this stage to finish signals the end of the stream to the next stage
+        with self._lock:
+            remaining_workers[0] -= 1
+            is_last_worker = remaining_workers[0] == 0
+        if is_last_worker:
+            next_workers = self.stages[stage_index + 1].workers if stage_index + 1 < len(self.stages) else 1
+            for _ in range(next_workers):
+                self._put(out_queue, _END_OF_STREAM)
+
+    def run(self, items: Iterable) -> Iterator[Any]:
+        """
+        Stream the items through every stage and yield the output of the last stage as soon as
+        each item completes. Outputs are yielded in completion order, not input order.
+        """
+        self._stop.clear()
+        self._stats = {stage.name: {'workers': stage.workers, 'processed': 0, 'dropped': 0, 'errors': 0, 'busy_seconds': 0.0}
+                       for stage in self.stages}
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self._feed, args=(items, queues[0]), daemon=True)]
+        for stage_index, stage in enumerate(self.stages):
+            remaining_workers = [stage.workers]
+            for worker in range(stage.workers):
+                threads.append(threading.Thread(target=self._work,
+                                                args=(stage_index, queues[stage_index], queues[stage_index + 1], remaining_workers),
+                                                name=f"{stage.name}-{worker}", daemon=True))
+        for t in threads:
+            t.start()
+        st = time.perf_counter()
+        completed: int = 0
+        try:
+            while True:
+                item = self._get(queues[-1])
+                if item is _END_OF_STREAM:
+                    break
+                completed += 1
+                yield item
+        finally:
+            self._stop.set()
+            elapsed_time = time.perf_counter() - st
+            logger.info(f"pipeline completed {completed} items in {elapsed_time:.2f}s, stats={self.stats()}")
+
+    def stats(self) -> Dict[str, Dict]:
+        """
+        Return the number of processed, dropped and failed items and the busy time for every stage.
+        """
+        with self._lock:
+            return {name: dict(stage_stats) for name, stage_stats in self._stats.items()}
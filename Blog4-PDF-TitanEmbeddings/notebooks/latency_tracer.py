@@ -0,0 +1,243 @@
+"""
+Span based latency tracing for the RAG query path. Every stage of a query (entity extraction, embedding,
+each knn search, image fetch, each hit level LLM call and the final LLM call) is recorded as a span that
+carries its duration, its parent span and attributes such as token counts and costs. Spans are aggregated
+into p50/p95/p99 latencies per stage and exported to JSON and CSV, and optionally to OpenTelemetry.
+"""
+import csv
+import json
+import time
+import uuid
+import logging
+import threading
+import contextvars
+import numpy as np
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+logger = logging.getLogger(__name__)
+
+# percentiles reported for the latency of each stage
+PERCENTILES: Sequence[int] = (50, 95, 99)
+
+# numeric span attributes that are summed per stage in the summary
+SUMMED_ATTRIBUTES: Sequence[str] = ('input_tokens', 'output_tokens', 'input_token_cost', 'output_token_cost')
+
+# upper bounds (in ms) of the latency histogram buckets of each stage, the last bucket has no upper bound
+HISTOGRAM_BUCKETS_MS: Sequence[float] = (10, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+# span that is active in the current thread, new spans become its children
+_current_span: contextvars.ContextVar = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    """
+    A timed stage of a query. The root span of a query has no parent, and every span in the same query
+    shares the trace id of the root span.
+    """
+
+    def __init__(self, stage: str, parent: Optional['Span'], attributes: Dict[str, Any]):
+        self.stage = stage
+        self.span_id: str = uuid.uuid4().hex[:16]
+        self.trace_id: str = parent.trace_id if parent is not None else uuid.uuid4().hex
+        self.parent_id: Optional[str] = parent.span_id if parent is not None else None
+        self.attributes: Dict[str, Any] = dict(attributes)
+        self.start_time: float = time.time()
+        self.duration_ms: Optional[float] = None
+        self._start: float = time.perf_counter()
+        self._otel_span = None
+
+    def set_attributes(self, **attributes: Any) -> None:
+        """
+        Add attributes, such as token counts and costs, to the span.
+        """
+        self.attributes.update(attributes)
+
+    def end(self) -> None:
+        self.duration_ms = (time.perf_counter() - self._start) * 1000
+
+    def to_dict(self) -> Dict:
+        return {'trace_id': self.trace_id,
+                'span_id': self.span_id,
+                'parent_id': self.parent_id,
+                'stage': self.stage,
+                'start_time': self.start_time,
+                'duration_ms': self.duration_ms,
+                'attributes': self.attributes}
+
+
+class LatencyTracer:
+    """
+    Thread safe recorder of the spans of every query. The most recent `max_spans` spans are kept in memory.
+    Spans started in a thread pool are parented to the span that was active when the task was submitted if
+    the task is wrapped with `wrap`.
+    """
+
+    def __init__(self, enabled: bool = True, max_spans: int = 100000, otel_enabled: bool = False):
+        """
+        :param enabled: Record spans. When disabled the spans are still timed, but they are not kept.
+        :param max_spans: Maximum number of spans kept in memory, the oldest spans are dropped first.
+        :param otel_enabled: Also export every span to the OpenTelemetry tracer provider, if opentelemetry is installed.
+        """
+        self.enabled = enabled
+        self._spans: deque = deque(maxlen=max_spans)
+        self._lock = threading.Lock()
+        self._otel_tracer = None
+        if otel_enabled:
+            if otel_trace is None:
+                logger.warning("opentelemetry is not installed, spans are not exported to OpenTelemetry")
+            else:
+                self._otel_tracer = otel_trace.get_tracer(__name__)
+
+    @contextmanager
+    def span(self, stage: str, **attributes: Any) -> Iterator[Span]:
+        """
+        Time the code in the `with` block as a span of the given stage, as a child of the active span.
+        The span records the exception if the block raises.
+        """
+        parent: Optional[Span] = _current_span.get()
+        span = Span(stage, parent, attributes)
+        if self.enabled and self._otel_tracer is not None:
+            otel_context = otel_trace.set_span_in_context(parent._otel_span) \
+                           if parent is not None and parent._otel_span is not None else None
+            span._otel_span = self._otel_tracer.start_span(stage, context=otel_context)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except Exception as e:
+            span.set_attributes(error=repr(e))
+            raise
+        finally:
+            span.end()
+            _current_span.reset(token)
+            if self.enabled:
+                self._record(span)
+
+    def wrap(self, fn: Callable) -> Callable:
+        """
+        Return a function that runs `fn` with the span that is active now as its parent span. Use it to
+        submit work to a thread pool so the spans of the worker threads are part of the same trace.
+        """
+        parent: Optional[Span] = _current_span.get()
+
+        def run_with_parent(*args, **kwargs):
+            token = _current_span.set(parent)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                _current_span.reset(token)
+        return run_with_parent
+
+    def _record(self, span: Span) -> None:
+        with self._lock:
+            self._spans.append(span)
+        if span._otel_span is not None:
+            # OpenTelemetry only accepts primitive attribute values
+            span._otel_span.set_attributes({k: v for k, v in span.attributes.items()
+                                            if isinstance(v, (str, bool, int, float))})
+            span._otel_span.end()
+
+    def spans(self, stage: Optional[str] = None) -> List[Span]:
+        """
+        Return the recorded spans, optionally only those of one stage.
+        """
+        with self._lock:
+            spans = list(self._spans)
+        return [s for s in spans if stage is None or s.stage == stage]
+
+    def summary(self) -> Dict[str, Dict]:
+        """
+        Aggregate the spans of each stage into the number of spans and errors, the mean, max and
+        p50/p95/p99 latencies in ms, a latency histogram and the sum of the token and cost attributes.
+        """
+        by_stage: Dict[str, List[Span]] = {}
+        for span in self.spans():
+            by_stage.setdefault(span.stage, []).append(span)
+        summary: Dict[str, Dict] = {}
+        for stage, spans in by_stage.items():
+            durations = np.array([s.duration_ms for s in spans])
+            stage_summary: Dict[str, Any] = {'count': len(spans),
+                                             'errors': sum(1 for s in spans if 'error' in s.attributes),
+                                             'mean_ms': round(float(durations.mean()), 2),
+                                             'max_ms': round(float(durations.max()), 2)}
+            for p, value in zip(PERCENTILES, np.percentile(durations, PERCENTILES)):
+                stage_summary[f'p{p}_ms'] = round(float(value), 2)
+            bucket_counts = np.bincount(np.searchsorted(HISTOGRAM_BUCKETS_MS, durations),
+                                        minlength=len(HISTOGRAM_BUCKETS_MS) + 1)
+            bucket_names = [f'le_{b}ms' for b in HISTOGRAM_BUCKETS_MS] + [f'gt_{HISTOGRAM_BUCKETS_MS[-1]}ms']
+            stage_summary['histogram'] = dict(zip(bucket_names, bucket_counts.tolist()))
+            for attribute in SUMMED_ATTRIBUTES:
+                values = [s.attributes[attribute] for s in spans if isinstance(s.attributes.get(attribute), (int, float))]
+                if values:
+                    stage_summary[f'total_{attribute}'] = sum(values)
+            summary[stage] = stage_summary
+        return summary
+
+    def format_trace(self, trace_id: str) -> str:
+        """
+        Return the spans of one query as an indented tree, in start order, to see where its time was spent.
+        """
+        spans = sorted([s for s in self.spans() if s.trace_id == trace_id], key=lambda s: s.start_time)
+        children: Dict[Optional[str], List[Span]] = {}
+        for span in spans:
+            children.setdefault(span.parent_id, []).append(span)
+        span_ids = {s.span_id for s in spans}
+        lines: List[str] = []
+
+        def add(span: Span, depth: int) -> None:
+            lines.append(f"{'  ' * depth}{span.stage}: {span.duration_ms:.1f}ms {span.attributes}")
+            for child in children.get(span.span_id, []):
+                add(child, depth + 1)
+        # spans whose parent was dropped from memory are shown at the top level
+        for span in spans:
+            if span.parent_id is None or span.parent_id not in span_ids:
+                add(span, 0)
+        return "\n".join(lines)
+
+    def slowest_traces(self, root_stage: str, n: int = 5) -> List[str]:
+        """
+        Return the trace ids of the `n` slowest spans of the given root stage, slowest first.
+        """
+        return [s.trace_id for s in sorted(self.spans(root_stage), key=lambda s: s.duration_ms, reverse=True)[:n]]
+
+    def export_json(self, file_path: str) -> None:
+        """
+        Write the per stage summary and every span to a JSON file.
+        """
+        with open(file_path, 'w') as f:
+            json.dump({'summary': self.summary(), 'spans': [s.to_dict() for s in self.spans()]}, f, indent=2, default=str)
+        logger.info(f"wrote the latency traces to {file_path}")
+
+    def export_csv(self, spans_file_path: str, summary_file_path: str) -> None:
+        """
+        Write one row per span, and one row per stage with its summary, to CSV files.
+        """
+        with open(spans_file_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['trace_id', 'span_id', 'parent_id', 'stage', 'start_time', 'duration_ms', 'attributes'])
+            for s in self.spans():
+                writer.writerow([s.trace_id, s.span_id, s.parent_id, s.stage, s.start_time, s.duration_ms,
+                                 json.dumps(s.attributes, default=str)])
+        summary = self.summary()
+        columns = ['count', 'errors', 'mean_ms', 'max_ms'] + [f'p{p}_ms' for p in PERCENTILES] + \
+                  [f'total_{a}' for a in SUMMED_ATTRIBUTES] + ['histogram']
+        with open(summary_file_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['stage'] + columns)
+            for stage, stage_summary in summary.items():
+                writer.writerow([stage] + [json.dumps(stage_summary[c]) if c == 'histogram' else stage_summary.get(c, '')
+                                           for c in columns])
+        logger.info(f"wrote {len(self._spans)} spans to {spans_file_path} and the stage summary to {summary_file_path}")
+
+    def clear(self) -> None:
+        """
+        Delete every recorded span.
+        """
+        with self._lock:
+            self._spans.clear()
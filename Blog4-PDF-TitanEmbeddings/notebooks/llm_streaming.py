@@ -0,0 +1,115 @@
+"""
+Token streaming for the LLM calls of the query path. `stream_completion` streams a litellm completion,
+handing each piece of text to a callback as soon as it arrives, and returns the same token counts and
+latency fields as the blocking calls once the stream ends, along with the time to the first token.
+`TokenStream` runs a function that produces tokens through such a callback in a background thread and
+exposes the tokens as an iterator, and the return value of the function once it finishes.
+"""
+import time
+import queue
+import logging
+import threading
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# marks the end of the tokens in the queue of a TokenStream
+_END_OF_STREAM = object()
+
+
+def stream_completion(completion_fn: Callable,
+                      model: str,
+                      messages: List[Dict],
+                      on_token: Callable[[str], None],
+                      **kwargs: Any) -> Dict:
+    """
+    Call `completion_fn` (the litellm `completion` function) with `stream=True` and call `on_token` with each
+    piece of text as it arrives. The token counts are taken from the usage of the last chunk, and computed by
+    litellm from the chunks if the model does not return them.
+    :return: Dictionary with the full `completion`, `prompt_token_count`, `completion_token_count`,
+             `time_taken_in_seconds` and `time_to_first_token_in_seconds`.
+    """
+    st = time.perf_counter()
+    ret: Dict = {'completion': None,
+                 'prompt_token_count': None,
+                 'completion_token_count': None,
+                 'time_taken_in_seconds': None,
+                 'time_to_first_token_in_seconds': None}
+    chunks: List[Any] = []
+    pieces: List[str] = []
+    usage = None
+    for chunk in completion_fn(model=model, messages=messages, stream=True,
+                               stream_options={'include_usage': True}, **kwargs):
+        chunks.append(chunk)
+        if getattr(chunk, 'usage', None) is not None:
+            usage = chunk.usage
+        for choice in getattr(chunk, 'choices', None) or []:
+            text = getattr(choice.delta, 'content', None) if getattr(choice, 'delta', None) is not None else None
+            if not text:
+                continue
+            if ret['time_to_first_token_in_seconds'] is None:
+                ret['time_to_first_token_in_seconds'] = time.perf_counter() - st
+            pieces.append(text)
+            on_token(text)
+    ret['time_taken_in_seconds'] = time.perf_counter() - st
+    ret['completion'] = "".join(pieces).strip() if pieces else None
+    if usage is None:
+        # litellm rebuilds the full response, with the token counts, from the chunks
+        from litellm import stream_chunk_builder
+        usage = stream_chunk_builder(chunks, messages=messages).usage
+    ret['prompt_token_count'] = usage.prompt_tokens
+    ret['completion_token_count'] = usage.completion_tokens
+    logger.info(f"streamed {ret['completion_token_count']} tokens, first token after "
+                f"{ret['time_to_first_token_in_seconds']}s, stream ended after {ret['time_taken_in_seconds']:.2f}s")
+    return ret
+
+
+class TokenStream:
+    """
+    Iterator over the tokens that `producer(on_token)` passes to its `on_token` callback, while the producer
+    runs in a background thread. Once the iteration ends, `result` holds the value returned by the producer.
+    An exception raised by the producer is raised by the iteration and by `result`.
+    """
+
+    def __init__(self, producer: Callable[[Callable[[str], None]], Any]):
+        """
+        :param producer: Function that takes the callback to call with each token and returns the final result.
+        """
+        self._queue: queue.Queue = queue.Queue()
+        self._result: Any = None
+        self._error: Optional[BaseException] = None
+        self._done = threading.Event()
+        self._start: float = time.perf_counter()
+        self.time_to_first_token_in_seconds: Optional[float] = None
+        self._thread = threading.Thread(target=self._run, args=(producer,), daemon=True)
+        self._thread.start()
+
+    def _run(self, producer: Callable[[Callable[[str], None]], Any]) -> None:
+        try:
+            self._result = producer(self._queue.put)
+        except BaseException as e:
+            self._error = e
+        finally:
+            self._done.set()
+            self._queue.put(_END_OF_STREAM)
+
+    def __iter__(self) -> Iterator[str]:
+        while True:
+            token = self._queue.get()
+            if token is _END_OF_STREAM:
+                break
+            if self.time_to_first_token_in_seconds is None:
+                self.time_to_first_token_in_seconds = time.perf_counter() - self._start
+            yield token
+        if self._error is not None:
+            raise self._error
+
+    @property
+    def result(self) -> Any:
+        """
+        Value returned by the producer, waits for the producer to finish.
+        """
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._result
@@ -0,0 +1,354 @@
+"""
+In process vector index that can be used instead of OpenSearch Serverless for retrieval. It answers
+the same knn and `metadata.entities` prefilter queries that are sent to OpenSearch, and returns
+responses in the OpenSearch format, so the retrieval functions work unchanged with either backend.
+The index can be built from the JSON records written to `json_img_dir`/`json_txt_dir` during data
+ingestion, and is saved to disk as a float32 matrix that is memory mapped when it is loaded.
+"""
+import os
+import json
+import time
+import glob
+import fnmatch
+import hashlib
+import logging
+import numpy as np
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+try:
+    import hnswlib
+except ImportError:
+    hnswlib = None
+
+# search modes supported by the index
+MODE_EXACT: str = "exact"
+MODE_HNSW: str = "hnsw"
+
+# files in which a saved index is stored
+VECTORS_FILE: str = "vectors.npy"
+DOCUMENTS_FILE: str = "documents.json"
+INFO_FILE: str = "index_info.json"
+
+
+class LocalVectorIndex:
+    """
+    Vector index held in memory as a float32 matrix with one row per document, along with the
+    document fields that OpenSearch returns in `_source`. Searches are exact top-k by default,
+    scored the same way as the OpenSearch l2 space (1 / (1 + squared l2 distance)). If `hnswlib`
+    is installed, an approximate HNSW graph can be used instead by setting the mode to "hnsw".
+    """
+
+    def __init__(self,
+                 name: str,
+                 vectors: Optional[np.ndarray] = None,
+                 documents: Optional[List[Dict]] = None,
+                 mode: str = MODE_EXACT,
+                 hnsw_m: int = 16,
+                 hnsw_ef_construction: int = 200,
+                 hnsw_ef_search: int = 100):
+        """
+        :param name: Name of the index, the OpenSearch index name that it replaces.
+        :param vectors: Matrix of document embeddings, one row per document.
+        :param documents: Document fields returned in `_source` for each row of `vectors`.
+        :param mode: "exact" for a brute force search or "hnsw" for an approximate search.
+        :param hnsw_m: Number of links per node of the HNSW graph.
+        :param hnsw_ef_construction: Size of the candidate list used while building the HNSW graph.
+        :param hnsw_ef_search: Size of the candidate list used while searching the HNSW graph.
+        """
+        if mode not in (MODE_EXACT, MODE_HNSW):
+            raise ValueError(f"mode={mode} is not supported, use '{MODE_EXACT}' or '{MODE_HNSW}'")
+        if mode == MODE_HNSW and hnswlib is None:
+            raise ValueError(f"mode={mode} needs the hnswlib package, install it or use '{MODE_EXACT}'")
+        self.name = name
+        self.mode = mode
+        self.hnsw_m = hnsw_m
+        self.hnsw_ef_construction = hnsw_ef_construction
+        self.hnsw_ef_search = hnsw_ef_search
+        self.vectors: np.ndarray = vectors if vectors is not None else np.zeros((0, 0), dtype=np.float32)
+        self.documents: List[Dict] = documents if documents is not None else []
+        if len(self.vectors) != len(self.documents):
+            raise ValueError(f"{len(self.vectors)} vectors do not match {len(self.documents)} documents")
+        self._prepare()
+
+    def _prepare(self) -> None:
+        # squared norms of the rows are used to compute every l2 distance with a single matrix product
+        self._squared_norms = np.einsum('ij,ij->i', self.vectors, self.vectors) if len(self.vectors) else np.zeros(0, dtype=np.float32)
+        self._hnsw = None
+        if self.mode == MODE_HNSW and len(self.vectors):
+            self._hnsw = hnswlib.Index(space='l2', dim=self.vectors.shape[1])
+            self._hnsw.init_index(max_elements=len(self.vectors), M=self.hnsw_m, ef_construction=self.hnsw_ef_construction)
+            self._hnsw.add_items(self.vectors, np.arange(len(self.vectors)))
+            self._hnsw.set_ef(self.hnsw_ef_search)
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    def add(self, documents: Iterable[Dict]) -> None:
+        """
+        Add documents in the format that is posted to the OSI pipeline. The `vector_embedding`
+        field of each document is stored in the matrix and the rest of the fields in `_source`.
+        """
+        new_vectors: List[List[float]] = []
+        for document in documents:
+            document = dict(document)
+            new_vectors.append(document.pop('vector_embedding'))
+            self.documents.append(document)
+        if not new_vectors:
+            return
+        new_matrix = np.asarray(new_vectors, dtype=np.float32)
+        self.vectors = np.vstack([self.vectors, new_matrix]) if len(self.vectors) else new_matrix
+        self._prepare()
+
+    def knn(self, vector: List[float], k: int, candidates: Optional[np.ndarray] = None) -> List[tuple]:
+        """
+        Return the (row, score) of the k nearest documents to the vector, best first. If a boolean
+        mask of candidate rows is given, only those rows are searched, like a knn prefilter in OpenSearch.
+        """
+        if len(self.vectors) == 0 or k <= 0:
+            return []
+        query = np.asarray(vector, dtype=np.float32)
+        if self._hnsw is not None:
+            allowed = (lambda row: bool(candidates[row])) if candidates is not None else None
+            n_allowed = int(candidates.sum()) if candidates is not None else len(self.vectors)
+            if n_allowed == 0:
+                return []
+            self._hnsw.set_ef(max(self.hnsw_ef_search, k))
+            rows, distances = self._hnsw.knn_query(query, k=min(k, n_allowed), filter=allowed)
+            return [(int(row), float(1.0 / (1.0 + d))) for row, d in zip(rows[0], distances[0])]
+        rows = np.flatnonzero(candidates) if candidates is not None else np.arange(len(self.vectors))
+        if len(rows) == 0:
+            return []
+        squared_distances = self._squared_norms[rows] - 2.0 * (self.vectors[rows] @ query) + float(query @ query)
+        squared_distances = np.maximum(squared_distances, 0.0)
+        k = min(k, len(rows))
+        # partial sort to get the k nearest rows, then sort only those k
+        nearest = np.argpartition(squared_distances, k - 1)[:k]
+        nearest = nearest[np.argsort(squared_distances[nearest])]
+        return [(int(rows[i]), float(1.0 / (1.0 + squared_distances[i]))) for i in nearest]
+
+    def search(self, body: Dict) -> Dict:
+        """
+        Run an OpenSearch query body against the index and return the response in the OpenSearch format.
+        Supports a top level `knn` query, or a `bool` query with a `knn` in `must` and `wildcard`, `term`,
+        `terms`, `fuzzy` or `match` clauses on the document fields in `filter`.
+        """
+        st = time.perf_counter()
+        size: int = body.get('size', 10)
+        query: Dict = body.get('query', {})
+        candidates: Optional[np.ndarray] = None
+        if 'bool' in query:
+            knn_query = query['bool'].get('must', {})
+            if isinstance(knn_query, list):
+                knn_query = next(q for q in knn_query if 'knn' in q)
+            if query['bool'].get('filter'):
+                candidates = self._filter_mask(query['bool']['filter'])
+            query = knn_query
+        if 'knn' not in query:
+            raise ValueError(f"query={query} is not supported by the local vector index, only knn queries are")
+        field, knn_params = next(iter(query['knn'].items()))
+        results = self.knn(knn_params['vector'], min(size, knn_params.get('k', size)), candidates)
+        hits = [{'_index': self.name, '_id': str(row), '_score': score, '_source': self.documents[row]}
+                for row, score in results]
+        return {
+            'took': int((time.perf_counter() - st) * 1000),
+            'timed_out': False,
+            'hits': {
+                'total': {'value': len(hits), 'relation': 'eq'},
+                'max_score': hits[0]['_score'] if hits else None,
+                'hits': hits,
+            },
+        }
+
+    def _field_values(self, field: str) -> List[List[str]]:
+        # values of a (dotted) document field for every row, as a list of strings since a field can hold an array
+        values: List[List[str]] = []
+        for document in self.documents:
+            value = document
+            for part in field.split('.'):
+                value = value.get(part) if isinstance(value, dict) else None
+            if value is None:
+                values.append([])
+            else:
+                values.append([str(v) for v in value] if isinstance(value, list) else [str(value)])
+        return values
+
+    def _filter_mask(self, clause) -> np.ndarray:
+        # evaluate an OpenSearch filter clause into a boolean mask over the rows of the index
+        if isinstance(clause, list):
+            masks = [self._filter_mask(c) for c in clause]
+            return np.logical_and.reduce(masks) if masks else np.ones(len(self), dtype=bool)
+        if 'bool' in clause:
+            bool_clause: Dict = clause['bool']
+            mask = np.ones(len(self), dtype=bool)
+            for key in ('must', 'filter'):
+                if bool_clause.get(key):
+                    mask &= self._filter_mask(bool_clause[key])
+            if bool_clause.get('must_not'):
+                must_not = bool_clause['must_not']
+                for c in (must_not if isinstance(must_not, list) else [must_not]):
+                    mask &= ~self._filter_mask(c)
+            should = bool_clause.get('should', [])
+            should = should if isinstance(should, list) else [should]
+            if should:
+                matches = np.sum([self._filter_mask(c) for c in should], axis=0)
+                mask &= matches >= int(bool_clause.get('minimum_should_match', 1))
+            return mask
+        if 'wildcard' in clause:
+            field, params = next(iter(clause['wildcard'].items()))
+            pattern: str = params['value'] if isinstance(params, dict) else params
+            case_insensitive: bool = isinstance(params, dict) and params.get('case_insensitive', False)
+            if case_insensitive:
+                pattern = pattern.lower()
+            return np.array([any(fnmatch.fnmatchcase(v.lower() if case_insensitive else v, pattern) for v in row_values)
+                             for row_values in self._field_values(field)], dtype=bool)
+        if 'term' in clause:
+            field, params = next(iter(clause['term'].items()))
+            value = str(params['value'] if isinstance(params, dict) else params)
+            return np.array([value in row_values for row_values in self._field_values(field)], dtype=bool)
+        if 'terms' in clause:
+            field, values = next(iter(clause['terms'].items()))
+            values = {str(v) for v in values}
+            return np.array([not values.isdisjoint(row_values) for row_values in self._field_values(field)], dtype=bool)
+        if 'fuzzy' in clause:
+            field, params = next(iter(clause['fuzzy'].items()))
+            value = str(params['value'] if isinstance(params, dict) else params)
+            fuzziness = params.get('fuzziness', 'AUTO') if isinstance(params, dict) else 'AUTO'
+            max_edits = _auto_fuzziness(value) if str(fuzziness).upper() == 'AUTO' else int(fuzziness)
+            return np.array([any(_edit_distance(value, v, max_edits) <= max_edits for v in row_values)
+                             for row_values in self._field_values(field)], dtype=bool)
+        if 'match' in clause:
+            field, params = next(iter(clause['match'].items()))
+            tokens = str(params['query'] if isinstance(params, dict) else params).lower().split()
+            return np.array([any(t in v.lower() for t in tokens for v in row_values)
+                             for row_values in self._field_values(field)], dtype=bool)
+        raise ValueError(f"filter clause={clause} is not supported by the local vector index")
+
+    def save(self, index_dir: str, source_fingerprint: Optional[str] = None) -> None:
+        """
+        Save the matrix of embeddings and the documents to a directory.
+        """
+        os.makedirs(index_dir, exist_ok=True)
+        np.save(os.path.join(index_dir, VECTORS_FILE), np.ascontiguousarray(self.vectors, dtype=np.float32))
+        Path(os.path.join(index_dir, DOCUMENTS_FILE)).write_text(json.dumps(self.documents, default=str))
+        Path(os.path.join(index_dir, INFO_FILE)).write_text(json.dumps({'name': self.name,
+                                                                        'documents': len(self),
+                                                                        'source_fingerprint': source_fingerprint}, indent=2))
+        logger.info(f"saved the local vector index {self.name} with {len(self)} documents to {index_dir}")
+
+    @classmethod
+    def load(cls, index_dir: str, mmap: bool = True, **kwargs) -> "LocalVectorIndex":
+        """
+        Load an index saved with `save`. The matrix of embeddings is memory mapped unless `mmap` is False.
+        """
+        info: Dict = json.loads(Path(os.path.join(index_dir, INFO_FILE)).read_text())
+        vectors = np.load(os.path.join(index_dir, VECTORS_FILE), mmap_mode='r' if mmap else None)
+        documents: List[Dict] = json.loads(Path(os.path.join(index_dir, DOCUMENTS_FILE)).read_text())
+        logger.info(f"loaded the local vector index {info['name']} with {len(documents)} documents from {index_dir}")
+        return cls(info['name'], vectors, documents, **kwargs)
+
+
+def _auto_fuzziness(value: str) -> int:
+    # number of edits allowed by the AUTO fuzziness of OpenSearch, based on the length of the term
+    return 0 if len(value) <= 2 else 1 if len(value) <= 5 else 2
+
+
+def _edit_distance(a: str, b: str, max_edits: int) -> int:
+    # Levenshtein distance between two strings, returns max_edits + 1 as soon as it is exceeded
+    if abs(len(a) - len(b)) > max_edits:
+        return max_edits + 1
+    previous_row = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current_row = [i]
+        for j, cb in enumerate(b, 1):
+            current_row.append(min(previous_row[j] + 1, current_row[j - 1] + 1, previous_row[j - 1] + (ca != cb)))
+        if min(current_row) > max_edits:
+            return max_edits + 1
+        previous_row = current_row
+    return previous_row[-1]
+
+
+def json_records_fingerprint(json_dir: str) -> str:
+    """
+    Return a hash of the names, sizes and modification times of the JSON records in a directory,
+    used to detect that a saved index is out of date.
+    """
+    entries = sorted((os.path.basename(p), os.path.getsize(p), os.path.getmtime(p))
+                     for p in glob.glob(os.path.join(json_dir, "*.json")))
+    return hashlib.sha256(json.dumps(entries).encode('utf-8')).hexdigest()
+
+
+def build_index_from_json_records(name: str,
+                                  json_dir: str,
+                                  embed_fn: Callable[[str], List[float]],
+                                  bucket_name: str,
+                                  bucket_prefix: str,
+                                  **kwargs) -> LocalVectorIndex:
+    """
+    Build an index from the JSON records that data ingestion writes for each image or text file.
+    Records that do not contain a `vector_embedding` are embedded with `embed_fn`, which is served
+    from the embedding cache for content that was embedded during ingestion.
+    :param name: Name of the index.
+    :param json_dir: Directory with the JSON records, `json_img_dir` or `json_txt_dir`.
+    :param embed_fn: Function that returns the embedding of the text of a record.
+    :param bucket_name: Bucket that the images and texts were uploaded to, used to rebuild the file paths.
+    :param bucket_prefix: Prefix of the images or texts in the bucket.
+    """
+    documents: List[Dict] = []
+    for fpath in sorted(glob.glob(os.path.join(json_dir, "*.json"))):
+        record: Dict = json.loads(Path(fpath).read_text())
+        embedding = record.get('vector_embedding') or embed_fn(record['text'])
+        if embedding is None:
+            logger.error(f"could not get the embedding for {fpath}, it is not added to the local vector index")
+            continue
+        # same fields as the documents posted to the OSI pipeline during data ingestion
+        documents.append({
+            "file_path": f"s3://{bucket_name}/{bucket_prefix}/{Path(record['file_name']).stem}{record['file_type']}",
+            "file_text": record['text'],
+            "page_number": record['page_number'],
+            "metadata": {
+                "filename": f"{Path(record['file_name']).stem}{record['file_type']}",
+                "entities": record['entities'],
+                "entity_terms": record.get('entity_terms', [])
+            },
+            "vector_embedding": embedding
+        })
+    index = LocalVectorIndex(name, **kwargs)
+    index.add(documents)
+    logger.info(f"built the local vector index {name} with {len(index)} documents from {json_dir}")
+    return index
+
+
+def load_or_build_index(name: str, index_dir: str, json_dir: str, **kwargs) -> LocalVectorIndex:
+    """
+    Load the saved index from `index_dir` if it was built from the current JSON records in `json_dir`,
+    otherwise build it from the records and save it. See `build_index_from_json_records` for the arguments.
+    """
+    fingerprint = json_records_fingerprint(json_dir)
+    index_kwargs = {k: kwargs.pop(k) for k in ('mode', 'hnsw_m', 'hnsw_ef_construction', 'hnsw_ef_search') if k in kwargs}
+    info_path = os.path.join(index_dir, INFO_FILE)
+    if os.path.exists(info_path) and json.loads(Path(info_path).read_text()).get('source_fingerprint') == fingerprint:
+        return LocalVectorIndex.load(index_dir, **index_kwargs)
+    index = build_index_from_json_records(name, json_dir, **kwargs, **index_kwargs)
+    index.save(index_dir, fingerprint)
+    return index
+
+
+class LocalOpenSearchClient:
+    """
+    Stand in for the OpenSearch client that serves `search` calls from local vector indexes, so it can
+    be passed to the retrieval functions in place of an `OpenSearch` client.
+    """
+
+    def __init__(self, indexes: Dict[str, LocalVectorIndex]):
+        """
+        :param indexes: Local vector indexes keyed by the OpenSearch index name they replace.
+        """
+        self.indexes = indexes
+
+    def search(self, body: Dict, index: str, **kwargs) -> Dict:
+        if index not in self.indexes:
+            raise KeyError(f"index={index} is not loaded in the local vector store, loaded={list(self.indexes)}")
+        return self.indexes[index].search(body)
@@ -1,31 +1,34 @@
 import os
 import sys
-import yaml
 import json
+import hashlib
 import logging
+import yaml
+import subprocess
 import papermill as pm
-from typing import Dict
+from typing import Dict, List, Optional
 from pathlib import Path
 from datetime import datetime
 from nbformat import NotebookNode
+from pipeline_runner import PipelineRunner, PipelineStep, steps_from_config, write_step_notebook, STATUS_FAILED
 
 # Setup logging
 logging.basicConfig(format='[%(asctime)s] p%(process)s {%(filename)s:%(lineno)d} %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Function to get the config file path and use that to read it
-def read_config(config_file_path: str) -> Dict:
-    if config_file_path is not None:
-        logger.info(f"executing the config file found in {config_file_path}...")
-        try:
-            logger.info(f"loading config from given relative path: {config_file_path}")
-            config_content = yaml.safe_load(Path(config_file_path).read_text())
-        except Exception as e:
-            logger.error(f"error loading config from given path: {e}")
-            raise
-    else:
-        logger.info(f"the provided config'{config_file_path}' is not a valid path or non existant")
-
+# tag of the notebook cells that install the requirements, they are installed once by this script instead
+INSTALL_REQUIREMENTS_TAG: str = "install_requirements"
+
+# Function to get the config file paths and use them to read the merged config
+def read_config(config_file_path: str, full_config_file_path: str) -> Dict:
+    # utils is imported here since its dependencies are only available once the requirements are installed
+    from utils import load_and_merge_configs
+    logger.info(f"loading config from {config_file_path} merged into {full_config_file_path}")
+    try:
+        config_content = load_and_merge_configs(config_file_path, full_config_file_path)
+    except Exception as e:
+        logger.error(f"error loading config from given path: {e}")
+        raise
     logger.info(f"loaded configuration: {json.dumps(config_content, indent=2)}")
     return config_content
 
@@ -37,10 +40,33 @@ def output_handler(cell: NotebookNode, _):
                 print(output.text, end='')
 
 
-def run_notebooks(config_file: str) -> None:
-    # Assume `read_config` function is defined elsewhere to load the config
-    config = read_config(config_file)
-
+def install_requirements(requirements_file: Path, marker_file: Path) -> None:
+    """
+    Install the requirements once for all of the notebooks. The hash of the requirements file is recorded in
+    the marker file, and the requirements are installed again only if the file changes.
+    """
+    requirements_hash: str = hashlib.sha256(requirements_file.read_bytes()).hexdigest()
+    if marker_file.exists() and marker_file.read_text().strip() == requirements_hash:
+        logger.info(f"requirements in {requirements_file} are unchanged since they were last installed, skipping")
+        return
+    logger.info(f"installing the requirements in {requirements_file}...")
+    subprocess.run([sys.executable, '-m', 'pip', 'install', '-r', str(requirements_file)], check=True)
+    marker_file.write_text(requirements_hash)
+
+
+def start_shared_ray_session() -> Optional[str]:
+    """
+    Start a Ray session that the notebooks connect to through the RAY_ADDRESS environment variable, which is
+    inherited by the notebook kernels, instead of each notebook starting its own.
+    """
+    import ray
+    ray_address: str = ray.init().address_info['gcs_address']
+    os.environ['RAY_ADDRESS'] = ray_address
+    logger.info(f"started a shared ray session at {ray_address}")
+    return ray_address
+
+
+def run_notebooks(config_file: str, full_config_file: str) -> None:
     current_directory = Path(__file__).parent
     logging.info(f"Current directory is --> {current_directory}")
 
@@ -48,39 +74,61 @@ def run_notebooks(config_file: str) -> None:
     if not output_directory.exists():
         output_directory.mkdir()
 
-    for step, execute in config['run_steps'].items():
-        if execute:
-            notebook_path = current_directory / step
-            logging.info(f"Current step file --> {notebook_path.stem}")
-
-            timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
-            output_file = output_directory / f"{notebook_path.stem}_{timestamp}.ipynb"
-
-            try:
-                logging.info(f"Executing {notebook_path.name}...")
-                logger.info(f"THE STEP BEING EXECUTED NOW: {step}")
-                pm.execute_notebook(
-                    input_path=str(notebook_path),
-                    output_path=str(output_file),
-                    kernel_name='python3',
-                    parameters={},
-                    report_mode=True,  
-                    progress_bar=True,
-                    stdout_file=None, 
-                    stderr_file=None,
-                    log_output=True,
-                    output_handler=output_handler 
-                )
-                logger.info(f"STEP EXECUTION COMPLETED: {step}")
-            except FileNotFoundError as e:
-                logging.error(f"File not found: {e.filename}")
-                sys.exit(1)
-            except Exception as e:
-                logging.error(f"Failed to execute {step}: {str(e)}")
-                sys.exit(1)
-        else:
-            logging.info(f"Skipping {step} as it is not marked for execution")
-
+    # the merged config is read after the requirements are installed, so this setting is read from the full config
+    common_skip_tags: List[str] = []
+    full_config: Dict = yaml.safe_load(Path(full_config_file).read_text())
+    if full_config['pipeline_info'].get('install_requirements', True):
+        install_requirements(current_directory / "requirements.txt", output_directory / ".requirements_installed")
+        common_skip_tags.append(INSTALL_REQUIREMENTS_TAG)
+    config = read_config(config_file, full_config_file)
+    pipeline_info: Dict = config['pipeline_info']
+    steps = steps_from_config(pipeline_info, config['run_steps'], common_skip_tags)
+    for step in steps:
+        if not step.enabled:
+            logging.info(f"Skipping {step.name} as {step.notebook} is not marked for execution")
+
+    if pipeline_info.get('shared_ray_session', True):
+        start_shared_ray_session()
+
+    timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+
+    def execute_step(step: PipelineStep) -> None:
+        # the cells tagged with the skip tags of the step are removed from a copy of the notebook that is executed
+        notebook_path = current_directory / step.notebook
+        input_file = write_step_notebook(str(notebook_path), step.skip_tags, str(output_directory / "step_inputs" / f"{step.name}.ipynb"))
+        output_file = output_directory / f"{notebook_path.stem}_{step.name}_{timestamp}.ipynb"
+        logger.info(f"THE STEP BEING EXECUTED NOW: {step.name} ({notebook_path.name})")
+        pm.execute_notebook(
+            input_path=input_file,
+            output_path=str(output_file),
+            kernel_name='python3',
+            parameters={},
+            report_mode=True,
+            # steps run at the same time, so the progress bars are not shown
+            progress_bar=False,
+            stdout_file=None,
+            stderr_file=None,
+            log_output=True,
+            cwd=str(current_directory),
+            output_handler=output_handler
+        )
+        logger.info(f"STEP EXECUTION COMPLETED: {step.name}")
+
+    runner = PipelineRunner(steps,
+                            config,
+                            execute_step,
+                            work_dir=str(current_directory),
+                            state_file=str(current_directory / pipeline_info['state_file']),
+                            max_parallel_steps=pipeline_info.get('max_parallel_steps', 4))
+    report = runner.run()
+    report_file = current_directory / pipeline_info['report_file']
+    report_file.write_text(json.dumps(report, indent=2))
+    logger.info(f"pipeline report written to {report_file}")
+
+    failed_steps = [name for name, result in report['steps'].items() if result['status'] == STATUS_FAILED]
+    if failed_steps:
+        logging.error(f"Failed to execute {failed_steps}, see the logs above and {report_file}")
+        sys.exit(1)
     logger.info(f"Multimodal enhanced RAG workflow is complete. View results in the local metrics directory.")
 
 
@@ -90,9 +138,13 @@ def main():
     # config file path location
     current_directory = Path(__file__).parent
     config_file_path: str = os.path.join(current_directory, 'config.yaml')
+    full_config_file_path: str = os.path.join(current_directory, 'configs', 'config_full.yaml')
+
+    # the notebooks and the modules that they import use paths relative to this directory
+    os.chdir(current_directory)
 
     # config file path being read for step execution
-    run_notebooks(config_file_path)    
+    run_notebooks(config_file_path, full_config_file_path)    
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
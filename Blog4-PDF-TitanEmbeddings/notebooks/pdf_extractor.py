@@ -0,0 +1,129 @@
+"""
+Single pass, parallel extraction of the text and the rendered image of every page of a pdf file.
+"""
+import os
+import logging
+import pypdfium2 as pdfium
+from PIL import Image
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+from importlib.metadata import version, PackageNotFoundError
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+logger = logging.getLogger(__name__)
+
+# format and extension of the page images and texts that are saved
+IMAGE_FORMAT: str = "JPEG"
+IMAGE_FILE_EXTN: str = ".jpg"
+TEXT_FILE_EXTN: str = ".txt"
+
+
+def extractor_id() -> str:
+    """
+    Return the name and version of the library that extracts the text and renders the image of each page.
+    The extracted text (and so the embeddings and entities of each page) differs between libraries and versions,
+    for example from the text extracted by PyPDF2 in earlier versions of data prep, so it is part of the data
+    prep fingerprint and the pdf files are extracted again when it changes.
+    """
+    try:
+        return f"pypdfium2=={version('pypdfium2')}"
+    except PackageNotFoundError:
+        return "pypdfium2"
+
+
+def crop_page_image(img: Image.Image, image_dir: str, page_name: str, horizontal_split: bool, vertical_split: bool) -> List[str]:
+    """
+    Save the halves of the page image that are requested by the split settings and return their paths
+    """
+    width, height = img.size
+    crops: Dict[str, tuple] = {}
+    if vertical_split:
+        # Coordinates for the left and right half
+        crops['left_half'] = (0, 0, width / 2, height)
+        crops['right_half'] = (width / 2, 0, width, height)
+    if horizontal_split:
+        # Coordinates for the upper and lower half
+        crops['upper_half'] = (0, 0, width, height / 2)
+        crops['lower_half'] = (0, height / 2, width, height)
+    crop_paths: List[str] = []
+    for name, box in crops.items():
+        crop_path = os.path.join(image_dir, f"{page_name}_{name}{IMAGE_FILE_EXTN}")
+        img.crop(box).save(crop_path, IMAGE_FORMAT)
+        crop_paths.append(crop_path)
+    return crop_paths
+
+
+def extract_page_range(pdf_path: str,
+                       start_page: int,
+                       end_page: int,
+                       text_dir: str,
+                       image_dir: str,
+                       image_scale: float,
+                       horizontal_split: bool,
+                       vertical_split: bool) -> List[Dict]:
+    """
+    Open the pdf file once, and for each page in [start_page, end_page) save the page text and the
+    rendered page image (and its halves if the page is split). Runs in a worker process.
+    :return: List of dictionaries containing the page number, and paths to the text and image files of each page
+    """
+    file_name: str = Path(pdf_path).stem
+    pdf = pdfium.PdfDocument(pdf_path)
+    pages: List[Dict] = []
+    try:
+        for page_number in range(start_page, end_page):
+            page = pdf[page_number]
+            # extract the text of the page
+            textpage = page.get_textpage()
+            pdf_text: str = textpage.get_text_range()
+            textpage.close()
+            text_path = os.path.join(text_dir, f"{file_name}_text_{page_number + 1}{TEXT_FILE_EXTN}")
+            with open(text_path, 'w', encoding='utf-8') as text_file:
+                text_file.write(pdf_text)
+            # render the page as an image
+            pil_image = page.render(scale=image_scale, rotation=0, crop=(0, 0, 0, 0)).to_pil()
+            page_name: str = f"{file_name}_page_{page_number + 1}"
+            page_image = os.path.join(image_dir, f"{page_name}{IMAGE_FILE_EXTN}")
+            pil_image.save(page_image, format=IMAGE_FORMAT)
+            image_paths = crop_page_image(pil_image, image_dir, page_name, horizontal_split, vertical_split)
+            image_paths.append(page_image)
+            page.close()
+            pages.append({'page_number': page_number, 'text_path': text_path, 'image_paths': image_paths})
+    finally:
+        pdf.close()
+    return pages
+
+
+def extract_pdf_pages(pdf_path: str,
+                      text_dir: str,
+                      image_dir: str,
+                      image_scale: float,
+                      horizontal_split: bool = False,
+                      vertical_split: bool = False,
+                      max_workers: Optional[int] = None,
+                      pages_per_task: int = 8) -> Iterator[Dict]:
+    """
+    Split the pages of a pdf file into ranges that are extracted in parallel by a pool of processes
+    and yield the text and image paths of each page as soon as its range is done. Pages are yielded
+    in completion order, not in page order.
+    :param pdf_path: Path to the pdf file.
+    :param text_dir: Directory in which the page texts are saved.
+    :param image_dir: Directory in which the page images are saved.
+    :param image_scale: Scale at which the pages are rendered.
+    :param horizontal_split: Also save the upper and lower halves of each page image.
+    :param vertical_split: Also save the left and right halves of each page image.
+    :param max_workers: Number of worker processes, defaults to the number of CPUs.
+    :param pages_per_task: Number of pages extracted by a worker process in one task.
+    """
+    os.makedirs(text_dir, exist_ok=True)
+    os.makedirs(image_dir, exist_ok=True)
+    pdf = pdfium.PdfDocument(pdf_path)
+    n_pages: int = len(pdf)
+    pdf.close()
+    logger.info(f"Extracting {n_pages} pages from {pdf_path} in ranges of {pages_per_task} pages")
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(extract_page_range, pdf_path, start, min(start + pages_per_task, n_pages),
+                                   text_dir, image_dir, image_scale, horizontal_split, vertical_split)
+                   for start in range(0, n_pages, pages_per_task)]
+        for future in as_completed(futures):
+            for page in future.result():
+                yield page
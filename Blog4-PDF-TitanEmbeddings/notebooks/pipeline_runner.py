@@ -0,0 +1,288 @@
+"""
+Runs the notebooks of the solution as a dependency graph of steps. Each step declares the steps it
+depends on, its input files and config sections, and its output files. A step is skipped when its
+inputs, its config, its notebook and the outputs of the steps it depends on are unchanged since it last
+succeeded, steps whose dependencies are complete run concurrently, and the wall time of every step is
+recorded along with the critical path of the run.
+"""
+import os
+import json
+import glob
+import time
+import logging
+from pathlib import Path
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+from ingestion_manifest import hash_file, make_fingerprint
+
+logger = logging.getLogger(__name__)
+
+# status of each step in the report of a run
+STATUS_RAN: str = "ran"
+STATUS_SKIPPED: str = "skipped"
+STATUS_FAILED: str = "failed"
+STATUS_BLOCKED: str = "blocked"
+STATUS_DISABLED: str = "disabled"
+
+
+class PipelineStep:
+    """
+    A notebook run as one step of the pipeline. Cells tagged with one of `skip_tags` are not executed, so
+    that independent parts of a notebook can run as separate steps.
+    """
+
+    def __init__(self,
+                 name: str,
+                 notebook: str,
+                 depends_on: Iterable[str] = (),
+                 inputs: Iterable[str] = (),
+                 outputs: Iterable[str] = (),
+                 config_sections: Iterable[str] = (),
+                 skip_tags: Iterable[str] = (),
+                 cache: bool = True,
+                 reset_state: bool = False,
+                 enabled: bool = True):
+        """
+        :param name: Name of the step.
+        :param notebook: Path of the notebook that the step executes.
+        :param depends_on: Names of the steps that must complete before this step.
+        :param inputs: Glob patterns of the files that the step reads, other than the outputs of its dependencies.
+        :param outputs: Glob patterns of the files that the step writes, read by the steps that depend on it.
+        :param config_sections: Sections of the config file that the step depends on.
+        :param skip_tags: Tags of the notebook cells that are not executed by this step.
+        :param cache: Skip the step if it is unchanged since it last succeeded.
+        :param reset_state: Forget the state of every step once this step succeeds, for steps that delete
+                            the outputs of the other steps.
+        :param enabled: Run the step, a disabled step is treated as complete by the steps that depend on it.
+        """
+        self.name = name
+        self.notebook = notebook
+        self.depends_on = list(depends_on)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.config_sections = list(config_sections)
+        self.skip_tags = sorted(skip_tags)
+        self.cache = cache
+        self.reset_state = reset_state
+        self.enabled = enabled
+
+
+def steps_from_config(pipeline_info: Dict, run_steps: Dict[str, bool], common_skip_tags: Iterable[str] = ()) -> List[PipelineStep]:
+    """
+    Create the steps in the pipeline_info section of the config file. A step is enabled if its notebook is
+    enabled in run_steps.
+    """
+    return [PipelineStep(name,
+                         step_info['notebook'],
+                         depends_on=step_info.get('depends_on') or [],
+                         inputs=step_info.get('inputs') or [],
+                         outputs=step_info.get('outputs') or [],
+                         config_sections=step_info.get('config_sections') or [],
+                         skip_tags=list(step_info.get('skip_tags') or []) + list(common_skip_tags),
+                         cache=step_info.get('cache', True),
+                         reset_state=step_info.get('reset_state', False),
+                         enabled=bool(run_steps.get(step_info['notebook'], False)))
+            for name, step_info in pipeline_info['steps'].items()]
+
+
+def write_step_notebook(notebook_path: str, skip_tags: Iterable[str], output_path: str) -> str:
+    """
+    Write a copy of the notebook without the cells that have one of the skip tags.
+    :return: Path of the copy.
+    """
+    notebook: Dict = json.loads(Path(notebook_path).read_text())
+    skip = set(skip_tags)
+    notebook['cells'] = [cell for cell in notebook['cells'] if not skip & set(cell.get('metadata', {}).get('tags', []))]
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    Path(output_path).write_text(json.dumps(notebook, indent=1, ensure_ascii=False) + "\n")
+    return output_path
+
+
+class PipelineRunner:
+    """
+    Runs the enabled steps of a pipeline in dependency order, up to `max_parallel_steps` at a time. The
+    fingerprint of a step covers its notebook, skip tags, input files and config sections, and the hash of
+    the outputs of the steps it depends on. The fingerprint and the hash of the outputs of every step that
+    succeeds are stored in `state_file`, and a step whose fingerprint is the same as in the state file, and
+    whose outputs exist, is skipped. A step that fails blocks the steps that depend on it, the other steps
+    still run.
+    """
+
+    def __init__(self,
+                 steps: List[PipelineStep],
+                 config: Dict,
+                 execute_fn: Callable[[PipelineStep], None],
+                 work_dir: str,
+                 state_file: str,
+                 max_parallel_steps: int = 4):
+        """
+        :param steps: Steps of the pipeline.
+        :param config: Merged config, the sections that each step depends on are part of its fingerprint.
+        :param execute_fn: Function that executes a step, it raises an exception if the step fails.
+        :param work_dir: Directory that the input and output patterns of the steps are relative to.
+        :param state_file: Path of the file that records the fingerprint and outputs of the steps that succeeded.
+        :param max_parallel_steps: Maximum number of steps running at the same time.
+        """
+        self.steps: Dict[str, PipelineStep] = {step.name: step for step in steps}
+        self.config = config
+        self.execute_fn = execute_fn
+        self.work_dir = work_dir
+        self.state_file = state_file
+        self.max_parallel_steps = max_parallel_steps
+        self._order: List[str] = self._topological_order()
+        self._state: Dict[str, Dict] = json.loads(Path(state_file).read_text()) if os.path.exists(state_file) else {}
+
+    def _topological_order(self) -> List[str]:
+        # raises ValueError for a dependency on an unknown step or a cycle
+        for step in self.steps.values():
+            unknown = set(step.depends_on) - set(self.steps)
+            if unknown:
+                raise ValueError(f"step {step.name} depends on unknown steps {sorted(unknown)}")
+        order: List[str] = []
+        visiting: Set[str] = set()
+
+        def visit(name: str) -> None:
+            if name in order:
+                return
+            if name in visiting:
+                raise ValueError(f"the pipeline has a cycle through step {name}")
+            visiting.add(name)
+            for dependency in self.steps[name].depends_on:
+                visit(dependency)
+            visiting.discard(name)
+            order.append(name)
+        for name in self.steps:
+            visit(name)
+        return order
+
+    def _files(self, patterns: Iterable[str]) -> List[str]:
+        # files matching the patterns, relative to the work directory
+        files: Set[str] = set()
+        for pattern in patterns:
+            files |= {os.path.relpath(p, self.work_dir) for p in glob.glob(os.path.join(self.work_dir, pattern), recursive=True)
+                      if os.path.isfile(p)}
+        return sorted(files)
+
+    def _hash_files(self, patterns: Iterable[str]) -> Dict[str, str]:
+        return {f: hash_file(os.path.join(self.work_dir, f)) for f in self._files(patterns)}
+
+    def fingerprint(self, step: PipelineStep, upstream_outputs: Dict[str, Optional[str]]) -> str:
+        """
+        Return the fingerprint of a step given the hash of the outputs of each step that it depends on.
+        """
+        return make_fingerprint(notebook=hash_file(os.path.join(self.work_dir, step.notebook)),
+                                skip_tags=step.skip_tags,
+                                inputs=self._hash_files(step.inputs),
+                                config={section: self.config.get(section) for section in step.config_sections},
+                                upstream_outputs=upstream_outputs)
+
+    def _outputs_hash(self, step: PipelineStep, fingerprint: str) -> str:
+        # a step without declared outputs changes its dependents whenever it runs with a different fingerprint
+        return make_fingerprint(outputs=self._hash_files(step.outputs)) if step.outputs else fingerprint
+
+    def _outputs_exist(self, step: PipelineStep) -> bool:
+        return all(self._files([pattern]) for pattern in step.outputs)
+
+    def _save_state(self) -> None:
+        os.makedirs(os.path.dirname(self.state_file) or '.', exist_ok=True)
+        tmp_path = f"{self.state_file}.tmp"
+        Path(tmp_path).write_text(json.dumps(self._state, indent=2))
+        os.replace(tmp_path, self.state_file)
+
+    def _critical_path(self, results: Dict[str, Dict]) -> List[str]:
+        # longest chain of dependent steps by the time they ran, the lower bound of the wall time of the run
+        longest: Dict[str, float] = {}
+        previous: Dict[str, Optional[str]] = {}
+        for name in self._order:
+            dependency = max(self.steps[name].depends_on, key=lambda d: longest[d], default=None)
+            longest[name] = results[name]['seconds'] + (longest[dependency] if dependency is not None else 0.0)
+            previous[name] = dependency
+        path: List[str] = []
+        name = max(longest, key=longest.get, default=None)
+        while name is not None:
+            path.insert(0, name)
+            name = previous[name]
+        return path
+
+    def run(self) -> Dict:
+        """
+        Run the pipeline.
+        :return: Report with the status, start offset and wall time of each step, the wall time of the run,
+                 the sum of the step times and the critical path.
+        """
+        st = time.perf_counter()
+        results: Dict[str, Dict] = {}
+        # hash of the outputs of the completed steps, read by the steps that depend on them
+        outputs: Dict[str, Optional[str]] = {}
+        running: Dict[Future, Tuple[str, float, str]] = {}
+        pending: List[str] = list(self._order)
+        executor = ThreadPoolExecutor(max_workers=self.max_parallel_steps, thread_name_prefix='pipeline-step')
+
+        def finish(name: str, status: str, started: float, fingerprint: Optional[str] = None) -> None:
+            step = self.steps[name]
+            results[name] = {'status': status, 'notebook': step.notebook,
+                             'start_seconds': round(started - st, 3),
+                             'seconds': round(time.perf_counter() - started, 3) if status == STATUS_RAN else 0.0}
+            if status == STATUS_RAN:
+                outputs[name] = self._outputs_hash(step, fingerprint)
+                if step.reset_state:
+                    self._state = {}
+                if step.cache:
+                    self._state[name] = {'fingerprint': fingerprint, 'outputs': outputs[name]}
+                self._save_state()
+            elif status == STATUS_SKIPPED:
+                outputs[name] = self._state[name]['outputs']
+            elif status == STATUS_DISABLED:
+                outputs[name] = self._state.get(name, {}).get('outputs') or \
+                                (make_fingerprint(outputs=self._hash_files(step.outputs)) if step.outputs else None)
+            logger.info(f"step {name}: {status}" + (f" in {results[name]['seconds']:.1f}s" if status == STATUS_RAN else ""))
+
+        try:
+            while pending or running:
+                for name in list(pending):
+                    step = self.steps[name]
+                    if any(dependency not in results for dependency in step.depends_on):
+                        continue
+                    if any(results[dependency]['status'] in (STATUS_FAILED, STATUS_BLOCKED) for dependency in step.depends_on):
+                        pending.remove(name)
+                        finish(name, STATUS_BLOCKED, time.perf_counter())
+                        continue
+                    if not step.enabled:
+                        pending.remove(name)
+                        finish(name, STATUS_DISABLED, time.perf_counter())
+                        continue
+                    if len(running) >= self.max_parallel_steps:
+                        break
+                    fingerprint = self.fingerprint(step, {dependency: outputs[dependency] for dependency in step.depends_on})
+                    pending.remove(name)
+                    if step.cache and self._state.get(name, {}).get('fingerprint') == fingerprint and self._outputs_exist(step):
+                        finish(name, STATUS_SKIPPED, time.perf_counter())
+                        continue
+                    logger.info(f"step {name}: running {step.notebook}" + (f" without the cells tagged {step.skip_tags}" if step.skip_tags else ""))
+                    started = time.perf_counter()
+                    future = executor.submit(self.execute_fn, step)
+                    running[future] = (name, started, fingerprint)
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name, started, fingerprint = running.pop(future)
+                    try:
+                        future.result()
+                        finish(name, STATUS_RAN, started, fingerprint)
+                    except Exception as e:
+                        logger.error(f"step {name} failed: {e}")
+                        finish(name, STATUS_FAILED, started)
+                        results[name]['error'] = str(e)
+                        results[name]['seconds'] = round(time.perf_counter() - started, 3)
+        finally:
+            executor.shutdown(wait=True)
+        critical_path = self._critical_path(results)
+        report: Dict = {'steps': {name: results[name] for name in self._order},
+                        'wall_seconds': round(time.perf_counter() - st, 3),
+                        'sum_of_step_seconds': round(sum(result['seconds'] for result in results.values()), 3),
+                        'critical_path': critical_path,
+                        'critical_path_seconds': round(sum(results[name]['seconds'] for name in critical_path), 3)}
+        logger.info(f"pipeline completed in {report['wall_seconds']:.1f}s, sum of step times {report['sum_of_step_seconds']:.1f}s, "
+                    f"critical path {' -> '.join(critical_path)} ({report['critical_path_seconds']:.1f}s)")
+        return report
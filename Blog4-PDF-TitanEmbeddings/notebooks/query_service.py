@@ -0,0 +1,241 @@
+"""
+Long lived HTTP service that answers questions with the query path in `rag_query.py`. The config, the
+prompt templates, the OpenSearch client and the Bedrock client are loaded once when the service starts
+and are shared by every request. Requests are handled concurrently: each question is answered on a
+bounded thread pool so that the event loop keeps accepting requests while the LLM calls are in flight.
+
+Endpoints:
+    POST /query     {"question": "...", "indexes": ["text", "image"], "k": 3, "answer_mode": "per_hit", "stream": false}
+                    Only "question" is required. With "stream": true the response is newline delimited JSON,
+                    one {"token": "..."} line per piece of the answer and a final {"result": {...}} line.
+    GET  /health    Liveness of the service and the number of questions being answered.
+    GET  /metrics   Request counts and latency percentiles, per stage latencies, and the cache and Bedrock stats.
+
+Usage (from this directory):
+    python query_service.py [--host 0.0.0.0] [--port 8080]
+"""
+import json
+import time
+import boto3
+import asyncio
+import logging
+import argparse
+import threading
+import numpy as np
+import globals as g
+from aiohttp import web
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Deque, Dict, List, Optional, Tuple
+from latency_tracer import PERCENTILES
+from rag_query import RAGQueryEngine, load_prompt_templates, create_opensearch_client, create_local_search_client
+from utils import (config, get_cfn_outputs, get_bucket_name, get_bedrock_runtime_client, get_answer_cache,
+                   get_latency_tracer, get_image_cache)
+
+logger = logging.getLogger(__name__)
+
+# answer modes that a request can ask for, see the answer_mode setting in the config file
+ANSWER_MODES: Tuple[str, ...] = ('per_hit', 'multi_context')
+
+
+def _dumps(obj: Any) -> str:
+    # the responses can hold values that are not JSON serializable, such as the exception of a failed LLM call
+    return json.dumps(obj, default=str)
+
+
+class QueryService:
+    """
+    aiohttp application that answers the questions posted to /query with a shared RAGQueryEngine, and
+    keeps the request counters and latencies reported by /metrics.
+    """
+
+    def __init__(self,
+                 engine: RAGQueryEngine,
+                 index_clients: Dict[str, Tuple[Any, str]],
+                 max_concurrent_queries: int = 16,
+                 default_indexes: Optional[List[str]] = None,
+                 default_k: int = 3,
+                 max_question_chars: int = 2000,
+                 max_latency_samples: int = 10000):
+        """
+        :param engine: Query engine used to answer every question.
+        :param index_clients: (search client, index name) of each index that a request can name, keyed by 'text' and 'image'.
+        :param max_concurrent_queries: Number of questions answered at the same time, the other requests wait.
+        :param default_indexes: Indexes searched when a request does not name any, all of them if not given.
+        :param default_k: Number of hits retrieved from each index when a request does not give 'k'.
+        :param max_question_chars: Maximum length of a question.
+        :param max_latency_samples: Number of most recent request latencies kept for the percentiles.
+        """
+        self.engine = engine
+        self.index_clients = index_clients
+        self.default_indexes = default_indexes or list(index_clients)
+        self.default_k = default_k
+        self.max_question_chars = max_question_chars
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent_queries, thread_name_prefix='query')
+        self._lock = threading.Lock()
+        self._started_at: float = time.time()
+        self._in_flight: int = 0
+        self._counts: Dict[str, int] = {'requests': 0, 'answered': 0, 'failed': 0, 'rejected': 0, 'streamed': 0}
+        self._latencies: Deque[float] = deque(maxlen=max_latency_samples)
+
+    def _parse_query(self, body: Dict) -> Dict:
+        # validate the request body and fill in the defaults, raises ValueError for an invalid request
+        question = body.get('question')
+        if not isinstance(question, str) or not question.strip():
+            raise ValueError("'question' must be a non empty string")
+        if len(question) > self.max_question_chars:
+            raise ValueError(f"'question' is longer than {self.max_question_chars} characters")
+        indexes = body.get('indexes', self.default_indexes)
+        if not isinstance(indexes, list) or not indexes or any(index not in self.index_clients for index in indexes):
+            raise ValueError(f"'indexes' must be a non empty list of {sorted(self.index_clients)}")
+        k = body.get('k', self.default_k)
+        if not isinstance(k, int) or isinstance(k, bool) or k <= 0:
+            raise ValueError("'k' must be a positive integer")
+        answer_mode = body.get('answer_mode')
+        if answer_mode is not None and answer_mode not in ANSWER_MODES:
+            raise ValueError(f"'answer_mode' must be one of {list(ANSWER_MODES)}")
+        return {'question': question.strip(),
+                'size': k,
+                'index_clients': [self.index_clients[index] for index in dict.fromkeys(indexes)],
+                'answer_mode': answer_mode,
+                'stream': bool(body.get('stream', False))}
+
+    def _record(self, outcome: str, seconds: Optional[float] = None) -> None:
+        with self._lock:
+            self._counts[outcome] += 1
+            if seconds is not None:
+                self._latencies.append(seconds)
+
+    async def handle_query(self, request: web.Request) -> web.StreamResponse:
+        self._record('requests')
+        try:
+            query = self._parse_query(await request.json())
+        except (ValueError, AttributeError) as e:
+            self._record('rejected')
+            return web.json_response({'error': str(e)}, status=400, dumps=_dumps)
+        st = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            self._in_flight += 1
+        try:
+            if not query.pop('stream'):
+                result = await loop.run_in_executor(self._executor, lambda: self.engine.get_index_response(**query))
+                if result is None:
+                    self._record('failed')
+                    return web.json_response({'error': "could not answer the question"}, status=500, dumps=_dumps)
+                self._record('answered', time.perf_counter() - st)
+                return web.json_response(result, dumps=_dumps)
+            # the tokens are handed from the worker thread to the event loop, in order, and written as they arrive
+            tokens: asyncio.Queue = asyncio.Queue()
+            on_token = lambda token: loop.call_soon_threadsafe(tokens.put_nowait, token)
+            future = loop.run_in_executor(self._executor, lambda: self.engine.get_index_response(**query, on_token=on_token))
+            future.add_done_callback(lambda _: tokens.put_nowait(None))
+            response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+            await response.prepare(request)
+            while (token := await tokens.get()) is not None:
+                await response.write((_dumps({'token': token}) + "\n").encode('utf-8'))
+            result = await future
+            if result is None:
+                self._record('failed')
+                await response.write((_dumps({'error': "could not answer the question"}) + "\n").encode('utf-8'))
+            else:
+                self._record('streamed')
+                self._record('answered', time.perf_counter() - st)
+                await response.write((_dumps({'result': result}) + "\n").encode('utf-8'))
+            await response.write_eof()
+            return response
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        with self._lock:
+            in_flight = self._in_flight
+        return web.json_response({'status': 'ok',
+                                  'uptime_seconds': round(time.time() - self._started_at, 1),
+                                  'in_flight': in_flight})
+
+    def metrics(self) -> Dict:
+        """
+        Return the request counters and latency percentiles, the latency summary of each stage of the query path,
+        the answer cache, image cache and Bedrock client stats, and the token totals of the engine.
+        """
+        with self._lock:
+            counts = dict(self._counts)
+            in_flight = self._in_flight
+            latencies = list(self._latencies)
+        latency_ms: Dict[str, float] = {}
+        if latencies:
+            latency_ms = {f"p{p}": round(float(v), 2) for p, v in zip(PERCENTILES, np.percentile(np.array(latencies) * 1000, PERCENTILES))}
+        answer_cache = get_answer_cache()
+        return {'uptime_seconds': round(time.time() - self._started_at, 1),
+                'in_flight': in_flight,
+                'requests': counts,
+                'latency_ms': latency_ms,
+                'stages': {stage: {key: value for key, value in stage_summary.items() if key != 'histogram'}
+                           for stage, stage_summary in self.engine.tracer.summary().items()},
+                'answer_cache': answer_cache.stats() if answer_cache is not None else None,
+                'image_cache': self.engine.image_cache.stats(),
+                'bedrock': get_bedrock_runtime_client().stats(),
+                'token_totals': dict(self.engine.token_totals)}
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        return web.json_response(self.metrics(), dumps=_dumps)
+
+    async def _close(self, app: web.Application) -> None:
+        # wait for the questions being answered, then stop the image downloads
+        await asyncio.get_running_loop().run_in_executor(None, lambda: self._executor.shutdown(wait=True))
+        self.engine.image_cache.close()
+
+    def app(self) -> web.Application:
+        """
+        Return the aiohttp application with the /query, /health and /metrics routes.
+        """
+        app = web.Application()
+        app.add_routes([web.post('/query', self.handle_query),
+                        web.get('/health', self.handle_health),
+                        web.get('/metrics', self.handle_metrics)])
+        app.on_cleanup.append(self._close)
+        return app
+
+
+def create_query_service(config: Dict) -> QueryService:
+    """
+    Load the prompt templates, create the OpenSearch (or local vector store) and Bedrock clients and the query
+    engine once, for every request that the service answers.
+    """
+    service_info: Dict = config['query_service_info']
+    outputs = get_cfn_outputs(config['aws']['cfn_stack_name'])
+    text_index_name: str = outputs['OpenSearchTextIndexName']
+    img_index_name: str = outputs['OpenSearchImgIndexName']
+    bedrock = get_bedrock_runtime_client()
+    if config['vector_store_info']['backend'] == 'local':
+        os_client = create_local_search_client(config, img_index_name, text_index_name,
+                                               get_bucket_name(config['aws']['cfn_stack_name']), bedrock,
+                                               g.BUCKET_IMG_PREFIX, g.BUCKET_TEXT_PREFIX)
+    else:
+        session = boto3.Session()
+        os_client = create_opensearch_client(outputs['MultimodalCollectionEndpoint'].split('//')[1],
+                                             session.region_name, config['aws']['os_service'], session.get_credentials(),
+                                             pool_maxsize=service_info.get('opensearch_pool_maxsize', 20))
+    engine = RAGQueryEngine(config, img_index_name, text_index_name, load_prompt_templates(config),
+                            get_latency_tracer(), get_image_cache())
+    logger.info(f"query service ready, text index={text_index_name}, image index={img_index_name}")
+    return QueryService(engine,
+                        {'text': (os_client, text_index_name), 'image': (os_client, img_index_name)},
+                        max_concurrent_queries=service_info.get('max_concurrent_queries', 16),
+                        default_indexes=service_info.get('default_indexes'),
+                        default_k=config['other_inference_and_eval_metrics']['k_count_retrieval'],
+                        max_question_chars=service_info.get('max_question_chars', 2000))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='[%(asctime)s] p%(process)s {%(filename)s:%(lineno)d} %(levelname)s - %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description="HTTP service that answers questions from the image and text indexes")
+    parser.add_argument('--host', type=str, help="address to listen on, overrides the config")
+    parser.add_argument('--port', type=int, help="port to listen on, overrides the config")
+    args = parser.parse_args()
+    service_info: Dict = config['query_service_info']
+    web.run_app(create_query_service(config).app(),
+                host=args.host or service_info.get('host', '0.0.0.0'),
+                port=args.port or service_info.get('port', 8080))
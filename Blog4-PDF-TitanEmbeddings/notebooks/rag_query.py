@@ -0,0 +1,800 @@
+"""
+Query path of the multimodal RAG solution: retrieval from the image and text indexes, the LLM calls that
+answer the question from the hits, and the final answer. `RAGQueryEngine` holds the config, the prompt
+templates, the latency tracer and the image cache that the query path needs, so the same code is used by
+the RAG inference notebook and by the long lived query service in `query_service.py`.
+"""
+import os
+import time
+import logging
+import threading
+import opensearchpy
+import numpy as np
+from pathlib import Path
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from opensearchpy import OpenSearch, RequestsHttpConnection, AWSV4SignerAuth
+from image_payload import ImagePayload
+from image_cache import S3ImageCache
+from latency_tracer import LatencyTracer
+from llm_streaming import stream_completion, TokenStream
+from ingestion_manifest import hash_file, make_fingerprint
+from local_vector_index import LocalOpenSearchClient, load_or_build_index
+from context_packing import pack_contexts, format_contexts, cited_sources
+from template_registry import PromptTemplateRegistry
+from utils import (get_text_embedding, get_llm_response, get_question_entities, get_bedrock_runtime_client,
+                   normalize_entities, get_answer_cache, get_prompt_templates, completion)
+
+logger = logging.getLogger(__name__)
+
+# keys of the prompt templates in the dir_info section of the config file that are used by the query path
+PROMPT_TEMPLATE_KEYS: List[str] = ['search_in_images_template', 'search_in_text_template', 'multi_context_answer_template']
+
+
+def load_prompt_templates(config: Dict) -> Dict[str, str]:
+    """
+    Return the prompt templates used by the query path, keyed by their name in the dir_info section of the config.
+    The templates are read through the process wide template registry, so each file is read from disk once.
+    """
+    templates = get_prompt_templates()
+    if templates.dir_info is not config['dir_info']:
+        templates = PromptTemplateRegistry(config['dir_info'])
+    return templates.preload(PROMPT_TEMPLATE_KEYS)
+
+
+def create_opensearch_client(host: str, region: str, os_service: str, credentials, pool_maxsize: int = 20) -> OpenSearch:
+    """
+    Create an OpenSearch client for the collection endpoint, signed with SigV4.
+    """
+    return OpenSearch(
+        hosts=[{'host': host, 'port': 443}],
+        http_auth=AWSV4SignerAuth(credentials, region, os_service),
+        use_ssl=True,
+        verify_certs=True,
+        connection_class=RequestsHttpConnection,
+        pool_maxsize=pool_maxsize
+    )
+
+
+def create_local_search_client(config: Dict, img_index_name: str, text_index_name: str, bucket_name: str,
+                               bedrock, img_bucket_prefix: str, text_bucket_prefix: str) -> LocalOpenSearchClient:
+    """
+    Load (or build from the JSON records written during data ingestion) the in process vector indexes that
+    serve the searches when the local vector store is configured. The records are embedded with the same
+    models as during data ingestion, so the embeddings are served from the embedding cache.
+    """
+    vector_store_info: Dict = config['vector_store_info']
+    index_settings: Dict = {k: vector_store_info[k] for k in ('mode', 'hnsw_m', 'hnsw_ef_construction', 'hnsw_ef_search')}
+    img_embeddings_model_id: str = config['model_info']['embeddings_model_info'].get('model_id')
+    local_img_index = load_or_build_index(img_index_name,
+                                          os.path.join(vector_store_info['index_dir'], img_index_name),
+                                          config['dir_info']['json_img_dir'],
+                                          embed_fn=lambda text: get_text_embedding(bedrock, text, img_embeddings_model_id),
+                                          bucket_name=bucket_name,
+                                          bucket_prefix=img_bucket_prefix,
+                                          **index_settings)
+    local_text_index = load_or_build_index(text_index_name,
+                                           os.path.join(vector_store_info['index_dir'], text_index_name),
+                                           config['dir_info']['json_txt_dir'],
+                                           embed_fn=lambda text: get_text_embedding(bedrock, text),
+                                           bucket_name=bucket_name,
+                                           bucket_prefix=text_bucket_prefix,
+                                           **index_settings)
+    logger.info(f"using the local vector store, image index={len(local_img_index)} documents, text index={len(local_text_index)} documents")
+    return LocalOpenSearchClient({img_index_name: local_img_index, text_index_name: local_text_index})
+
+
+def sanitize_llm_response(llm_response: str) -> str:
+    """
+    This function sanitizes the LLM response generated. If the LLM response contains a sentence that has
+    "not found" or "Not found" within it, it returns only "not found" and no other characters. Case sensitivity does not matter.
+    """
+    string_to_match: str = "not found"
+    sanitized_response: Optional[str] = None
+    try:
+        # Normalize the case for comparison
+        normalized_response = llm_response.lower()
+        if llm_response is None:
+            sanitized_response: Optional[str] = None
+        # Check if the normalized response contains the string "not found"
+        if string_to_match in normalized_response:
+            sanitized_response = string_to_match
+        else:
+            sanitized_response = normalized_response
+    except Exception as e:
+        logger.error(f"The LLM response cannot be sanitized: {e}")
+        sanitized_response: Optional[str] = None
+    return sanitized_response
+
+
+def failed_hit_response(exception: Optional[Exception]) -> Dict:
+    """
+    Response of a hit whose LLM call could not be made or failed, with no completion, tokens or latency.
+    """
+    return {'exception': exception, 'completion': None, 'prompt_token_count': 0, 'completion_token_count': 0,
+            'time_taken_in_seconds': 0.0, 'input_token_cost': 0.0, 'output_token_cost': 0.0}
+
+
+class RAGQueryEngine:
+    """
+    Answers questions from the image and text indexes. The engine is safe to use from concurrent threads, and
+    keeps the total input and output tokens of the image and text indexes over all the questions it answered.
+    """
+
+    def __init__(self,
+                 config: Dict,
+                 img_index_name: str,
+                 text_index_name: str,
+                 prompt_templates: Dict[str, str],
+                 tracer: LatencyTracer,
+                 image_cache: S3ImageCache,
+                 completion_fn: Callable = completion,
+                 display_image: Optional[Callable[[bytes], None]] = None):
+        """
+        :param config: Merged config of the solution.
+        :param img_index_name: Name of the image index.
+        :param text_index_name: Name of the text index.
+        :param prompt_templates: Prompt templates keyed by their name in the dir_info section, see load_prompt_templates.
+        :param tracer: Latency tracer that records a span for every stage of each query.
+        :param image_cache: Cache of the images of the image index hits.
+        :param completion_fn: Function with the signature of the litellm `completion` function used for the hit level calls.
+        :param display_image: Function called with the bytes of each image hit that is used to answer a question,
+                              for example to display it in a notebook. The images are not fetched for display if not given.
+        """
+        self.config = config
+        self.img_index_name = img_index_name
+        self.text_index_name = text_index_name
+        self.direct_image_answer_retrieval_prompt: str = prompt_templates['search_in_images_template']
+        self.direct_text_answer_retrieval_prompt: str = prompt_templates['search_in_text_template']
+        self.multi_context_answer_prompt: str = prompt_templates['multi_context_answer_template']
+        self.tracer = tracer
+        self.image_cache = image_cache
+        self.completion = completion_fn
+        self.display_image = display_image
+        # total input and output tokens of the image and text indexes across the questions answered by the engine
+        self.token_totals: Dict[str, int] = {'image_input_tokens': 0, 'image_output_tokens': 0,
+                                             'text_input_tokens': 0, 'text_output_tokens': 0}
+        self._token_totals_lock = threading.Lock()
+        # the answer cache fingerprint, and the sizes and modification times of the files that it was computed from
+        self._answer_cache_fingerprint: Optional[Tuple[Tuple, str]] = None
+        self._answer_cache_fingerprint_lock = threading.Lock()
+
+    def find_similar_data_with_entities(self, text_embedding, size: int, os_client, index_name: str, question_entities: List[str],
+                                        prefiltering: bool, fuzzy: bool = False):
+        """
+        This function is used to prefilter the responses only with images/texts that have entities that match
+        with the entities provided in the question. Once the documents are refiltered, the search from the index
+        is returned. The question entities are normalized and matched exactly against the normalized entity terms
+        stored with each document, or with a fuzzy match if fuzzy is set.
+        """
+        inference_info: Dict = self.config['inference_info']
+        should_clauses: List[Dict] = []
+        minimum_should_match: int = inference_info['minimum_entities_to_match_from_question']
+        if prefiltering and inference_info.get('entity_match_mode', 'terms') == 'wildcard':
+            # Convert filter_string to lowercase to ensure case-insensitive matching
+            q_entities_lower: str = question_entities.lower()
+            q_entities_upper: str = question_entities.upper()
+            # entities can either be lower case or upper case. search for both cases is supported
+            question_entities_variants = [q_entities_lower, q_entities_upper]
+            logger.info(f"Entities extracted: {question_entities_variants}")
+            for word in question_entities_variants:
+                for entity in word.split(","):
+                    should_clauses.append({
+                        "wildcard": {
+                            "metadata.entities": {
+                                # wildcard queries are to search for terms that match a wildcard pattern
+                                # in this case, we are searching for an entity within the text embedding
+                                "value": f"*{entity.strip()}*",
+                                "case_insensitive": True
+                            }
+                        }
+                    })
+        elif prefiltering:
+            # each normalized question entity is looked up as an exact term (or a fuzzy term) in the entity terms
+            # of the documents, so the cost of the prefilter does not grow with the size of the term dictionary
+            entity_terms: List[str] = normalize_entities(question_entities)
+            logger.info(f"Entity terms extracted: {entity_terms}, fuzzy={fuzzy}")
+            for entity_term in entity_terms:
+                if fuzzy:
+                    should_clauses.append({"fuzzy": {"metadata.entity_terms": {"value": entity_term,
+                                                                              "fuzziness": inference_info.get('entity_fuzziness', 'AUTO')}}})
+                else:
+                    should_clauses.append({"term": {"metadata.entity_terms": entity_term}})
+            # a question with fewer entities than the minimum can still match on all of its entities
+            minimum_should_match = max(1, min(inference_info.get('minimum_entity_terms_to_match', 1), len(entity_terms)))
+        else:
+            logger.info("Prefiltering disabled")
+        query = {
+            "size": size,
+            "query": {
+                "bool": {
+                    "must": {
+                        "knn": {
+                            "vector_embedding": {
+                                "vector": text_embedding,
+                                "k": size
+                            }
+                        }
+                    },
+                    "filter": {
+                        "bool": {
+                            "should": should_clauses,
+                            # should match at least a single entity to fetch a response. Increase if there
+                            # is a lot being asked in the question
+                            "minimum_should_match": minimum_should_match
+                        }
+                    }
+                }
+            }
+        }
+        try:
+            content_based_search = os_client.search(body=query, index=index_name)
+        except Exception as e:
+            logger.error(f"error occured while querying OpenSearch index={index_name}, exception={e}")
+            content_based_search = None
+        return content_based_search
+
+    def _completion_response(self, prompt: str, content: List[Dict], model_id: str) -> Dict:
+        # call the model with the content of a single user message and extract the completion, token counts and latency
+        temperature = self.config['inference_parameters'].get('temperature', 0.1)
+        max_tokens = self.config['inference_parameters'].get('max_tokens', 500)
+        # suppress the litellm logger responses
+        logging.getLogger('LiteLLM').setLevel(logging.CRITICAL)
+        ret = {
+            "exception": None,
+            "prompt": prompt,
+            "completion": None,
+            "time_taken_in_seconds": None,
+            "completion_token_count": None,
+            "prompt_token_count": None,
+            "model_id": model_id,
+            "input_token_cost": None,
+            "output_token_cost": None,
+        }
+        try:
+            response = self.completion(
+                model=model_id,
+                messages=[{"role": "user", "content": content}],
+                temperature=temperature,
+                max_tokens=max_tokens
+            )
+            # iterate through the entire model response
+            for idx, choice in enumerate(response.choices):
+                # extract the message and the message's content from litellm
+                if choice.message and choice.message.content:
+                    # extract the response from the dict
+                    ret["completion"] = choice.message.content.strip()
+            # Extract number of input and completion prompt tokens (this is the same structure for embeddings and text generation models on Amazon Bedrock)
+            ret['prompt_token_count'] = response.usage.prompt_tokens
+            ret['completion_token_count'] = response.usage.completion_tokens
+            # Extract latency in seconds
+            ret['time_taken_in_seconds'] = response._response_ms / 1000
+        except Exception as e:
+            logger.error(f"exception={e}")
+            ret["exception"] = e
+        return ret
+
+    def get_nearest_img_search_response(self, nearest_image_path: str, prompt: str, modelId: str) -> Optional[Dict]:
+        """
+        This function takes in the file path that is most similar to the text embeddings
+        of the question, returns the image and checks for if the text description does not
+        contain the answer, directly search for the answer in the selected image.
+        """
+        logger.info(f"Nearest image path being used for search: {nearest_image_path}")
+        # get the image bytes from the image cache (they are prefetched as soon as the search results come back, and
+        # are the same bytes that are displayed) and encode them in memory, MAX image size supported is 2048 * 2048 pixels
+        try:
+            with self.tracer.span('image_load', image_path=nearest_image_path):
+                image = ImagePayload(nearest_image_path, data=self.image_cache.get_bytes(nearest_image_path))
+                input_image_b64 = image.b64
+        except Exception as e:
+            logger.error(f"Error encoding the image from the image cache to base64: {e}")
+            return None
+        content: List[Dict] = [
+            {"type": "text", "text": prompt},
+            {
+                "type": "image_url",
+                "image_url": {
+                    "url": f"data:{image.media_type};base64," + input_image_b64
+                },
+            },
+        ]
+        return self._completion_response(prompt, content, modelId)
+
+    def response_from_text_extracted(self, prompt: str, modelId: str) -> Dict:
+        """
+        This function takes in the prompt that checks whether the text file has a response to the question and if not,
+        returns "not found" to move to the next hit.
+        """
+        return self._completion_response(prompt, [{"type": "text", "text": prompt}], modelId)
+
+    def retrieve_hits(self,
+                      question: str,
+                      size: int,
+                      index_clients: List[Tuple[opensearchpy.client.OpenSearch, str]],
+                      bedrock,
+                      model_id: str,
+                      question_embedding: Optional[np.ndarray] = None) -> List[Tuple[str, str, str, float]]:
+        """
+        Plan the retrieval for a question once and search every index concurrently. The entities and the
+        embedding of the question are the same for every index, so they are computed once (in parallel). Pass
+        `question_embedding` if the question was already embedded, for example for the answer cache lookup.
+        Each index is searched with the exact entity terms prefilter first. The fuzzy prefilter (if enabled) and
+        then the search without the prefilter are only sent if the more selective searches returned fewer than
+        `size` hits, and their hits fill the remaining places. With speculative_fallback_search set, all the
+        searches of an index are sent together instead.
+        :return: List of tuples containing the file path, file text, index name and score of each hit, in index_clients order.
+        """
+        tracer = self.tracer
+
+        def extract_entities() -> str:
+            with tracer.span('entity_extraction'):
+                return get_question_entities(bedrock, question, model_id)
+
+        def embed_question() -> np.ndarray:
+            if question_embedding is not None:
+                return question_embedding
+            with tracer.span('embedding'):
+                return get_text_embedding(bedrock, question)
+
+        def search(os_client: opensearchpy.client.OpenSearch, index_name: str, variant: Dict) -> Dict:
+            with tracer.span('knn_search', index=index_name, **variant) as span:
+                response = self.find_similar_data_with_entities(text_embedding, size, os_client, index_name, question_entities, **variant)
+                span.set_attributes(hits=len(response.get('hits', {}).get('hits', [])) if response else 0)
+                return response
+
+        def search_index(os_client: opensearchpy.client.OpenSearch, index_name: str) -> List[Dict]:
+            # search with each query variant, from the most selective, until there are `size` distinct hits
+            if speculative:
+                with ThreadPoolExecutor(max_workers=len(query_variants)) as executor:
+                    responses = list(executor.map(tracer.wrap(lambda variant: search(os_client, index_name, variant)), query_variants))
+            else:
+                # the searches are sent lazily, so the less selective ones are not sent once there are enough hits
+                responses = (search(os_client, index_name, variant) for variant in query_variants)
+            hits: List[Dict] = []
+            file_paths = set()
+            for variant, vector_db_response in zip(query_variants, responses):
+                variant_hits = vector_db_response.get('hits', {}).get('hits', []) if vector_db_response else []
+                logger.info(f"{len(variant_hits)} hits from the {index_name} index with {variant}")
+                for hit in variant_hits:
+                    if len(hits) < size and hit['_source']['file_path'] not in file_paths:
+                        file_paths.add(hit['_source']['file_path'])
+                        hits.append(hit)
+                if len(hits) >= size:
+                    break
+            return hits
+
+        # tracer.wrap makes the spans of the worker threads children of the span of the query
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            question_entities_future = executor.submit(tracer.wrap(extract_entities))
+            text_embedding_future = executor.submit(tracer.wrap(embed_question))
+            question_entities = question_entities_future.result()
+            text_embedding = text_embedding_future.result()
+        logger.info(f"Searching for the answer in the {[index_name for _, index_name in index_clients]} indexes")
+        # the prefiltered query, the fuzzy prefiltered query (if enabled) and the fallback (no prefilter) query, from
+        # the most to the least selective. The fuzzy query is only used with the exact entity terms match
+        inference_info: Dict = self.config['inference_info']
+        use_fuzzy: bool = inference_info.get('entity_match_mode', 'terms') == 'terms' and inference_info.get('entity_fuzzy_fallback', False) is True
+        speculative: bool = inference_info.get('speculative_fallback_search', False) is True
+        query_variants: List[Dict] = [{'prefiltering': True, 'fuzzy': False}]
+        if use_fuzzy:
+            query_variants.append({'prefiltering': True, 'fuzzy': True})
+        query_variants.append({'prefiltering': False, 'fuzzy': False})
+        with ThreadPoolExecutor(max_workers=len(index_clients)) as executor:
+            index_hits = list(executor.map(tracer.wrap(lambda index_client: search_index(*index_client)), index_clients))
+        all_hits: List[Tuple[str, str, str, float]] = []
+        for (_, index_name), hits in zip(index_clients, index_hits):
+            all_hits.extend([(hit['_source']['file_path'], hit['_source']['file_text'], index_name, hit.get('_score')) for hit in hits])
+        return all_hits
+
+    def answer_from_hit(self, question: str, content_path: str, extracted_text: str, index_name: str, model_id: str) -> Dict:
+        """
+        Search for the answer to the question in a single hit. For the image index, the answer is searched in the
+        image description and if not, directly in the image. For the text index, it is searched in the extracted text.
+        :return: Dictionary with the model response, token counts and costs, and the sanitized response.
+        """
+        with self.tracer.span('hit_llm_call', index=index_name, content_path=content_path) as span:
+            if index_name == self.img_index_name:
+                search_in_img_prompt = self.direct_image_answer_retrieval_prompt.format(context=extracted_text, question=question)
+                hit_response = self.get_nearest_img_search_response(content_path, search_in_img_prompt, model_id)
+            else:
+                search_in_txt_prompt = self.direct_text_answer_retrieval_prompt.format(context=extracted_text, question=question)
+                hit_response = self.response_from_text_extracted(search_in_txt_prompt, model_id)
+            if hit_response is None:
+                # the image could not be loaded, so the hit is answered as a failed call
+                hit_response = failed_hit_response(None)
+            # a failed call has no token counts or latency, and counts as zero
+            hit_response['prompt_token_count'] = hit_response.get('prompt_token_count') or 0
+            hit_response['completion_token_count'] = hit_response.get('completion_token_count') or 0
+            hit_response['time_taken_in_seconds'] = hit_response.get('time_taken_in_seconds') or 0.0
+            # calculate the input and output token pricing
+            eval_model_info: Dict = self.config['model_info']['eval_model_info']
+            hit_response['input_token_cost'] = (hit_response['prompt_token_count']/1000) * eval_model_info.get('input_tokens_price')
+            hit_response['output_token_cost'] = (hit_response['completion_token_count']/1000) * eval_model_info.get('output_tokens_price')
+            # sanitize the response if the response contains "not found". A hit whose call failed is dropped like a
+            # hit that does not have the answer
+            if hit_response['completion'] is None:
+                hit_response['sanitized_response'] = "not found"
+            else:
+                hit_response['sanitized_response'] = sanitize_llm_response(hit_response['completion'])
+            span.set_attributes(input_tokens=hit_response['prompt_token_count'],
+                                output_tokens=hit_response['completion_token_count'],
+                                input_token_cost=hit_response['input_token_cost'],
+                                output_token_cost=hit_response['output_token_cost'],
+                                answered=hit_response['sanitized_response'] != "not found")
+        return hit_response
+
+    def answer_hits_in_rank_order(self, question: str, all_hits: List[Tuple[str, str, str, float]], model_id: str,
+                                  discarded: Optional[List[Tuple[Tuple, Future]]] = None) -> Iterator[Tuple[Tuple, Dict]]:
+        """
+        Yield each hit with its answer, in rank order. In the concurrent mode, the calls for the next hits are sent
+        while the answer of the current hit is awaited, so the time taken is close to that of the slowest call that is
+        needed instead of the sum of all the calls. Only min_answers_before_stopping + hit_call_lookahead calls are in
+        flight at a time (max_concurrent_hit_calls if summarize_all_hits is set), so the calls of the hits after that
+        are only sent if the search has not stopped. With the default config (sequential mode) no call is ever
+        discarded. The calls still in flight when the caller stops iterating are not cancelled, they are appended
+        with their hit to `discarded` so that the caller can account for their tokens.
+        """
+        hit_inference_info: Dict = self.config['other_inference_and_eval_metrics']
+        if hit_inference_info.get('hit_inference_mode', 'sequential') != 'concurrent' or len(all_hits) <= 1:
+            for content_path, extracted_text, index_name, score in all_hits:
+                yield (content_path, extracted_text, index_name, score), self.answer_from_hit(question, content_path, extracted_text, index_name, model_id)
+            return
+        max_in_flight: int = hit_inference_info.get('max_concurrent_hit_calls', 8)
+        if hit_inference_info.get('summarize_all_hits', False) is False:
+            max_in_flight = min(max_in_flight, hit_inference_info.get('min_answers_before_stopping', 1) + hit_inference_info.get('hit_call_lookahead', 1))
+        max_in_flight = max(1, min(max_in_flight, len(all_hits)))
+        executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        futures: List[Future] = []
+        answered: int = 0
+        try:
+            for hit_number, hit in enumerate(all_hits):
+                # keep max_in_flight calls in flight, starting from the hit whose answer is awaited
+                while len(futures) < min(hit_number + max_in_flight, len(all_hits)):
+                    content_path, extracted_text, index_name, _ = all_hits[len(futures)]
+                    futures.append(executor.submit(self.tracer.wrap(self.answer_from_hit), question, content_path, extracted_text, index_name, model_id))
+                try:
+                    hit_response = futures[hit_number].result()
+                except Exception as e:
+                    # a hit that fails is dropped, the other hits still answer the question
+                    logger.error(f"the answer from the hit {hit[0]} failed: {e}")
+                    hit_response = failed_hit_response(e)
+                    hit_response['sanitized_response'] = "not found"
+                answered = hit_number + 1
+                yield hit, hit_response
+        finally:
+            # the calls in flight finish in the background, their responses are not used to answer the question
+            for hit, future in zip(all_hits[answered:], futures[answered:]):
+                if not future.cancel() and discarded is not None:
+                    discarded.append((hit, future))
+            executor.shutdown(wait=False)
+
+    def get_multi_context_response(self,
+                                   question: str,
+                                   all_hits: List[Tuple[str, str, str, float]],
+                                   model_id: str,
+                                   on_token: Optional[Callable[[str], None]] = None) -> Dict:
+        """
+        Answer the question from the contexts of the top hits in a single LLM call. The hits are ranked by their score
+        and packed into the prompt until the token budget in multi_context_answer_info is reached, along with the images
+        of up to max_images image hits. The answer cites the source ids of the contexts that it is based on. If `on_token`
+        is given, the answer is streamed and `on_token` is called with each piece of text as it arrives.
+        :return: Dictionary with the model response, token counts, the packed contexts and the cited contexts.
+        """
+        multi_context_info: Dict = self.config['multi_context_answer_info']
+        packed: List[Dict] = pack_contexts(all_hits,
+                                           token_budget=multi_context_info.get('token_budget', 6000),
+                                           image_index_name=self.img_index_name,
+                                           max_images=multi_context_info.get('max_images', 0),
+                                           tokens_per_image=multi_context_info.get('tokens_per_image', 1600),
+                                           chars_per_token=multi_context_info.get('chars_per_token', 4.0))
+        prompt: str = self.multi_context_answer_prompt.format(contexts=format_contexts(packed), question=question)
+        content: List[Dict] = [{"type": "text", "text": prompt}]
+        # the images are sent after the prompt, each one preceded by the id of its source
+        for context in packed:
+            if not context['with_image']:
+                continue
+            try:
+                with self.tracer.span('image_load', image_path=context['file_path']):
+                    image = ImagePayload(context['file_path'], data=self.image_cache.get_bytes(context['file_path']))
+                    content.append({"type": "text", "text": f"Image of [{context['source_id']}]:"})
+                    content.append({"type": "image_url", "image_url": {"url": f"data:{image.media_type};base64," + image.b64}})
+            except Exception as e:
+                logger.error(f"Error encoding the image of {context['file_path']}, it is not sent with the prompt: {e}")
+        if on_token is None:
+            ret: Dict = self._completion_response(prompt, content, model_id)
+        else:
+            ret = {"exception": None, "prompt": prompt, "completion": None, "completion_token_count": None,
+                   "prompt_token_count": None, "model_id": model_id, "time_taken_in_seconds": None}
+            try:
+                ret.update(stream_completion(self.completion, model_id, [{"role": "user", "content": content}], on_token,
+                                             temperature=self.config['inference_parameters'].get('temperature', 0.1),
+                                             max_tokens=self.config['inference_parameters'].get('max_tokens', 500)))
+            except Exception as e:
+                logger.error(f"exception={e}")
+                ret["exception"] = e
+        ret.setdefault("time_to_first_token_in_seconds", None)
+        ret['packed_contexts'] = packed
+        ret['cited_contexts'] = cited_sources(ret['completion'], packed)
+        return ret
+
+    def get_answer_cache_fingerprint(self) -> str:
+        """
+        Fingerprint of everything that the answer to a question depends on other than the question: the
+        ingestion manifests (which change when content is ingested), the prompt templates and the inference
+        settings. Cached answers are dropped when it changes. The files are only hashed again when their size
+        or modification time changes, so a query only pays for a few stat calls.
+        """
+        config: Dict = self.config
+        manifest_info: Dict = config['ingestion_manifest_info']
+        manifest_paths: List[str] = [os.path.join(manifest_info['manifest_dir'], manifest_info[name])
+                                     for name in ('image_ingestion_manifest', 'text_ingestion_manifest')]
+        prompt_paths: List[Path] = sorted(p for p in Path(config['dir_info']['prompt_dir']).glob('*') if p.is_file())
+
+        def file_state(path: str) -> Optional[Tuple[int, int]]:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                return None
+            return stat.st_size, stat.st_mtime_ns
+
+        files_state: Tuple = tuple((str(p), file_state(str(p))) for p in [*manifest_paths, *prompt_paths])
+        with self._answer_cache_fingerprint_lock:
+            if self._answer_cache_fingerprint is not None and self._answer_cache_fingerprint[0] == files_state:
+                return self._answer_cache_fingerprint[1]
+            fingerprint: str = make_fingerprint(manifests={p: hash_file(p) if os.path.exists(p) else None for p in manifest_paths},
+                                                prompts={p.name: hash_file(str(p)) for p in prompt_paths},
+                                                model_info=config['model_info']['inference_model_info'],
+                                                inference_info=config['inference_info'],
+                                                other_inference_info=config['other_inference_and_eval_metrics'],
+                                                vector_store_info=config['vector_store_info'])
+            self._answer_cache_fingerprint = (files_state, fingerprint)
+            return fingerprint
+
+    def _show_image(self, content_path: str) -> None:
+        # fetch an image hit that is used in the answer and pass it to display_image, if set
+        if self.display_image is not None:
+            with self.tracer.span('image_fetch', content_path=content_path):
+                self.display_image(self.image_cache.get_bytes(content_path))
+
+    def get_index_response(self,
+                           question: str,
+                           size: int,
+                           index_clients: List[Tuple[opensearchpy.client.OpenSearch, str]],
+                           answer_mode: Optional[str] = None,
+                           on_token: Optional[Callable[[str], None]] = None,
+                           use_answer_cache: bool = True) -> Optional[Dict]:
+        """
+        Get LLM responses from retrieved data on questions asked from image, text, or both indexes combined.
+        :param question: Question that a user asks on the content.
+        :param size: 'k' size.
+        :param index_clients: List of tuples containing OpenSearch clients and index names.
+        :param answer_mode: 'per_hit' to ask the LLM to answer from each hit and combine the answers in a final call, or
+                            'multi_context' to answer from the packed contexts of the top hits in a single call. Defaults
+                            to the answer_mode in the config file.
+        :param on_token: If given, the answer of the final LLM call is streamed and `on_token` is called with each piece
+                         of text as it arrives. A cached answer is passed to it in one piece. See stream_index_response.
+        :param use_answer_cache: Set to False to always answer the question from the indexes, for example to measure
+                                 the token counts and latencies of every question in an evaluation.
+        :return: Dictionary with the context used to answer the question and the final response. The response is
+                 returned from the semantic answer cache if a similar question was already answered, with `cache_hit`
+                 set, no tokens and the latency of the cache lookup.
+        """
+        config: Dict = self.config
+        tracer = self.tracer
+        index_llm_response_and_context = {'source': ''}
+        model_id = config['model_info']['inference_model_info'].get('model_id')
+        # Initialize latency counters
+        total_image_latency: int = 0.0
+        total_text_latency: int = 0.0
+        # Initialize the token counters for this question
+        image_input_tokens: int = 0
+        image_output_tokens: int = 0
+        text_input_tokens: int = 0
+        text_output_tokens: int = 0
+        hit_inference_info: Dict = config['other_inference_and_eval_metrics']
+        answer_mode = answer_mode or hit_inference_info.get('answer_mode', 'per_hit')
+
+        try:
+            # every stage of the query is recorded as a child span of the query span
+            with tracer.span('query', question=question, indexes=[index_name for _, index_name in index_clients], k=size,
+                             answer_mode=answer_mode) as query_span:
+                bedrock = get_bedrock_runtime_client()
+                logger.info(f"Going to answer the question: {question}")
+                # answer the question from the semantic answer cache if the same or a very similar question
+                # was already asked against these indexes
+                answer_cache = get_answer_cache() if use_answer_cache else None
+                question_embedding: Optional[np.ndarray] = None
+                if answer_cache is not None:
+                    answer_cache_scope: str = f"k={size}, indexes={[index_name for _, index_name in index_clients]}, mode={answer_mode}"
+                    lookup_start: float = time.perf_counter()
+                    with tracer.span('answer_cache_lookup') as cache_span:
+                        answer_cache_fingerprint: str = self.get_answer_cache_fingerprint()
+                        question_embedding = get_text_embedding(bedrock, question)
+                        cached_response = answer_cache.get(question_embedding, answer_cache_scope, answer_cache_fingerprint) \
+                                          if question_embedding is not None else None
+                        cache_span.set_attributes(cache_hit=cached_response is not None)
+                    if cached_response is not None:
+                        # no tokens are spent on a cached answer, and its latency is the time taken by the lookup
+                        lookup_seconds: float = time.perf_counter() - lookup_start
+                        cached_response = {**cached_response,
+                                           'cache_hit': True,
+                                           'image_input_tokens': 0,
+                                           'image_output_tokens': 0,
+                                           'text_input_tokens': 0,
+                                           'text_output_tokens': 0,
+                                           'total_input_tokens': 0,
+                                           'total_output_tokens': 0,
+                                           'total_image_latency': 0.0,
+                                           'total_text_latency': 0.0,
+                                           'total_combined_latency': lookup_seconds,
+                                           'time_to_first_token': lookup_seconds if on_token is not None else None}
+                        query_span.set_attributes(cache_hit=True, input_tokens=0, output_tokens=0)
+                        if on_token is not None and cached_response.get('response'):
+                            on_token(cached_response['response'])
+                        return cached_response
+                # get the entities and the embedding of the user question once, and search all the indexes
+                # concurrently, using the entities as a prefilter to get the most relevant documents
+                # the embedding of the question for the answer cache lookup, if any, is reused for the knn search
+                all_hits = self.retrieve_hits(question, size, index_clients, bedrock, model_id, question_embedding)
+                # start downloading the images of all the image hits at once, they are needed both for the
+                # multimodal LLM calls and for displaying them
+                self.image_cache.prefetch([content_path for content_path, _, index_name, _ in all_hits
+                                           if index_name == self.img_index_name])
+                if answer_mode == 'multi_context':
+                    # answer the question from the contexts of the top hits, ranked by score and packed under the token
+                    # budget, in a single LLM call instead of one call per hit and a final call to combine the answers
+                    with tracer.span('multi_context_llm_call') as multi_context_span:
+                        multi_context_response = self.get_multi_context_response(question, all_hits, model_id, on_token)
+                    packed_contexts: List[Dict] = multi_context_response['packed_contexts']
+                    cited_contexts: List[Dict] = multi_context_response['cited_contexts']
+                    index_llm_response_and_context['source'] = format_contexts(packed_contexts)
+                    index_llm_response_and_context['sources'] = [context['file_path'] for context in cited_contexts]
+                    answers_found: int = len(cited_contexts)
+                    # the tokens and latency of the single call are split between the image and text indexes by their share
+                    # of the packed contexts, so the per index totals stay comparable with the per hit mode
+                    packed_tokens: int = sum(context['tokens'] for context in packed_contexts)
+                    image_share: float = sum(context['tokens'] for context in packed_contexts
+                                             if context['index_name'] == self.img_index_name) / packed_tokens if packed_tokens else 0.0
+                    prompt_token_count: int = multi_context_response['prompt_token_count'] or 0
+                    completion_token_count: int = multi_context_response['completion_token_count'] or 0
+                    call_seconds: float = multi_context_response['time_taken_in_seconds'] or 0.0
+                    image_input_tokens = round(prompt_token_count * image_share)
+                    text_input_tokens = prompt_token_count - image_input_tokens
+                    image_output_tokens = round(completion_token_count * image_share)
+                    text_output_tokens = completion_token_count - image_output_tokens
+                    total_image_latency = call_seconds * image_share
+                    total_text_latency = call_seconds - total_image_latency
+                    inference_model_info: Dict = config['model_info']['inference_model_info']
+                    time_to_first_token: Optional[float] = multi_context_response['time_to_first_token_in_seconds']
+                    multi_context_span.set_attributes(packed_contexts=len(packed_contexts),
+                                                      cited_contexts=answers_found,
+                                                      input_tokens=prompt_token_count,
+                                                      output_tokens=completion_token_count,
+                                                      input_token_cost=(prompt_token_count/1000) * inference_model_info.get('input_token_price'),
+                                                      output_token_cost=(completion_token_count/1000) * inference_model_info.get('output_token_price'),
+                                                      time_to_first_token_ms=time_to_first_token * 1000 if time_to_first_token is not None else None)
+                    # display the images of the image index sources that the answer cites
+                    for context in cited_contexts:
+                        if context['index_name'] == self.img_index_name:
+                            self._show_image(context['file_path'])
+                    # the single call is accounted for in the image and text totals
+                    index_llm_response = {'completion': multi_context_response['completion'],
+                                          'prompt_token_count': 0,
+                                          'completion_token_count': 0,
+                                          'time_taken_in_seconds': 0.0}
+                else:
+                    logger.info(f"Iterating through all relevant hits to search for an answer....")
+
+                    # iterate through each of the content fetched from the vectorDB, in rank order. The answers from the hits
+                    # are computed concurrently if the hit_inference_mode is concurrent, and the search stops once
+                    # min_answers_before_stopping hits have answered the question (unless summarize_all_hits is set)
+                    answers_found: int = 0
+                    discarded_hit_calls: List[Tuple[Tuple, Future]] = []
+                    hit_answers = self.answer_hits_in_rank_order(question, all_hits, model_id, discarded_hit_calls)
+                    for (content_path, extracted_text, index_name, _), hit_response in hit_answers:
+                        file_text = ""
+                        sanitized_response = hit_response['sanitized_response']
+                        # for the image index, display each image that is used in the search and
+                        # retrieve the response to the user question
+                        if index_name == self.img_index_name:
+                            self._show_image(content_path)
+                            # record the latency for image search
+                            total_image_latency += hit_response['time_taken_in_seconds']
+                            logger.info(f"latency recorded at this image index iteration: {total_image_latency}")
+                            # update the image input and output tokens
+                            image_input_tokens += hit_response['prompt_token_count']
+                            image_output_tokens += hit_response['completion_token_count']
+                            logger.info(f"current img input and output tokens: {image_input_tokens}, {image_output_tokens}")
+
+                        # for the text index
+                        elif index_name == self.text_index_name:
+                            # record the latency for the text search
+                            total_text_latency += hit_response['time_taken_in_seconds']
+                            logger.info(f"latency recorded at this image index iteration: {total_text_latency}")
+                            # update the text input and output tokens
+                            text_input_tokens += hit_response['prompt_token_count']
+                            text_output_tokens += hit_response['completion_token_count']
+                            logger.info(f"current text input and output tokens: {text_input_tokens}, {text_output_tokens}")
+                        # if the response is found, then append the answer to the context for the final LLM call
+                        if sanitized_response != "not found":
+                            logger.info(f"Response FOUND from the {index_name} index {content_path}")
+                            file_text += sanitized_response
+                            index_llm_response_and_context['source'] += file_text
+                            answers_found += 1
+                            if hit_inference_info.get('summarize_all_hits', False) is False and \
+                               answers_found >= hit_inference_info.get('min_answers_before_stopping', 1):
+                                logger.info(f"{answers_found} answer(s) found, exiting out of the search process.")
+                                break
+                    hit_answers.close()
+                    # get the final response from a final LLM call from all iterations
+                    with tracer.span('final_llm_call') as final_span:
+                        index_llm_response = get_llm_response(question, index_llm_response_and_context['source'], model_id, on_token)
+                        time_to_first_token: Optional[float] = index_llm_response.get('time_to_first_token_in_seconds')
+                        inference_model_info: Dict = config['model_info']['inference_model_info']
+                        if index_llm_response['prompt_token_count'] is not None:
+                            final_span.set_attributes(input_tokens=index_llm_response['prompt_token_count'],
+                                                      output_tokens=index_llm_response['completion_token_count'],
+                                                      input_token_cost=(index_llm_response['prompt_token_count']/1000) * inference_model_info.get('input_token_price'),
+                                                      output_token_cost=(index_llm_response['completion_token_count']/1000) * inference_model_info.get('output_token_price'),
+                                                      time_to_first_token_ms=time_to_first_token * 1000 if time_to_first_token is not None else None)
+                    # the hit calls that were in flight when the search stopped finished during the final LLM call. Their
+                    # answers are not used but their tokens are paid for, so they are added to the token counts
+                    for (_, _, index_name, _), future in discarded_hit_calls:
+                        try:
+                            hit_response = future.result()
+                        except Exception as e:
+                            logger.error(f"a discarded hit call failed: {e}")
+                            continue
+                        if index_name == self.img_index_name:
+                            image_input_tokens += hit_response['prompt_token_count']
+                            image_output_tokens += hit_response['completion_token_count']
+                        elif index_name == self.text_index_name:
+                            text_input_tokens += hit_response['prompt_token_count']
+                            text_output_tokens += hit_response['completion_token_count']
+                    if discarded_hit_calls:
+                        logger.info(f"{len(discarded_hit_calls)} hit call(s) in flight were discarded, their tokens are counted")
+                # add the token counts of this question to the totals of the engine
+                with self._token_totals_lock:
+                    self.token_totals['image_input_tokens'] += image_input_tokens
+                    self.token_totals['image_output_tokens'] += image_output_tokens
+                    self.token_totals['text_input_tokens'] += text_input_tokens
+                    self.token_totals['text_output_tokens'] += text_output_tokens
+                index_llm_response_and_context.update({
+                    'cache_hit': False,
+                    'response': index_llm_response['completion'],
+                    'image_input_tokens': image_input_tokens,
+                    'image_output_tokens': image_output_tokens,
+                    'text_input_tokens': text_input_tokens,
+                    'text_output_tokens': text_output_tokens,
+                    'total_input_tokens': (image_input_tokens + text_input_tokens + (index_llm_response['prompt_token_count'] or 0)),
+                    'total_output_tokens': (image_output_tokens + text_output_tokens + (index_llm_response['completion_token_count'] or 0)),
+                    'total_image_latency': total_image_latency,
+                    'total_text_latency': total_text_latency,
+                    'total_combined_latency': ((index_llm_response['time_taken_in_seconds'] or 0.0) + total_image_latency + total_text_latency),
+                    # seconds from the start of the final LLM call to its first token, when the answer is streamed
+                    'time_to_first_token': time_to_first_token
+                })
+                query_span.set_attributes(cache_hit=False,
+                                          answers_found=answers_found,
+                                          input_tokens=index_llm_response_and_context['total_input_tokens'],
+                                          output_tokens=index_llm_response_and_context['total_output_tokens'])
+                if answer_cache is not None and question_embedding is not None and index_llm_response['completion'] is not None:
+                    answer_cache.put(question_embedding, answer_cache_scope, answer_cache_fingerprint, index_llm_response_and_context, question)
+        except Exception as e:
+            logger.error(f"Could not get a response: {e}")
+            index_llm_response_and_context = None
+        return index_llm_response_and_context
+
+    def stream_index_response(self,
+                              question: str,
+                              size: int,
+                              index_clients: List[Tuple[opensearchpy.client.OpenSearch, str]],
+                              answer_mode: Optional[str] = None,
+                              use_answer_cache: bool = True) -> TokenStream:
+        """
+        Streaming variant of get_index_response. Iterate over the returned stream to get the tokens of the final answer
+        as they arrive, then read its `result` for the same dictionary as get_index_response, with the token counts,
+        costs and latencies of the question.
+        """
+        return TokenStream(lambda on_token: self.get_index_response(question, size, index_clients, answer_mode, on_token, use_answer_cache))
@@ -0,0 +1,245 @@
+"""
+Concurrent transfers between a local directory and S3. Listings are paginated so that prefixes with
+more than 1,000 objects are synced completely, uploads and downloads run on a bounded thread pool with
+multipart transfers for large objects, and objects that match the local copy are skipped: an object matches
+if it has the size of the local file and either the ETag computed from the file, or (for a downloaded multipart
+object) the LastModified time that is set as the modification time of the file when it is downloaded. The
+number of bytes transferred and the throughput in bytes/sec are recorded for each direction.
+"""
+import os
+import time
+import boto3
+import hashlib
+import logging
+import threading
+from datetime import datetime
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from boto3.s3.transfer import TransferConfig
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# size of the blocks read while computing the ETag of a local file
+_ETAG_BLOCK_SIZE: int = 1024 * 1024
+
+UPLOAD: str = "upload"
+DOWNLOAD: str = "download"
+
+
+def compute_etag(file_path: str, multipart_threshold: int, multipart_chunksize: int) -> str:
+    """
+    Return the ETag that S3 assigns to the file when it is uploaded with the given multipart settings: the
+    MD5 of the contents for a single part upload, and the MD5 of the part MD5s followed by the number of
+    parts for a multipart upload.
+    """
+    if os.path.getsize(file_path) < multipart_threshold:
+        md5 = hashlib.md5()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(_ETAG_BLOCK_SIZE), b''):
+                md5.update(block)
+        return md5.hexdigest()
+    part_digests: List[bytes] = []
+    with open(file_path, 'rb') as f:
+        for part in iter(lambda: f.read(multipart_chunksize), b''):
+            part_digests.append(hashlib.md5(part).digest())
+    return f"{hashlib.md5(b''.join(part_digests)).hexdigest()}-{len(part_digests)}"
+
+
+class TransferStats:
+    """
+    Thread safe counters of the files transferred, skipped and failed in one direction. The throughput
+    is the number of bytes transferred over the time from the first transfer started to the last one finished.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.transferred: int = 0
+        self.skipped: int = 0
+        self.failed: int = 0
+        self.bytes: int = 0
+        self._first_start: Optional[float] = None
+        self._last_end: Optional[float] = None
+
+    def start(self) -> None:
+        with self._lock:
+            if self._first_start is None:
+                self._first_start = time.perf_counter()
+
+    def record(self, outcome: str, n_bytes: int = 0) -> None:
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+            self.bytes += n_bytes
+            self._last_end = time.perf_counter()
+
+    def summary(self) -> Dict:
+        with self._lock:
+            seconds = self._last_end - self._first_start if self._first_start is not None and self._last_end is not None else 0.0
+            return {'transferred': self.transferred,
+                    'skipped': self.skipped,
+                    'failed': self.failed,
+                    'bytes': self.bytes,
+                    'seconds': round(seconds, 3),
+                    'bytes_per_second': round(self.bytes / seconds, 1) if seconds > 0 else None}
+
+
+class S3TransferManager:
+    """
+    Uploads and downloads files over a pooled S3 client and a bounded thread pool. Each transfer of an
+    object larger than `multipart_threshold_mb` is split into parts of `multipart_chunksize_mb`, with up
+    to `max_concurrency_per_object` parts in flight.
+    """
+
+    def __init__(self,
+                 max_workers: int = 16,
+                 multipart_threshold_mb: float = 8,
+                 multipart_chunksize_mb: float = 8,
+                 max_concurrency_per_object: int = 4,
+                 skip_unchanged: bool = True,
+                 s3_client=None):
+        """
+        :param max_workers: Number of objects transferred at the same time.
+        :param multipart_threshold_mb: Size above which objects are transferred in parts.
+        :param multipart_chunksize_mb: Size of each part of a multipart transfer.
+        :param max_concurrency_per_object: Number of parts of one object transferred at the same time.
+        :param skip_unchanged: Skip the objects that match the local file, see is_unchanged.
+        :param s3_client: S3 client to use, a client with a connection pool sized for the transfers is created if not given.
+        """
+        self.multipart_threshold = int(multipart_threshold_mb * 1024 * 1024)
+        self.multipart_chunksize = int(multipart_chunksize_mb * 1024 * 1024)
+        self.skip_unchanged = skip_unchanged
+        self._s3 = s3_client if s3_client is not None else \
+                   boto3.client('s3', config=Config(max_pool_connections=max_workers * max_concurrency_per_object,
+                                                    retries={'mode': 'standard'}))
+        self._transfer_config = TransferConfig(multipart_threshold=self.multipart_threshold,
+                                               multipart_chunksize=self.multipart_chunksize,
+                                               max_concurrency=max_concurrency_per_object)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='s3-transfer')
+        self._stats: Dict[str, TransferStats] = {UPLOAD: TransferStats(), DOWNLOAD: TransferStats()}
+
+    def list_objects(self, bucket: str, prefix: str, suffix: Optional[str] = None) -> Iterator[Dict]:
+        """
+        Yield every object under the prefix, across all the pages of the listing, optionally only the
+        objects whose key ends with `suffix`.
+        """
+        paginator = self._s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                if suffix is None or obj['Key'].endswith(suffix):
+                    yield obj
+
+    def is_unchanged(self, local_path: str, size: int, etag: str, last_modified: Optional[datetime] = None) -> bool:
+        """
+        Return True if the local file has the given size, and either the given ETag or, for a multipart object,
+        a modification time equal to `last_modified`. The ETag of a multipart object depends on the part size it
+        was uploaded with, so an object uploaded with other settings does not match the computed ETag, while the
+        modification time of a downloaded file is set to the LastModified time of its object (see download_file).
+        """
+        if not os.path.exists(local_path) or os.path.getsize(local_path) != size:
+            return False
+        etag = etag.strip('"')
+        if '-' in etag and last_modified is not None and int(os.path.getmtime(local_path)) == int(last_modified.timestamp()):
+            return True
+        return compute_etag(local_path, self.multipart_threshold, self.multipart_chunksize) == etag
+
+    def download_file(self, bucket: str, key: str, local_path: str, size: Optional[int] = None, etag: Optional[str] = None,
+                      last_modified: Optional[datetime] = None) -> bool:
+        """
+        Download an object, unless the local file already matches it (see is_unchanged). The modification time of
+        the downloaded file is set to `last_modified`, the LastModified time of the object, if it is given.
+        :return: True if the local file is up to date, False if the download failed.
+        """
+        stats = self._stats[DOWNLOAD]
+        stats.start()
+        try:
+            if self.skip_unchanged and size is not None and etag is not None and self.is_unchanged(local_path, size, etag, last_modified):
+                logger.info(f"{local_path} is unchanged from {bucket}/{key}, skipping the download")
+                stats.record('skipped')
+                return True
+            self._s3.download_file(bucket, key, local_path, Config=self._transfer_config)
+            if last_modified is not None:
+                os.utime(local_path, (last_modified.timestamp(), last_modified.timestamp()))
+            stats.record('transferred', os.path.getsize(local_path))
+            logger.info(f"downloaded {bucket}/{key} to {local_path}")
+            return True
+        except Exception as e:
+            logger.error(f"error downloading {bucket}/{key} from S3: {e}")
+            stats.record('failed')
+            return False
+
+    def upload_file(self, local_path: str, bucket: str, key: str) -> bool:
+        """
+        Upload a file, unless the object already has the size of the file and the ETag computed from it.
+        :return: True if the object is up to date, False if the upload failed.
+        """
+        stats = self._stats[UPLOAD]
+        stats.start()
+        try:
+            if self.skip_unchanged:
+                try:
+                    head = self._s3.head_object(Bucket=bucket, Key=key)
+                    if self.is_unchanged(local_path, head['ContentLength'], head['ETag']):
+                        logger.info(f"{bucket}/{key} is unchanged from {local_path}, skipping the upload")
+                        stats.record('skipped')
+                        return True
+                except ClientError as e:
+                    if e.response.get('Error', {}).get('Code') not in ('404', 'NoSuchKey', 'NotFound'):
+                        raise
+            self._s3.upload_file(local_path, bucket, key, Config=self._transfer_config)
+            stats.record('transferred', os.path.getsize(local_path))
+            logger.info(f"File {local_path} uploaded to {bucket}/{key}.")
+            return True
+        except Exception as e:
+            logger.error(f"error uploading {local_path} to S3: {e}")
+            stats.record('failed')
+            return False
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        """
+        Run `fn` on the transfer thread pool, for example an upload that also updates a manifest.
+        """
+        return self._executor.submit(fn, *args, **kwargs)
+
+    def download_prefix(self, bucket: str, prefix: str, local_dir: str, suffix: Optional[str] = None) -> List[str]:
+        """
+        Download every object under the prefix (optionally only those whose key ends with `suffix`) into
+        `local_dir`, named after the last part of the key.
+        :return: Paths of the local files that are up to date with S3, in listing order.
+        """
+        os.makedirs(local_dir, exist_ok=True)
+        st = time.perf_counter()
+        futures: List[Tuple[str, Future]] = []
+        for obj in self.list_objects(bucket, prefix, suffix):
+            local_path = os.path.join(local_dir, os.path.basename(obj['Key']))
+            futures.append((local_path, self.submit(self.download_file, bucket, obj['Key'], local_path,
+                                                       obj['Size'], obj['ETag'], obj['LastModified'])))
+        local_paths: List[str] = [local_path for local_path, future in futures if future.result()]
+        logger.info(f"{len(local_paths)}/{len(futures)} objects under {bucket}/{prefix} are in {local_dir} "
+                    f"after {time.perf_counter() - st:.2f}s, download stats: {self._stats[DOWNLOAD].summary()}")
+        return local_paths
+
+    def upload_files(self, local_paths: List[str], bucket: str, prefix: str) -> List[str]:
+        """
+        Upload the files under the prefix, named after their file names.
+        :return: Keys of the objects that are up to date with the local files.
+        """
+        st = time.perf_counter()
+        keys: List[str] = [os.path.join(prefix, os.path.basename(local_path)) for local_path in local_paths]
+        futures: List[Future] = [self.submit(self.upload_file, local_path, bucket, key) for local_path, key in zip(local_paths, keys)]
+        uploaded_keys: List[str] = [key for key, future in zip(keys, futures) if future.result()]
+        logger.info(f"{len(uploaded_keys)}/{len(keys)} files are in {bucket}/{prefix} after {time.perf_counter() - st:.2f}s, "
+                    f"upload stats: {self._stats[UPLOAD].summary()}")
+        return uploaded_keys
+
+    def stats(self) -> Dict[str, Dict]:
+        """
+        Return the transfer counters and throughput of the uploads and the downloads.
+        """
+        return {direction: stats.summary() for direction, stats in self._stats.items()}
+
+    def close(self) -> None:
+        """
+        Wait for the transfers in flight and stop the transfer threads.
+        """
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,419 @@
+"""
+Local stand-ins for the services that the ingestion and inference notebooks call: the Bedrock runtime
+`invoke_model` API, the litellm `completion` function, the OpenSearch Ingestion (OSI) endpoint, the
+OpenSearch search API and the S3 `get_object` API. Each stand-in has a configurable latency distribution, and
+throttling and error rates, and returns deterministic responses so that benchmark runs are repeatable
+without calling any AWS service.
+"""
+import io
+import os
+import re
+import json
+import time
+import random
+import hashlib
+import logging
+import threading
+import numpy as np
+from types import SimpleNamespace
+from botocore.exceptions import ClientError
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from local_vector_index import LocalVectorIndex, LocalOpenSearchClient
+
+logger = logging.getLogger(__name__)
+
+# outcomes of a simulated call
+OUTCOME_OK: str = "ok"
+OUTCOME_THROTTLED: str = "throttled"
+OUTCOME_ERROR: str = "error"
+
+# dimensions of the embeddings returned by the simulated Titan text embeddings model
+EMBEDDING_DIMENSIONS: int = 1536
+
+# words that the simulated models use for entities and answers, so that questions match documents
+DEFAULT_VOCABULARY: List[str] = [
+    "pipeline", "deployment", "governance", "monitoring", "feature store", "model registry", "training",
+    "inference", "data quality", "lineage", "automation", "security", "compliance", "architecture",
+    "observability", "drift", "experiment", "endpoint", "orchestration", "batch transform", "workflow",
+    "annotation", "evaluation", "retraining", "cost", "latency", "throughput", "scalability", "integration",
+    "interpretability",
+]
+
+
+class SimulatedThrottlingError(Exception):
+    """
+    Raised by a stand-in when a call is throttled.
+    """
+
+
+class SimulatedBackendError(Exception):
+    """
+    Raised by a stand-in when an error is injected into a call.
+    """
+
+
+class LatencyDistribution:
+    """
+    Distribution that the latency of each simulated call is sampled from. Supported distributions and
+    their parameters (in ms) are: constant (value_ms), uniform (min_ms, max_ms), normal (mean_ms,
+    stddev_ms) and lognormal (median_ms, sigma). Every sample is multiplied by `time_scale`.
+    """
+
+    def __init__(self, distribution: str = "constant", time_scale: float = 1.0, rng: Optional[random.Random] = None, **params: float):
+        if distribution not in ("constant", "uniform", "normal", "lognormal"):
+            raise ValueError(f"latency distribution={distribution} is not supported")
+        self.distribution = distribution
+        self.time_scale = time_scale
+        self.params = params
+        self._rng = rng if rng is not None else random.Random()
+
+    def sample_seconds(self) -> float:
+        p = self.params
+        if self.distribution == "constant":
+            ms = p.get('value_ms', 0.0)
+        elif self.distribution == "uniform":
+            ms = self._rng.uniform(p.get('min_ms', 0.0), p.get('max_ms', 0.0))
+        elif self.distribution == "normal":
+            ms = self._rng.gauss(p.get('mean_ms', 0.0), p.get('stddev_ms', 0.0))
+        else:
+            ms = p.get('median_ms', 0.0) * self._rng.lognormvariate(0.0, p.get('sigma', 0.0))
+        return max(ms, 0.0) * self.time_scale / 1000
+
+
+class BackendProfile:
+    """
+    Latency, throttling and error behaviour of one simulated service, and the counts of its calls.
+    """
+
+    def __init__(self, name: str, latency: Optional[Dict] = None, throttle_rate: float = 0.0, error_rate: float = 0.0,
+                 time_scale: float = 1.0, seed: Optional[int] = None):
+        """
+        :param name: Name of the service, used in the stats.
+        :param latency: Latency distribution settings, see `LatencyDistribution`.
+        :param throttle_rate: Fraction of the calls that are throttled.
+        :param error_rate: Fraction of the calls that fail with an error.
+        :param time_scale: Factor applied to every sampled latency.
+        :param seed: Seed of the random generator, for repeatable runs.
+        """
+        self.name = name
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+        self.latency = LatencyDistribution(time_scale=time_scale, rng=self._rng, **(latency or {}))
+        self._lock = threading.Lock()
+        self._counts: Dict[str, int] = {'calls': 0, OUTCOME_THROTTLED: 0, OUTCOME_ERROR: 0}
+
+    @classmethod
+    def from_config(cls, name: str, backend_info: Dict, time_scale: float = 1.0, seed: Optional[int] = None) -> "BackendProfile":
+        return cls(name,
+                   latency=backend_info.get('latency'),
+                   throttle_rate=backend_info.get('throttle_rate', 0.0),
+                   error_rate=backend_info.get('error_rate', 0.0),
+                   time_scale=time_scale,
+                   seed=seed)
+
+    def simulate_call(self) -> str:
+        """
+        Sleep for a sampled latency and return the outcome of the call.
+        """
+        latency_seconds, outcome = self.draw_call()
+        time.sleep(latency_seconds)
+        return outcome
+
+    def draw_call(self) -> Tuple[float, str]:
+        """
+        Sample the latency in seconds and the outcome of a call without sleeping, for calls whose latency is
+        spread over a stream of responses.
+        """
+        with self._rng_lock:
+            latency_seconds = self.latency.sample_seconds()
+            draw = self._rng.random()
+        if draw < self.throttle_rate:
+            outcome = OUTCOME_THROTTLED
+        elif draw < self.throttle_rate + self.error_rate:
+            outcome = OUTCOME_ERROR
+        else:
+            outcome = OUTCOME_OK
+        with self._lock:
+            self._counts['calls'] += 1
+            if outcome != OUTCOME_OK:
+                self._counts[outcome] += 1
+        return latency_seconds, outcome
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counts)
+
+
+def _seed_from_text(text: str) -> int:
+    return int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:8], 'little')
+
+
+def simulated_embedding(text: str, dimensions: int = EMBEDDING_DIMENSIONS) -> List[float]:
+    """
+    Deterministic unit length embedding of a text.
+    """
+    vector = np.random.default_rng(_seed_from_text(text)).standard_normal(dimensions)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def simulated_words(text: str, n: int, vocabulary: List[str] = DEFAULT_VOCABULARY) -> List[str]:
+    """
+    Deterministic choice of `n` words of the vocabulary for a text.
+    """
+    return random.Random(_seed_from_text(text)).sample(vocabulary, min(n, len(vocabulary)))
+
+
+def _count_tokens(text: str) -> int:
+    # rough token count, about 4 characters per token
+    return max(1, len(text) // 4)
+
+
+def _message_text(messages: List[Dict]) -> Tuple[str, int]:
+    # text of the messages, and the number of images in them
+    texts: List[str] = []
+    n_images: int = 0
+    for message in messages:
+        content = message.get('content')
+        if isinstance(content, str):
+            texts.append(content)
+            continue
+        for part in content or []:
+            if part.get('type') == 'text':
+                texts.append(part['text'])
+            elif part.get('type') in ('image', 'image_url'):
+                n_images += 1
+    return "\n".join(texts), n_images
+
+
+class SimulatedBedrockRuntime:
+    """
+    Stand-in for the boto3 `bedrock-runtime` client. `invoke_model` answers Titan embedding requests
+    with a deterministic embedding of the input text, and Anthropic messages requests with a comma
+    separated list of entities chosen from the vocabulary. Requests whose prompt asks for the entities and
+    the description in <entities> and <description> tags are answered in that format, except for a fraction
+    `malformed_rate` of them that are answered without the tags. Throttled and failed calls raise the same
+    `ClientError` codes as Bedrock, so the rate limited client retries them the same way.
+    """
+
+    def __init__(self, embeddings: BackendProfile, llm: BackendProfile, vocabulary: List[str] = DEFAULT_VOCABULARY,
+                 entities_per_response: int = 4, malformed_rate: float = 0.0):
+        """
+        :param embeddings: Behaviour of the embedding model calls.
+        :param llm: Behaviour of the text generation (and multimodal) model calls.
+        :param vocabulary: Words used for the entities in the responses.
+        :param entities_per_response: Number of entities in each response.
+        :param malformed_rate: Fraction of the responses in the tagged format that are returned without the tags.
+        """
+        self.embeddings = embeddings
+        self.llm = llm
+        self.vocabulary = vocabulary
+        self.entities_per_response = entities_per_response
+        self.malformed_rate = malformed_rate
+
+    def invoke_model(self, body: str, modelId: str, accept: str = 'application/json', contentType: str = 'application/json', **kwargs) -> Dict:
+        request: Dict = json.loads(body)
+        profile = self.embeddings if 'inputText' in request else self.llm
+        outcome = profile.simulate_call()
+        if outcome == OUTCOME_THROTTLED:
+            raise ClientError({'Error': {'Code': 'ThrottlingException', 'Message': 'simulated throttling'}}, 'InvokeModel')
+        if outcome == OUTCOME_ERROR:
+            raise ClientError({'Error': {'Code': 'ModelErrorException', 'Message': 'simulated model error'}}, 'InvokeModel')
+        if 'inputText' in request:
+            text: str = request['inputText']
+            response = {'embedding': simulated_embedding(text), 'inputTextTokenCount': _count_tokens(text)}
+        else:
+            text, n_images = _message_text(request.get('messages', []))
+            # the entities of an image depend on the image, so the image data is part of the seed
+            seed_text = text + "".join(part.get('source', {}).get('data', '')[:4096]
+                                       for message in request.get('messages', [])
+                                       for part in (message.get('content') if isinstance(message.get('content'), list) else []))
+            completion_text = ", ".join(simulated_words(seed_text, self.entities_per_response, self.vocabulary))
+            if '<description>' in text:
+                # the same response for the same image and prompt, so that the malformed responses are reproducible
+                description = " ".join(simulated_words(seed_text + 'description', 3 * self.entities_per_response, self.vocabulary))
+                if random.Random(_seed_from_text(seed_text + 'malformed')).random() >= self.malformed_rate:
+                    completion_text = f"<entities>\n{completion_text}\n</entities>\n<description>\n{description}\n</description>"
+                else:
+                    completion_text = f"{completion_text}\n{description}"
+            response = {'content': [{'type': 'text', 'text': completion_text}],
+                        'usage': {'input_tokens': _count_tokens(text) + 1500 * n_images,
+                                  'output_tokens': _count_tokens(completion_text)}}
+        return {'body': io.BytesIO(json.dumps(response).encode('utf-8')), 'contentType': 'application/json'}
+
+    def stats(self) -> Dict[str, Dict]:
+        return {'embeddings': self.embeddings.stats(), 'llm': self.llm.stats()}
+
+
+class SimulatedCompletion:
+    """
+    Stand-in for the litellm `completion` function. A fraction `not_found_rate` of the calls answer
+    "not found", the others answer with a sentence made of vocabulary words, citing the first source id
+    (such as [S1]) of the prompt if it has any. The response has the
+    `choices`, `usage` and `_response_ms` fields that the notebooks read from litellm responses. With
+    `stream=True`, the answer is returned as litellm stream chunks, one per word, the first one after
+    `first_token_fraction` of the sampled latency and the rest spread over the remaining latency.
+    """
+
+    def __init__(self, profile: BackendProfile, not_found_rate: float = 0.5, vocabulary: List[str] = DEFAULT_VOCABULARY,
+                 seed: Optional[int] = None, first_token_fraction: float = 0.25):
+        self.profile = profile
+        self.not_found_rate = not_found_rate
+        self.first_token_fraction = first_token_fraction
+        self.vocabulary = vocabulary
+        self._rng = random.Random(seed)
+        self._rng_lock = threading.Lock()
+
+    def __call__(self, model: str, messages: List[Dict], temperature: Optional[float] = None, max_tokens: Optional[int] = None,
+                 stream: bool = False, **kwargs) -> Any:
+        st = time.perf_counter()
+        latency_seconds, outcome = self.profile.draw_call()
+        time.sleep(latency_seconds * (self.first_token_fraction if stream else 1.0))
+        if outcome == OUTCOME_THROTTLED:
+            raise SimulatedThrottlingError(f"simulated throttling of {model}")
+        if outcome == OUTCOME_ERROR:
+            raise SimulatedBackendError(f"simulated error of {model}")
+        text, n_images = _message_text(messages)
+        with self._rng_lock:
+            not_found = self._rng.random() < self.not_found_rate
+        content = "not found" if not_found else \
+                  f"The answer covers {', '.join(simulated_words(text, 3, self.vocabulary))}."
+        source_ids: List[str] = re.findall(r"\[(S\d+)\]", text)
+        if source_ids and not not_found:
+            content += f" [{source_ids[0]}]"
+        if stream:
+            return self._stream(content, _count_tokens(text) + 1500 * n_images, latency_seconds * (1 - self.first_token_fraction))
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+                               usage=SimpleNamespace(prompt_tokens=_count_tokens(text) + 1500 * n_images,
+                                                     completion_tokens=_count_tokens(content)),
+                               _response_ms=(time.perf_counter() - st) * 1000)
+
+    def _stream(self, content: str, prompt_tokens: int, remaining_seconds: float) -> Iterator[Any]:
+        words: List[str] = re.findall(r"\S+\s*", content)
+        for i, word in enumerate(words):
+            if i > 0:
+                time.sleep(remaining_seconds / len(words))
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=word))], usage=None)
+        # the last chunk carries the usage, as with stream_options={'include_usage': True}
+        yield SimpleNamespace(choices=[], usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=_count_tokens(content)))
+
+    def stats(self) -> Dict[str, int]:
+        return self.profile.stats()
+
+
+class SimulatedOSIEndpoint:
+    """
+    Local HTTP server that stands in for the ingest endpoints of OSI pipelines. Each POST of a JSON list
+    of documents is answered with 200, or with 429/500 for throttled and failed calls. The documents that
+    are accepted are kept per pipeline, the first part of the URL path.
+    """
+
+    def __init__(self, profile: BackendProfile, host: str = '127.0.0.1', port: int = 0):
+        """
+        :param profile: Behaviour of the endpoint.
+        :param host: Address that the server listens on.
+        :param port: Port that the server listens on, 0 to pick a free port.
+        """
+        self.profile = profile
+        self._documents: Dict[str, List[Dict]] = {}
+        self._lock = threading.Lock()
+        endpoint = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                outcome = endpoint.profile.simulate_call()
+                status = {OUTCOME_OK: 200, OUTCOME_THROTTLED: 429, OUTCOME_ERROR: 500}[outcome]
+                if outcome == OUTCOME_OK:
+                    pipeline = self.path.strip('/').split('/')[0]
+                    with endpoint._lock:
+                        endpoint._documents.setdefault(pipeline, []).extend(json.loads(body))
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                self.wfile.write(json.dumps({'status': outcome}).encode('utf-8'))
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def url(self, pipeline: str) -> str:
+        """
+        Ingest URL of a pipeline.
+        """
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/{pipeline}/data/ingest"
+
+    def documents(self, pipeline: str) -> List[Dict]:
+        """
+        Documents that were ingested into a pipeline.
+        """
+        with self._lock:
+            return list(self._documents.get(pipeline, []))
+
+    def stats(self) -> Dict[str, int]:
+        return self.profile.stats()
+
+    def close(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class SimulatedOpenSearch:
+    """
+    Stand-in for the OpenSearch client `search` API. Queries are answered by local vector indexes, so the
+    knn and entity prefilter queries return real hits from the documents that were ingested.
+    """
+
+    def __init__(self, profile: BackendProfile, indexes: Dict[str, LocalVectorIndex]):
+        self.profile = profile
+        self._client = LocalOpenSearchClient(indexes)
+
+    def search(self, body: Dict, index: str, **kwargs) -> Dict:
+        outcome = self.profile.simulate_call()
+        if outcome == OUTCOME_THROTTLED:
+            raise SimulatedThrottlingError(f"simulated throttling of a search on {index}")
+        if outcome == OUTCOME_ERROR:
+            raise SimulatedBackendError(f"simulated error of a search on {index}")
+        return self._client.search(body=body, index=index, **kwargs)
+
+    def stats(self) -> Dict[str, int]:
+        return self.profile.stats()
+
+
+class SimulatedS3:
+    """
+    Stand-in for the S3 `get_object` API. Objects are served from a local directory that holds a file with
+    the same name as the object, and their ETag is the MD5 of the file contents. Conditional requests with an
+    `IfNoneMatch` ETag that matches raise the same 304 `ClientError` as S3.
+    """
+
+    def __init__(self, profile: BackendProfile, source_dir: str):
+        """
+        :param profile: Behaviour of the requests.
+        :param source_dir: Directory with the files that stand in for the S3 objects, by object name.
+        """
+        self.profile = profile
+        self.source_dir = source_dir
+
+    def get_object(self, Bucket: str, Key: str, IfNoneMatch: Optional[str] = None) -> Dict:
+        outcome = self.profile.simulate_call()
+        if outcome == OUTCOME_THROTTLED:
+            raise ClientError({'Error': {'Code': 'SlowDown', 'Message': 'simulated throttling'}}, 'GetObject')
+        if outcome == OUTCOME_ERROR:
+            raise ClientError({'Error': {'Code': 'InternalError', 'Message': 'simulated error'}}, 'GetObject')
+        with open(os.path.join(self.source_dir, os.path.basename(Key)), 'rb') as f:
+            data = f.read()
+        etag: str = f'"{hashlib.md5(data).hexdigest()}"'
+        if IfNoneMatch is not None and IfNoneMatch.strip('"') == etag.strip('"'):
+            raise ClientError({'Error': {'Code': '304', 'Message': 'Not Modified'}}, 'GetObject')
+        return {'Body': io.BytesIO(data), 'ETag': etag, 'ContentLength': len(data)}
+
+    def stats(self) -> Dict[str, int]:
+        return self.profile.stats()
@@ -0,0 +1,67 @@
+"""
+Registry of the prompt templates used by the solution. Each template file is read from disk once, the
+first time that it is used, and shared by every call in the process afterwards, so that the functions
+that format a prompt on every call do not re-read the template file each time.
+"""
+import os
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class PromptTemplateRegistry:
+    """
+    Thread safe cache of prompt templates keyed by the name of the template in the dir_info section of the
+    config file, such as 'final_combined_llm_response_prompt'.
+    """
+
+    def __init__(self, dir_info: Dict):
+        """
+        :param dir_info: The dir_info section of the config file, with the prompt directory in 'prompt_dir'
+                         and the file name of each template keyed by the name of the template.
+        """
+        self.dir_info = dir_info
+        self._lock = threading.Lock()
+        self._templates: Dict[str, str] = {}
+
+    def path(self, name: str) -> str:
+        """
+        Return the path of the file of a template.
+        """
+        return os.path.join(self.dir_info['prompt_dir'], self.dir_info[name])
+
+    def get(self, name: str) -> str:
+        """
+        Return a template, reading it from disk the first time that it is used.
+        """
+        template: Optional[str] = self._templates.get(name)
+        if template is None:
+            with self._lock:
+                template = self._templates.get(name)
+                if template is None:
+                    template = Path(self.path(name)).read_text()
+                    self._templates[name] = template
+                    logger.debug(f"loaded the prompt template {name} from {self.path(name)}")
+        return template
+
+    def format(self, name: str, **kwargs) -> str:
+        """
+        Return a template with its placeholders replaced by the keyword arguments.
+        """
+        return self.get(name).format(**kwargs)
+
+    def preload(self, names: Iterable[str]) -> Dict[str, str]:
+        """
+        Read the given templates, for example when a service starts, and return them keyed by name.
+        """
+        return {name: self.get(name) for name in names}
+
+    def clear(self) -> None:
+        """
+        Forget the loaded templates, so that edited template files are read again on their next use.
+        """
+        with self._lock:
+            self._templates.clear()
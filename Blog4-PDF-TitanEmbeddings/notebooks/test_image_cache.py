@@ -0,0 +1,81 @@
+"""
+Tests of the error paths of the S3 image cache, run with `python -m pytest test_image_cache.py` from this directory.
+"""
+import os
+import threading
+from botocore.exceptions import ClientError
+from image_cache import S3ImageCache
+
+
+class FakeBody:
+    def __init__(self, data: bytes):
+        self._data = data
+
+    def read(self) -> bytes:
+        return self._data
+
+
+class FakeS3:
+    # in memory S3 client with the get_object calls used by the image cache
+    def __init__(self, objects):
+        self.objects = objects
+        self.calls = 0
+
+    def get_object(self, Bucket, Key, **kwargs):
+        self.calls += 1
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': 'not found'}}, 'GetObject')
+        return {'Body': FakeBody(self.objects[Key]), 'ETag': '"etag"'}
+
+
+def call_with_timeout(fn, *args, timeout: float = 5.0):
+    # run fn in a thread so that a deadlock fails the test instead of hanging it
+    result = {}
+
+    def run():
+        try:
+            result['value'] = fn(*args)
+        except Exception as e:
+            result['error'] = e
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), f"{fn.__name__} did not return within {timeout} seconds"
+    return result
+
+
+def test_invalid_uri_raises(tmp_path):
+    cache = S3ImageCache(str(tmp_path), s3_client=FakeS3({}))
+    result = call_with_timeout(cache.get_bytes, "/local/path/0.jpg")
+    assert isinstance(result.get('error'), ValueError)
+    # an invalid URI is skipped by prefetch
+    call_with_timeout(cache.prefetch, ["/local/path/0.jpg"])
+    assert cache._inflight == {}
+    cache.close()
+
+
+def test_fetch_error_raises_and_is_not_kept(tmp_path):
+    s3 = FakeS3({})
+    cache = S3ImageCache(str(tmp_path), s3_client=s3)
+    for _ in range(2):
+        result = call_with_timeout(cache.get_bytes, "s3://bucket/missing.jpg")
+        assert isinstance(result.get('error'), ClientError)
+    # the failed request is forgotten, so the object is requested again
+    assert s3.calls == 2
+    assert cache._inflight == {}
+    assert cache.stats()['entries'] == 0
+    cache.close()
+
+
+def test_evicted_file_is_downloaded_again(tmp_path):
+    s3 = FakeS3({'page.jpg': b'image'})
+    cache = S3ImageCache(str(tmp_path), s3_client=s3)
+    assert cache.get_bytes("s3://bucket/page.jpg") == b'image'
+    # the file is removed after the index lookup, as if it had been evicted, and the object is not in memory
+    os.remove(cache.get_path("s3://bucket/page.jpg"))
+    cache._memory.clear()
+    cache._memory_bytes = 0
+    result = call_with_timeout(cache.get_bytes, "s3://bucket/page.jpg")
+    assert result.get('value') == b'image'
+    assert s3.calls == 2
+    cache.close()
@@ -1,22 +1,35 @@
 """
-Utility functions for S3 and CloudFormation used by the rest of the code
+Utility functions for S3 and CloudFormation used by the rest of the code.
+
+Importing this module is kept cheap so that notebooks, Ray workers and the query service start quickly:
+litellm, boto3 and the modules that import boto3 or requests are imported on first use, the config is
+loaded the first time that it is read, and each prompt template is read from disk once.
 """
+from __future__ import annotations
 import os
+import re
 import yaml
+import string
 import json
-import boto3
 import logging
-import botocore
+import threading
 import numpy as np
 import globals as g
-from pathlib import Path
-from typing import List, Dict
-from litellm import completion
-from sagemaker.s3 import S3Uploader
+from typing import TYPE_CHECKING, Callable, List, Dict, Optional, Tuple, Union
+from embedding_cache import EmbeddingCache
+from answer_cache import SemanticAnswerCache
+from latency_tracer import LatencyTracer
+from llm_streaming import stream_completion
+from template_registry import PromptTemplateRegistry
 
-logger = logging.getLogger(__name__)
+if TYPE_CHECKING:
+    import botocore
+    from image_cache import S3ImageCache
+    from s3_transfer import S3TransferManager
+    from bedrock_utils import RateLimitedBedrockClient
+    from bulk_writer import BulkWriter
 
-s3 = boto3.client('s3')
+logger = logging.getLogger(__name__)
 
 def _merge_dicts(src, dest):
     for key, value in src.items():
@@ -45,33 +58,201 @@ def load_and_merge_configs(config_path: str, full_config_path: str):
     _merge_dicts(user_config, full_config)
     return full_config
 
-# initialize the full config file
-config = load_and_merge_configs(g.CONFIG_SUBSET_FILE, g.FULL_CONFIG_FILE)
+# the merged config is loaded the first time that it is read, with get_config() or as `utils.config`
+_config: Optional[Dict] = None
+_config_lock = threading.Lock()
 
-def upload_to_s3(local_file_path:str, bucket_name: str, bucket_prefix:str) -> None:
-    global s3
-    try:
-        with open(local_file_path, 'rb') as file:
-            s3_key = os.path.join(bucket_prefix, os.path.basename(local_file_path))
-            s3.upload_fileobj(file, bucket_name, s3_key)
-            logger.info(f"File {local_file_path} uploaded to {bucket_name}/{s3_key}.")
-    except Exception as e:
-        logger.error(f"error uploading file to S3: {e}")
+def get_config() -> Dict:
+    """
+    Return the merged config of this process, loading it from the config files on first use.
+    """
+    global _config
+    if _config is None:
+        with _config_lock:
+            if _config is None:
+                _config = load_and_merge_configs(g.CONFIG_SUBSET_FILE, g.FULL_CONFIG_FILE)
+    return _config
+
+def __getattr__(name: str):
+    # `from utils import config` and `utils.config` return the memoized config
+    if name == 'config':
+        return get_config()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def completion(*args, **kwargs):
+    """
+    The litellm `completion` function. litellm takes seconds to import, so it is imported on the first call.
+    """
+    from litellm import completion as litellm_completion
+    return litellm_completion(*args, **kwargs)
+
+# prompt templates shared by every call in this process, each template file is read once
+_prompt_templates: Optional[PromptTemplateRegistry] = None
+_prompt_templates_lock = threading.Lock()
+
+def get_prompt_templates() -> PromptTemplateRegistry:
+    """
+    Return the process wide registry of the prompt templates in the dir_info section of the config.
+    """
+    global _prompt_templates
+    if _prompt_templates is None:
+        with _prompt_templates_lock:
+            if _prompt_templates is None:
+                _prompt_templates = PromptTemplateRegistry(get_config()['dir_info'])
+    return _prompt_templates
+
+# embedding cache shared by every call in this process, created on first use
+_embedding_cache: Optional[EmbeddingCache] = None
+_embedding_cache_lock = threading.Lock()
+
+def get_embedding_cache() -> Optional[EmbeddingCache]:
+    """
+    Return the process wide embedding cache, or None if caching is disabled in the config.
+    """
+    global _embedding_cache
+    cache_info: Dict = get_config().get('embedding_cache', {})
+    if not cache_info.get('enabled', False):
+        return None
+    if _embedding_cache is None:
+        with _embedding_cache_lock:
+            if _embedding_cache is None:
+                _embedding_cache = EmbeddingCache(cache_info['cache_path'],
+                                                  max_entries=cache_info.get('max_entries'),
+                                                  max_size_mb=cache_info.get('max_size_mb'))
+    return _embedding_cache
+
+# cache of the entities extracted from the page texts, created on first use
+_entity_cache: Optional[EmbeddingCache] = None
+_entity_cache_lock = threading.Lock()
+
+def get_entity_cache() -> Optional[EmbeddingCache]:
+    """
+    Return the process wide cache of the entities extracted from the page texts, keyed by a hash of the text,
+    or None if it is disabled in the config.
+    """
+    global _entity_cache
+    text_ingestion_info: Dict = get_config().get('text_ingestion_info', {})
+    if not text_ingestion_info.get('entity_cache_enabled', False):
+        return None
+    if _entity_cache is None:
+        with _entity_cache_lock:
+            if _entity_cache is None:
+                _entity_cache = EmbeddingCache(text_ingestion_info['entity_cache_path'],
+                                               max_entries=text_ingestion_info.get('entity_cache_max_entries'))
+    return _entity_cache
+
+# semantic answer cache shared by every call in this process, created on first use
+_answer_cache: Optional[SemanticAnswerCache] = None
+_answer_cache_lock = threading.Lock()
+
+def get_answer_cache() -> Optional[SemanticAnswerCache]:
+    """
+    Return the process wide semantic answer cache, or None if it is disabled in the config.
+    """
+    global _answer_cache
+    cache_info: Dict = get_config().get('answer_cache_info', {})
+    if not cache_info.get('enabled', False):
+        return None
+    if _answer_cache is None:
+        with _answer_cache_lock:
+            if _answer_cache is None:
+                _answer_cache = SemanticAnswerCache(similarity_threshold=cache_info.get('similarity_threshold', 0.95),
+                                                    ttl_seconds=cache_info.get('ttl_seconds'),
+                                                    max_entries=cache_info.get('max_entries', 1000))
+    return _answer_cache
+
+# latency tracer shared by every query in this process, created on first use
+_latency_tracer: Optional[LatencyTracer] = None
+_latency_tracer_lock = threading.Lock()
+
+def get_latency_tracer() -> LatencyTracer:
+    """
+    Return the process wide latency tracer. If tracing is disabled in the config, the tracer does not record spans.
+    """
+    global _latency_tracer
+    if _latency_tracer is None:
+        with _latency_tracer_lock:
+            if _latency_tracer is None:
+                tracing_info: Dict = get_config().get('latency_tracing_info', {})
+                _latency_tracer = LatencyTracer(enabled=tracing_info.get('enabled', True),
+                                                max_spans=tracing_info.get('max_spans', 100000),
+                                                otel_enabled=tracing_info.get('otel_enabled', False))
+    return _latency_tracer
+
+# image cache shared by every query in this process, created on first use
+_image_cache: Optional[S3ImageCache] = None
+_image_cache_lock = threading.Lock()
+
+def get_image_cache() -> S3ImageCache:
+    """
+    Return the process wide cache of the images retrieved from S3.
+    """
+    global _image_cache
+    if _image_cache is None:
+        with _image_cache_lock:
+            if _image_cache is None:
+                from image_cache import S3ImageCache
+                cache_info: Dict = get_config().get('image_cache_info', {})
+                _image_cache = S3ImageCache(cache_info.get('cache_dir', 'cache/images'),
+                                            max_size_mb=cache_info.get('max_size_mb', 512),
+                                            max_memory_mb=cache_info.get('max_memory_mb', 64),
+                                            max_workers=cache_info.get('max_workers', 16),
+                                            revalidate_after_seconds=cache_info.get('revalidate_after_seconds'))
+    return _image_cache
+
+# S3 transfer manager shared by every upload and download in this process, created on first use
+_transfer_manager: Optional[S3TransferManager] = None
+_transfer_manager_lock = threading.Lock()
+
+def get_transfer_manager() -> S3TransferManager:
+    """
+    Return the process wide S3 transfer manager, configured by the s3_transfer_info section of the config file.
+    """
+    global _transfer_manager
+    if _transfer_manager is None:
+        with _transfer_manager_lock:
+            if _transfer_manager is None:
+                from s3_transfer import S3TransferManager
+                transfer_info: Dict = get_config().get('s3_transfer_info', {})
+                _transfer_manager = S3TransferManager(max_workers=transfer_info.get('max_workers', 16),
+                                                      multipart_threshold_mb=transfer_info.get('multipart_threshold_mb', 8),
+                                                      multipart_chunksize_mb=transfer_info.get('multipart_chunksize_mb', 8),
+                                                      max_concurrency_per_object=transfer_info.get('max_concurrency_per_object', 4),
+                                                      skip_unchanged=transfer_info.get('skip_unchanged', True))
+    return _transfer_manager
+
+def get_bedrock_runtime_client() -> RateLimitedBedrockClient:
+    """
+    Return the pooled, rate limited Bedrock runtime client shared by every call in this process.
+    """
+    from bedrock_utils import get_shared_bedrock_client
+    inference_info: Dict = get_config()['inference_info']
+    return get_shared_bedrock_client(max_pool_connections=inference_info.get('bedrock_max_pool_connections', 50),
+                                     requests_per_second=inference_info.get('max_requests_per_second_per_model'),
+                                     initial_concurrency=inference_info['parallel_inference_count'],
+                                     max_concurrency=inference_info.get('max_parallel_inference_count', 64))
+
+def get_osi_bulk_writer(osi_endpoint: str) -> BulkWriter:
+    """
+    Return the batched writer for an OpenSearch Ingestion endpoint shared by every call in this process.
+    """
+    from bulk_writer import get_bulk_writer
+    writer_info: Dict = get_config().get('osi_bulk_writer_info', {})
+    return get_bulk_writer(osi_endpoint, **writer_info)
+
+def upload_to_s3(local_file_path:str, bucket_name: str, bucket_prefix:str) -> bool:
+    # the upload is skipped if the object in S3 already has the same size and ETag as the file
+    s3_key = os.path.join(bucket_prefix, os.path.basename(local_file_path))
+    return get_transfer_manager().upload_file(local_file_path, bucket_name, s3_key)
 
 
 def download_image_files_from_s3(bucket:str, bucket_image_prefix:str, local_image_dir:str, image_file_extn:str) -> List:
-    images = s3.list_objects_v2(Bucket=bucket, Prefix=bucket_image_prefix)['Contents']
-    local_file_paths: List = []
-    for img in images:
-        if img['Key'].endswith(image_file_extn):
-            file_path = os.path.join(local_image_dir, os.path.basename(img['Key']))            
-            s3.download_file(bucket, img['Key'], file_path)
-            logger.info(f"downloaded {bucket}/{img['Key']} to {file_path}")
-            local_file_paths.append(file_path)
-    return local_file_paths 
+    # every page of the listing is downloaded concurrently, files that are unchanged since the last download are skipped
+    return get_transfer_manager().download_prefix(bucket, bucket_image_prefix, local_image_dir, suffix=image_file_extn)
 
 
 def get_cfn_outputs(stackname: str) -> List:  
+    import boto3
     cfn = boto3.client('cloudformation')
     outputs = {}
     stacks = cfn.describe_stacks(StackName=stackname)['Stacks']
@@ -88,16 +269,25 @@ def get_bucket_name(stackname: str) -> str:
     return bucketname
 
 
-def get_text_embedding(bedrock: botocore.client, prompt_data: str) -> np.ndarray:
+def get_text_embedding(bedrock: botocore.client, prompt_data: str, modelId: str = g.TITAN_MODEL_ID) -> np.ndarray:
+    # return the cached embedding if this text has already been embedded by this model
+    cache = get_embedding_cache()
+    if cache is not None:
+        cached_response = cache.get(modelId, prompt_data)
+        if cached_response is not None:
+            return cached_response.get('embedding')
     body = json.dumps({
         "inputText": prompt_data,
     })
     try:
         response = bedrock.invoke_model(
-            body=body, modelId=g.TITAN_MODEL_ID, accept=g.ACCEPT_ENCODING, contentType=g.CONTENT_ENCODING
+            body=body, modelId=modelId, accept=g.ACCEPT_ENCODING, contentType=g.CONTENT_ENCODING
         )
         response_body = json.loads(response['body'].read())
         embedding = response_body.get('embedding')
+        if cache is not None and embedding is not None:
+            cache.put(modelId, prompt_data, {'embedding': embedding,
+                                             'inputTextTokenCount': response_body.get('inputTextTokenCount')})
     except Exception as e:
         logger.error(f"exception={e}")
         embedding = None
@@ -107,15 +297,16 @@ def get_text_embedding(bedrock: botocore.client, prompt_data: str) -> np.ndarray
 
 def get_llm_response(question: str, 
                      summary: str, 
-                     modelId: str = g.CLAUDE_MODEL_ID) -> Dict:
+                     modelId: str = g.CLAUDE_MODEL_ID,
+                     on_token: Optional[Callable[[str], None]] = None) -> Dict:
     """
     This function takes in the prompt that checks whether the text file has a response to the question and if not, 
     returns "not found" to move to the next hit.
+    If `on_token` is given, the response is streamed and `on_token` is called with each piece of text as it arrives.
+    The returned dictionary is populated once the stream ends, with the time to the first token in addition.
     """
-    get_final_llm_response_prompt_fpath: str = os.path.join(config['dir_info']['prompt_dir'],
-                                                                     config['dir_info']['final_combined_llm_response_prompt'])
-    final_llm_prompt: str = Path(get_final_llm_response_prompt_fpath).read_text()
-    prompt = final_llm_prompt.format(question=question, summary=summary)
+    config = get_config()
+    prompt = get_prompt_templates().format('final_combined_llm_response_prompt', question=question, summary=summary)
     messages = [
         {
             "role": "user",
@@ -137,9 +328,17 @@ def get_llm_response(question: str,
         "prompt_token_count": None,
         "model_id": modelId,
         "time_taken_in_seconds": None,
+        "time_to_first_token_in_seconds": None,
         "input_token_cost": None,
         "output_token_cost": None,
     }
+    if on_token is not None:
+        try:
+            ret.update(stream_completion(completion, modelId, messages, on_token, temperature=temperature, max_tokens=max_tokens))
+        except Exception as e:
+            logger.error(f"exception={e}")
+            ret["exception"] = e
+        return ret
     try:
         response = completion(
             model=modelId,
@@ -170,10 +369,7 @@ def get_llm_response(question: str,
 def get_question_entities(bedrock: botocore.client, 
                    question:str, 
                    modelId: str = g.CLAUDE_MODEL_ID) -> str:
-    get_entities_from_user_question_prompt_fpath: str = os.path.join(config['dir_info']['prompt_dir'],
-                                                                     config['dir_info']['extract_entities_from_user_question'])
-    question_entities_extraction_prompt: str = Path(get_entities_from_user_question_prompt_fpath).read_text()
-    prompt = question_entities_extraction_prompt.format(question=question)
+    prompt = get_prompt_templates().format('extract_entities_from_user_question', question=question)
 
     body = json.dumps(
     {
@@ -201,4 +397,59 @@ def get_question_entities(bedrock: botocore.client,
         logger.error(f"exception while getting question entities: exception={e}")
         combined_llm_response = None
 
-    return combined_llm_response
\ No newline at end of file
+    return combined_llm_response
+
+
+def normalize_entities(entities: Union[str, List[str], None]) -> List[str]:
+    """
+    Convert the entities extracted from an image, a text or a question into a list of normalized
+    entity terms that are matched exactly during the prefilter step. A string of entities is split
+    on commas, semicolons and new lines, and each entity is lower cased, single spaced and stripped
+    of surrounding punctuation. Duplicates are removed, keeping the order of the entities.
+
+    :param entities: Comma separated string or list of entities.
+    :return: List of normalized entity terms.
+    """
+    if not entities:
+        return []
+    if isinstance(entities, str):
+        entities = re.split(r"[,;\n]", entities)
+    entity_terms: List[str] = []
+    for entity in entities:
+        entity_term: str = re.sub(r"\s+", " ", entity).strip(string.punctuation + string.whitespace).lower()
+        if entity_term and entity_term not in entity_terms:
+            entity_terms.append(entity_term)
+    return entity_terms
+
+
+def _tagged_section(response: str, tag: str) -> Optional[re.Match]:
+    # text between <tag> and </tag>, or to the end of the response if the closing tag is missing because the
+    # response was cut off
+    return re.search(rf"<\s*{tag}\s*>(.*?)(?:<\s*/\s*{tag}\s*>|$)", response, flags=re.IGNORECASE | re.DOTALL)
+
+
+def parse_entities_and_description(response: str) -> Optional[Tuple[str, str]]:
+    """
+    Parse the response to the image_entities_and_description_template prompt, which has the entities of an
+    image in <entities></entities> tags followed by the description of the image in <description></description>
+    tags. The tags are matched regardless of case and surrounding whitespace, in either order, and text outside
+    of the tags is ignored.
+
+    :param response: Text of the model response.
+    :return: The entities and the description, or None if either of them is missing or empty.
+    """
+    if not response:
+        return None
+    description_match = _tagged_section(response, 'description')
+    if description_match is None:
+        return None
+    # the entities are looked for outside of the description, so that an entities section without its closing
+    # tag ends where the description starts
+    entities_match = _tagged_section(response[:description_match.start()] + response[description_match.end():], 'entities')
+    if entities_match is None:
+        return None
+    entities: str = entities_match.group(1).strip()
+    description: str = description_match.group(1).strip()
+    if not entities or not description:
+        return None
+    return entities, description
\ No newline at end of file